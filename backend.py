@@ -0,0 +1,204 @@
+NATIVE_WIDTH = 64
+NATIVE_HEIGHT = 32
+
+# SUPER-CHIP and XO-CHIP high resolution mode
+HIRES_WIDTH = 128
+HIRES_HEIGHT = 64
+
+PLANES = 2  # XO-CHIP bitplanes; plain CHIP-8 and SUPER-CHIP only ever use the first
+
+
+# The eight pixels (one byte each, 0 or 1) for every possible byte of a packed row
+PIXEL_BYTES = [bytes((value >> (7 - bit)) & 0x1 for bit in range(8)) for value in range(256)]
+
+
+# Everything the CPU and the emulator loop need from a display
+# The framebuffer lives here as one integer bitmask per row, with the leftmost pixel in the highest bit, along with a
+# flag per row saying whether it changed since the last present. Backends only decide what to do with it: the pygame
+# window in display.py shows it, HeadlessDisplay keeps it in memory
+# XO-CHIP adds a second bitplane, so there is a list of rows per plane and a pixel's color is its bit from each plane
+# (0-3). Drawing, clearing and scrolling only touch the planes selected in plane_mask. Switching between low and high
+# resolution (resize) swaps in new rows; scrolling shifts whole rows and row bitmasks, never single pixels
+class DisplayBackend:
+
+    headless = False    # True if there is no window, so the emulator can run uncapped
+
+    def __init__(self, width, height):
+        self.plane_mask = 1     # bit p set if plane p is drawn to, cleared and scrolled (XO-CHIP's PLANE)
+        self.keypad = None      # the Keypad host key events go to, set by CHIP8
+        self.resize(width, height)
+
+    # Switch to a width x height framebuffer, blanking every plane
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+        self.mask = (1 << width) - 1
+        self.planes = [[0] * height for _ in range(PLANES)]
+        self.dirty = bytearray(b"\x01") * height   # 1 for every row changed since the last present
+
+    # The first plane, which is the whole framebuffer for anything but XO-CHIP
+    @property
+    def rows(self):
+        return self.planes[0]
+
+    @rows.setter
+    def rows(self, rows):
+        self.planes[0] = rows
+
+    # The planes selected by plane_mask
+    def selected_planes(self):
+        return [plane for p, plane in enumerate(self.planes) if self.plane_mask >> p & 0x1]
+
+    # XOR the sprite onto the framebuffer at (start_x, start_y), returning 1 if any lit pixel was turned off
+    # The sprite is bytes, one per row, or two per row (big-endian) for a 16 pixel wide sprite, and wraps around the
+    # edges of the screen. With more than one plane selected, each plane takes its share of the sprite in turn
+    def draw_sprite(self, start_x, start_y, sprite, sprite_width=8):
+        if sprite_width == 16:
+            sprite = [sprite[k] << 8 | sprite[k + 1] for k in range(0, len(sprite) - 1, 2)]
+
+        if self.plane_mask == 1:
+            return self.draw_plane(self.planes[0], start_x, start_y, sprite, sprite_width)
+
+        planes = self.selected_planes()
+        if not planes:
+            return 0
+        size = len(sprite) // len(planes)
+        collision = 0
+        for k, rows in enumerate(planes):
+            collision |= self.draw_plane(rows, start_x, start_y, sprite[k * size:(k + 1) * size], sprite_width)
+        return collision
+
+    def draw_plane(self, rows, start_x, start_y, sprite, sprite_width):
+        width = self.width
+        height = self.height
+        dirty = self.dirty
+        collision = 0
+
+        # Where the lowest bit of a sprite row lands; negative means the row wraps past the right edge
+        shift = width - sprite_width - start_x % width
+        y = start_y % height
+
+        for byte in sprite:
+            if byte:
+                if shift >= 0:
+                    bits = byte << shift
+                else:
+                    bits = ((byte >> -shift) | (byte << (width + shift))) & self.mask
+
+                row = rows[y]
+                if row & bits:
+                    collision = 1
+                rows[y] = row ^ bits
+                dirty[y] = 1
+
+            y += 1
+            if y == height:
+                y = 0
+
+        return collision
+
+    # Turn every pixel of the selected planes off
+    def clear(self):
+        for p in range(PLANES):
+            if self.plane_mask >> p & 0x1:
+                self.planes[p] = [0] * self.height
+        self.dirty[:] = b"\x01" * self.height
+
+    # Scroll the selected planes by n pixels, filling in with blank pixels (SUPER-CHIP and XO-CHIP)
+    def scroll_down(self, n):
+        self.scroll(lambda rows: [0] * min(n, self.height) + rows[:max(self.height - n, 0)])
+
+    def scroll_up(self, n):
+        self.scroll(lambda rows: rows[n:] + [0] * min(n, self.height))
+
+    def scroll_right(self, n):
+        self.scroll(lambda rows: [row >> n for row in rows])
+
+    def scroll_left(self, n):
+        mask = self.mask
+        self.scroll(lambda rows: [(row << n) & mask for row in rows])
+
+    def scroll(self, shifted):
+        for p in range(PLANES):
+            if self.plane_mask >> p & 0x1:
+                self.planes[p] = shifted(self.planes[p])
+        self.dirty[:] = b"\x01" * self.height
+
+    def get_pixel(self, x, y):
+        if 0 <= x < self.width:
+            if 0 <= y < self.height:
+                return (self.rows[y] >> (self.width - 1 - x)) & 0x1
+            else:
+                print(f"Invalid y coord of {y} (max is {self.height - 1})")
+        else:
+            print(f"Invalid x coord of {x} (max is {self.width -1})")
+
+    def set_pixel(self, x, y, state):
+        if self.get_pixel(x, y) is not None:
+            bit = 1 << (self.width - 1 - x)
+            self.rows[y] = self.rows[y] | bit if state else self.rows[y] & ~bit
+            self.dirty[y] = 1
+
+    # One row of the framebuffer as bytes, one byte per pixel holding its color: 0 or 1, or up to 3 with XO-CHIP's
+    # second plane in use. The planes' pixels are combined as one big integer, since each lands in its own bit
+    def get_row(self, y):
+        row_bytes = self.width // 8
+        pixels = b"".join([PIXEL_BYTES[b] for b in self.planes[0][y].to_bytes(row_bytes, "big")])
+        second = self.planes[1][y]
+        if second:
+            pixels = (int.from_bytes(pixels, "big") |
+                      int.from_bytes(b"".join([PIXEL_BYTES[b] for b in second.to_bytes(row_bytes, "big")]), "big") << 1
+                      ).to_bytes(self.width, "big")
+        return pixels
+
+    # The framebuffer as bytes, one byte per pixel (see get_row) in row-major order
+    def get_framebuffer(self):
+        return b"".join([self.get_row(y) for y in range(self.height)])
+
+    # A plane of the framebuffer packed 8 pixels to a byte, leftmost pixel in the high bit, rows in order
+    # This is the layout numpy.unpackbits expects, for turning it into a height x width array
+    def get_packed(self, plane=0):
+        row_bytes = self.width // 8
+        return b"".join([row.to_bytes(row_bytes, "big") for row in self.planes[plane]])
+
+    # Replace a plane with one in the get_packed layout, marking the rows that changed as dirty
+    def set_packed(self, packed, plane=0):
+        row_bytes = self.width // 8
+        rows = self.planes[plane]
+        for y in range(self.height):
+            row = int.from_bytes(packed[y * row_bytes:(y + 1) * row_bytes], "big")
+            if row != rows[y]:
+                rows[y] = row
+                self.dirty[y] = 1
+
+    # Show the changed parts of the framebuffer on the screen, if there is one
+    def present(self):
+        self.dirty[:] = bytes(self.height)
+
+    # Show the whole framebuffer, whether or not it changed
+    def draw_all(self):
+        self.dirty[:] = b"\x01" * self.height
+        self.present()
+
+    # Handle any pending host events, returning False when the user asked to quit
+    def poll(self):
+        return True
+
+    # Sleep until a key is pressed after the first since presses of the keypad, or for at most timeout seconds
+    # Returns False if the user asked to quit
+    def wait_input(self, since, timeout):
+        self.keypad.wait_press(since, timeout)
+        return True
+
+    # Release whatever the backend holds on to (windows, video drivers, ...)
+    def close(self):
+        pass
+
+
+# A display that only exists in memory: no window, no pygame
+class HeadlessDisplay(DisplayBackend):
+
+    headless = True
+
+    def __init__(self, width=NATIVE_WIDTH, height=NATIVE_HEIGHT):
+        super().__init__(width, height)
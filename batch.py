@@ -0,0 +1,317 @@
+import numpy as np
+
+from core import *
+
+
+OPS = list(Op)
+
+# Op index (position in OPS) for every 16-bit opcode, built from Operator.lookup the first time it's needed
+_op_table = None
+
+
+def op_table():
+    global _op_table
+    if _op_table is None:
+        index = {op: i for i, op in enumerate(OPS)}
+        _op_table = np.array([index[Operator.lookup(opcode)] for opcode in range(0x10000)], dtype=np.uint8)
+    return _op_table
+
+
+# Many CHIP-8 machines running the same ROM in lockstep, with all of their state held in NumPy arrays
+# Every cycle fetches one opcode per machine, then applies each operation once, as a masked array operation over
+# the machines currently executing it. The operations follow the CPU handlers in main.py. A machine stops when it hits
+# an invalid opcode, overflows or underflows its stack, or does something that would raise in the interpreter
+# (reading or writing past the end of memory). Each machine has its own keypad; one waiting in LDKP pauses until a key
+# is pressed on it
+class BatchCHIP8:
+
+    def __init__(self, count, stack_size=16, width=NATIVE_WIDTH, height=NATIVE_HEIGHT, seed=None):
+        self.count = count
+        self.width = width
+        self.height = height
+
+        self.mem = np.zeros((count, MEM_SIZE), dtype=np.uint8)
+        self.mem[:, FONT_START:FONT_START + len(FONT)] = np.frombuffer(FONT, dtype=np.uint8)
+        self.mem[:, HIRES_FONT_START:HIRES_FONT_START + len(HIRES_FONT)] = np.frombuffer(HIRES_FONT, dtype=np.uint8)
+        self.v = np.zeros((count, CPU.NUM_VREGS), dtype=np.uint8)
+        self.i = np.zeros(count, dtype=np.int64)
+        self.pc = np.full(count, PGM_MEM_START, dtype=np.int64)
+        self.sp = np.zeros(count, dtype=np.int64)
+        self.stack = np.zeros((count, stack_size), dtype=np.int64)
+        self.dt = np.zeros(count, dtype=np.int64)
+        self.st = np.zeros(count, dtype=np.int64)
+        self.fb = np.zeros((count, height, width), dtype=np.uint8)
+        self.running = np.ones(count, dtype=bool)
+        self.keys = np.zeros(count, dtype=np.uint16)        # pressed-key mask of each machine, like Keypad.pressed
+        self.waiting = np.full(count, -1, dtype=np.int8)    # register each machine's LDKP will load, -1 if none
+
+        self.rng = np.random.default_rng(seed)
+        self.cycles = 0
+        self.table = op_table()
+
+    # Load the same ROM into every machine, from a path or from bytes
+    def load_rom(self, rom):
+        if isinstance(rom, str):
+            with open(rom, "rb") as rom_file:
+                rom = rom_file.read()
+
+        self.mem[:, PGM_MEM_START:PGM_MEM_START + len(rom)] = np.frombuffer(rom, dtype=np.uint8)
+
+    # Run every machine for n_cycles instructions, ticking the timers every CHIP8.CYCLES_PER_TICK instructions like
+    # CHIP8.run does. Returns the number of machines still running
+    def step(self, n_cycles=1):
+        for _ in range(n_cycles):
+            if not self.running.any():
+                break
+
+            self.cycle()
+            self.cycles += 1
+            if self.cycles % CHIP8.CYCLES_PER_TICK == 0:
+                self.tick60()
+
+        return int(self.running.sum())
+
+    # Press a key on the given machines (all of them by default), completing any LDKP they are waiting in
+    def press(self, key, machines=slice(None)):
+        self.keys[machines] |= 1 << key
+        waiting = np.zeros(self.count, dtype=bool)
+        waiting[machines] = self.waiting[machines] >= 0
+        waiting = np.nonzero(waiting)[0]
+        self.v[waiting, self.waiting[waiting]] = key
+        self.waiting[waiting] = -1
+
+    def release(self, key, machines=slice(None)):
+        self.keys[machines] &= ~np.uint16(1 << key)
+
+    # The framebuffers of every machine as a (count, height, width) array of 0/1 pixels
+    def framebuffers(self):
+        return self.fb
+
+    def tick60(self):
+        running = self.running
+        self.st[running & (self.st > 0)] -= 1
+        self.dt[running & (self.dt > 0)] -= 1
+
+    def cycle(self):
+        running = self.running
+
+        # Machines without a whole opcode left in memory stop, as CPU.cycle would raise on them
+        running &= self.pc + 1 < MEM_SIZE
+        # Machines waiting for a key sit out until press; their timers keep ticking
+        active = np.nonzero(running & (self.waiting < 0))[0]
+        pc = self.pc[active]
+
+        opcode = (self.mem[active, pc].astype(np.int64) << 8) | self.mem[active, pc + 1]
+        ops = self.table[opcode]
+        self.next_pc = pc + 2
+
+        # Apply each operation that at least one machine is executing
+        for op_index in np.nonzero(np.bincount(ops, minlength=len(OPS)))[0]:
+            mask = ops == op_index
+            BatchCHIP8.HANDLERS[OPS[op_index]](self, active[mask], opcode[mask], self.next_pc[mask], mask)
+
+        self.pc[active] = np.where(running[active], self.next_pc, pc)
+
+    # Each handler gets the machines executing its operation (sel), their opcodes, their default next program
+    # counter and the mask of sel within the active machines, for writing back a different next program counter
+
+    def op_none(self, sel, opcode, next_pc, mask):
+        self.running[sel] = False
+
+    def op_nop(self, sel, opcode, next_pc, mask):
+        pass
+
+    def op_jp(self, sel, opcode, next_pc, mask):
+        self.next_pc[mask] = opcode & 0x0FFF
+
+    def op_cls(self, sel, opcode, next_pc, mask):
+        self.fb[sel] = 0
+
+    def op_ret(self, sel, opcode, next_pc, mask):
+        # Stack underflow stops the machine
+        sel, opcode, mask = self.keep(sel, opcode, mask, self.sp[sel] > 0)
+        self.sp[sel] -= 1
+        self.next_pc[mask] = self.stack[sel, self.sp[sel]]
+
+    def op_call(self, sel, opcode, next_pc, mask):
+        # Stack overflow stops the machine
+        sel, opcode, mask = self.keep(sel, opcode, mask, self.sp[sel] < self.stack.shape[1])
+        self.stack[sel, self.sp[sel]] = self.pc[sel] + 2
+        self.sp[sel] += 1
+        self.next_pc[mask] = opcode & 0x0FFF
+
+    def op_se(self, sel, opcode, next_pc, mask):
+        self.skip_if(sel, mask, next_pc, self.v[sel, (opcode >> 8) & 0xF] == (opcode & 0xFF))
+
+    def op_sne(self, sel, opcode, next_pc, mask):
+        self.skip_if(sel, mask, next_pc, self.v[sel, (opcode >> 8) & 0xF] != (opcode & 0xFF))
+
+    def op_ser(self, sel, opcode, next_pc, mask):
+        self.skip_if(sel, mask, next_pc, self.v[sel, (opcode >> 8) & 0xF] == self.v[sel, (opcode >> 4) & 0xF])
+
+    def op_sner(self, sel, opcode, next_pc, mask):
+        self.skip_if(sel, mask, next_pc, self.v[sel, (opcode >> 8) & 0xF] != self.v[sel, (opcode >> 4) & 0xF])
+
+    def op_ld(self, sel, opcode, next_pc, mask):
+        self.v[sel, (opcode >> 8) & 0xF] = opcode & 0xFF
+
+    def op_add(self, sel, opcode, next_pc, mask):
+        x = (opcode >> 8) & 0xF
+        self.v[sel, x] = (self.v[sel, x] + (opcode & 0xFF)) & 0xFF
+
+    def op_ldr(self, sel, opcode, next_pc, mask):
+        self.v[sel, (opcode >> 8) & 0xF] = self.v[sel, (opcode >> 4) & 0xF]
+
+    def op_or(self, sel, opcode, next_pc, mask):
+        x, y = (opcode >> 8) & 0xF, (opcode >> 4) & 0xF
+        self.v[sel, x] = self.v[sel, x] | self.v[sel, y]
+
+    def op_and(self, sel, opcode, next_pc, mask):
+        x, y = (opcode >> 8) & 0xF, (opcode >> 4) & 0xF
+        self.v[sel, x] = self.v[sel, x] & self.v[sel, y]
+
+    def op_xor(self, sel, opcode, next_pc, mask):
+        x, y = (opcode >> 8) & 0xF, (opcode >> 4) & 0xF
+        self.v[sel, x] = self.v[sel, x] ^ self.v[sel, y]
+
+    def op_addr(self, sel, opcode, next_pc, mask):
+        x, y = (opcode >> 8) & 0xF, (opcode >> 4) & 0xF
+        total = self.v[sel, x].astype(np.int64) + self.v[sel, y]
+        self.v[sel, x] = total & 0xFF
+        self.v[sel, CPU.O] = total > CPU.BYTE_MAX_VALUE
+
+    def op_sub(self, sel, opcode, next_pc, mask):
+        x, y = (opcode >> 8) & 0xF, (opcode >> 4) & 0xF
+        vx, vy = self.v[sel, x], self.v[sel, y]
+        self.v[sel, x] = (vx.astype(np.int64) - vy) & 0xFF
+        self.v[sel, CPU.O] = vx > vy
+
+    def op_shr(self, sel, opcode, next_pc, mask):
+        x = (opcode >> 8) & 0xF
+        vx = self.v[sel, x]
+        self.v[sel, x] = vx >> 1
+        self.v[sel, CPU.O] = vx & 0x1
+
+    def op_subn(self, sel, opcode, next_pc, mask):
+        x, y = (opcode >> 8) & 0xF, (opcode >> 4) & 0xF
+        vx, vy = self.v[sel, x], self.v[sel, y]
+        self.v[sel, x] = (vy.astype(np.int64) - vx) & 0xFF
+        self.v[sel, CPU.O] = vy > vx
+
+    def op_shl(self, sel, opcode, next_pc, mask):
+        x = (opcode >> 8) & 0xF
+        vx = self.v[sel, x]
+        self.v[sel, x] = (vx.astype(np.int64) << 1) & 0xFF
+        self.v[sel, CPU.O] = vx >> 7
+
+    def op_ldi(self, sel, opcode, next_pc, mask):
+        self.i[sel] = opcode & 0x0FFF
+
+    def op_jpo(self, sel, opcode, next_pc, mask):
+        self.next_pc[mask] = (opcode & 0x0FFF) + self.v[sel, 0]
+
+    def op_rnd(self, sel, opcode, next_pc, mask):
+        self.v[sel, (opcode >> 8) & 0xF] = self.rng.integers(0, CPU.BYTE_MAX_VALUE + 1, len(sel)) & opcode & 0xFF
+
+    def op_drw(self, sel, opcode, next_pc, mask):
+        # Follows DisplayBackend.draw_sprite: all 8 columns of each row, starting at (Vx, Vy) and wrapping around
+        # SUPER-CHIP's 16x16 sprites (DXY0) aren't drawn here, so those machines stop
+        sel, opcode, mask = self.keep(sel, opcode, mask, opcode & 0xF != 0)
+        x, y, n = (opcode >> 8) & 0xF, (opcode >> 4) & 0xF, opcode & 0xF
+
+        rows = np.arange(16)
+        cols = np.arange(8)
+        addrs = self.i[sel][:, None] + rows
+        # Rows past the end of memory are left out, like the slice CPU.op_drw reads
+        sprite = np.where((rows < n[:, None]) & (addrs < MEM_SIZE), self.mem[sel[:, None], addrs % MEM_SIZE], 0)
+        bits = ((sprite[:, :, None] >> (7 - cols)) & 0x1).astype(np.uint8)
+
+        py = ((self.v[sel, y][:, None].astype(np.int64) + rows) % self.height)[:, :, None]
+        px = ((self.v[sel, x][:, None].astype(np.int64) + cols) % self.width)[:, None, :]
+        machines = sel[:, None, None]
+
+        old = self.fb[machines, py, px]
+        self.v[sel, CPU.O] = (old & bits).any(axis=(1, 2))
+        self.fb[machines, py, px] = old ^ bits
+
+    def op_skp(self, sel, opcode, next_pc, mask):
+        key = self.v[sel, (opcode >> 8) & 0xF] & 0xF
+        self.skip_if(sel, mask, next_pc, (self.keys[sel] >> key) & 0x1 == 1)
+
+    def op_sknp(self, sel, opcode, next_pc, mask):
+        key = self.v[sel, (opcode >> 8) & 0xF] & 0xF
+        self.skip_if(sel, mask, next_pc, (self.keys[sel] >> key) & 0x1 == 0)
+
+    def op_ldkp(self, sel, opcode, next_pc, mask):
+        self.waiting[sel] = (opcode >> 8) & 0xF
+
+    def op_lddt(self, sel, opcode, next_pc, mask):
+        self.v[sel, (opcode >> 8) & 0xF] = self.dt[sel]
+
+    def op_lddtr(self, sel, opcode, next_pc, mask):
+        self.dt[sel] = self.v[sel, (opcode >> 8) & 0xF]
+
+    def op_ldst(self, sel, opcode, next_pc, mask):
+        self.st[sel] = self.v[sel, (opcode >> 8) & 0xF]
+
+    def op_addi(self, sel, opcode, next_pc, mask):
+        self.i[sel] = (self.i[sel] + self.v[sel, (opcode >> 8) & 0xF]) & 0xFFFF
+
+    def op_lds(self, sel, opcode, next_pc, mask):
+        self.i[sel] = FONT_START + 5 * (self.v[sel, (opcode >> 8) & 0xF] & 0xF)
+
+    def op_ldbcd(self, sel, opcode, next_pc, mask):
+        sel, opcode, mask = self.check_memory(sel, opcode, mask, self.i[sel] + 3)
+        value = self.v[sel, (opcode >> 8) & 0xF]
+        i = self.i[sel]
+        self.mem[sel, i] = value // 100
+        self.mem[sel, i + 1] = (value // 10) % 10
+        self.mem[sel, i + 2] = value % 10
+
+    def op_ldir(self, sel, opcode, next_pc, mask):
+        sel, opcode, mask = self.check_memory(sel, opcode, mask, self.i[sel] + ((opcode >> 8) & 0xF) + 1)
+        x = (opcode >> 8) & 0xF
+        for r in range(CPU.NUM_VREGS):
+            rows = sel[x >= r]
+            self.mem[rows, self.i[rows] + r] = self.v[rows, r]
+
+    def op_ldri(self, sel, opcode, next_pc, mask):
+        sel, opcode, mask = self.check_memory(sel, opcode, mask, self.i[sel] + ((opcode >> 8) & 0xF) + 1)
+        x = (opcode >> 8) & 0xF
+        for r in range(CPU.NUM_VREGS):
+            rows = sel[x >= r]
+            self.v[rows, r] = self.mem[rows, self.i[rows] + r]
+
+    def skip_if(self, sel, mask, next_pc, condition):
+        # Skipping an F000 NNNN skips all four of its bytes, like CPU.skip
+        at = np.minimum(next_pc, MEM_SIZE - 2)
+        long = (self.mem[sel, at] == 0xF0) & (self.mem[sel, at + 1] == 0x00) & (next_pc + 1 < MEM_SIZE)
+        self.next_pc[mask] = next_pc + np.where(condition, np.where(long, 4, 2), 0)
+
+    # Stop the machines that would touch memory at or past end and return the rest
+    def check_memory(self, sel, opcode, mask, end):
+        return self.keep(sel, opcode, mask, end <= MEM_SIZE)
+
+    def keep(self, sel, opcode, mask, ok):
+        if ok.all():
+            return sel, opcode, mask
+
+        self.running[sel[~ok]] = False
+        positions = np.nonzero(mask)[0]
+        mask = mask.copy()
+        mask[positions[~ok]] = False
+        return sel[ok], opcode[ok], mask
+
+    HANDLERS = {
+        Op.NONE: op_none, Op.NOP: op_nop, Op.SYS: op_jp, Op.CLS: op_cls, Op.RET: op_ret, Op.JP: op_jp,
+        Op.CALL: op_call, Op.SE: op_se, Op.SNE: op_sne, Op.SER: op_ser, Op.LD: op_ld, Op.ADD: op_add,
+        Op.LDR: op_ldr, Op.OR: op_or, Op.AND: op_and, Op.XOR: op_xor, Op.ADDR: op_addr, Op.SUB: op_sub,
+        Op.SHR: op_shr, Op.SUBN: op_subn, Op.SHL: op_shl, Op.SNER: op_sner, Op.LDI: op_ldi, Op.JPO: op_jpo,
+        Op.RND: op_rnd, Op.DRW: op_drw, Op.SKP: op_skp, Op.SKNP: op_sknp, Op.LDDT: op_lddt, Op.LDKP: op_ldkp,
+        Op.LDDTR: op_lddtr, Op.LDST: op_ldst, Op.ADDI: op_addi, Op.LDS: op_lds, Op.LDBCD: op_ldbcd,
+        Op.LDIR: op_ldir, Op.LDRI: op_ldri,
+        # Batches run plain CHIP-8: the SUPER-CHIP and XO-CHIP operations stop the machine like an invalid opcode
+        Op.SCD: op_none, Op.SCR: op_none, Op.SCL: op_none, Op.EXIT: op_none, Op.LOW: op_none, Op.HIGH: op_none,
+        Op.LDHF: op_none, Op.STRF: op_none, Op.LDRF: op_none, Op.SCU: op_none, Op.SAVE: op_none, Op.LOAD: op_none,
+        Op.LDIL: op_none, Op.PLANE: op_none, Op.AUDIO: op_none, Op.PITCH: op_none,
+    }
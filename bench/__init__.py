@@ -0,0 +1,239 @@
+import gc
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from core import *
+from bench.roms import ROMS
+
+
+REPORT_VERSION = 1
+WARMUP = 1000   # instructions run before timing, so decoding and block compilation aren't measured
+
+# The sprite the renderer benchmarks draw
+SPRITE = bytes([0xFF, 0x81, 0xBD, 0xA5, 0xA5, 0xBD, 0x81, 0xFF])
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Commands timed in a fresh interpreter for the startup benchmarks, with the most each may add to a bare
+# interpreter's startup, in seconds. "{rom}" is replaced with the path of a benchmark ROM
+STARTUP = {
+    "startup/core": (["-c", "import core"], 0.020),
+    "startup/cli": (["cli.py", "headless", "{rom}", "--cycles", "1000"], 0.050),
+}
+
+
+# Best wall-clock time of repeat calls to run(), with the garbage collector off like timeit does
+# setup() is called before every run and its result passed in, so each run starts from the same state
+def measure(setup, run, repeat):
+    best = None
+    for _ in range(repeat):
+        state = setup()
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            run(state)
+            elapsed = time.perf_counter() - start
+        finally:
+            if gc_enabled:
+                gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def result(kind, count, seconds, per_frame=None):
+    entry = {"class": kind, "count": count, "seconds": seconds, "ns_per_op": seconds * 1e9 / count,
+             "ops_per_sec": count / seconds}
+    if per_frame is not None:
+        entry["fps"] = count / per_frame / seconds
+    return entry
+
+
+# Run a benchmark ROM headless through CHIP8.run, on the interpreter or the block engine
+def bench_rom(name, rom, instructions, repeat, compiled=False):
+    def setup():
+        chip8 = CHIP8(debug_mode=False, compiled=compiled, headless=True)
+        chip8.mem.load(PGM_MEM_START, rom)
+        chip8.run(WARMUP)
+        return chip8
+
+    def run(chip8):
+        if chip8.run(instructions) != instructions:
+            raise RuntimeError(f"benchmark ROM {name} halted")
+
+    seconds = measure(setup, run, repeat)
+    return result(name, instructions, seconds, CHIP8.CYCLES_PER_TICK)
+
+
+# DisplayBackend.draw_sprite on its own, walking across the screen and wrapping like the draw ROM does
+def bench_draw_sprite(display, count, repeat):
+    def run(display):
+        draw = display.draw_sprite
+        x = y = 0
+        for _ in range(count):
+            draw(x, y, SPRITE)
+            x += 3
+            y += 1
+
+    return result("draw_sprite", count, measure(lambda: display, run, repeat))
+
+
+# Full redraws of the window (every row dirty), the worst case for a frame
+def bench_draw_all(display, frames, repeat):
+    def run(display):
+        for _ in range(frames):
+            display.draw_all()
+
+    return result("draw_all", frames, measure(lambda: display, run, repeat), 1)
+
+
+# A typical frame: a few sprites drawn, then only the rows they touched presented
+# With a post-processing stage on the display, the whole frame goes through it instead
+def bench_present(display, frames, repeat, name="present"):
+    def run(display):
+        draw = display.draw_sprite
+        present = display.present
+        for frame in range(frames):
+            draw(frame % display.width, frame % display.height, SPRITE)
+            draw((frame * 7) % display.width, (frame * 3) % display.height, SPRITE)
+            present()
+
+    return result(name, frames, measure(lambda: display, run, repeat), 1)
+
+
+# Time to start a fresh interpreter and run args in it
+def spawn_time(args, repeat):
+    def run(state):
+        subprocess.run([sys.executable] + args, cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+
+    return measure(lambda: None, run, repeat)
+
+
+# How much each STARTUP command adds to the startup of a bare interpreter
+def bench_startup(names, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as rom_dir:
+        rom_path = os.path.join(rom_dir, "alu.ch8")
+        with open(rom_path, "wb") as rom_file:
+            rom_file.write(ROMS["alu"])
+
+        bare = spawn_time(["-c", "pass"], repeat)
+        for name in names:
+            args, target = STARTUP[name]
+            seconds = spawn_time([rom_path if arg == "{rom}" else arg for arg in args], repeat) - bare
+            results[name] = dict(result(name, 1, seconds), target=target)
+
+    return results
+
+
+# The pygame window, or None (with the reason) if there isn't one to be had
+# Without window=True the dummy video driver is used, so the numbers don't depend on the desktop
+def open_display(window=False):
+    if not window:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    try:
+        import pygame
+        from display import Display
+        pygame.init()
+        return Display(NATIVE_WIDTH, NATIVE_HEIGHT), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+# Run every benchmark whose name starts with one of only (or all of them), returning the report
+def run_benchmarks(instructions=200000, frames=2000, repeat=5, only=None, window=False):
+    def selected(name):
+        return not only or any(name.startswith(prefix) for prefix in only)
+
+    results = {}
+    skipped = {}
+
+    for engine, compiled in (("interpreter", False), ("compiled", True)):
+        for name, rom in ROMS.items():
+            key = f"{engine}/{name}"
+            if selected(key):
+                results[key] = bench_rom(name, rom, instructions, repeat, compiled)
+
+    if selected("render/draw_sprite"):
+        results["render/draw_sprite"] = bench_draw_sprite(HeadlessDisplay(), instructions // 10, repeat)
+
+    window_benchmarks = [name for name in ("render/draw_all", "render/present", "render/phosphor", "render/blend")
+                         if selected(name)]
+    if window_benchmarks:
+        display, reason = open_display(window)
+        if display is None:
+            skipped.update((name, reason) for name in window_benchmarks)
+        else:
+            if selected("render/draw_all"):
+                results["render/draw_all"] = bench_draw_all(display, frames, repeat)
+            if selected("render/present"):
+                results["render/present"] = bench_present(display, frames, repeat)
+            if selected("render/phosphor") or selected("render/blend"):
+                from phosphor import Phosphor, FrameBlend
+                for name, post in (("phosphor", Phosphor()), ("blend", FrameBlend())):
+                    if selected(f"render/{name}"):
+                        display.set_post(post)
+                        results[f"render/{name}"] = bench_present(display, frames, repeat, name)
+                display.set_post(None)
+            display.close()
+
+    results.update(bench_startup([name for name in STARTUP if selected(name)], repeat))
+
+    return {
+        "version": REPORT_VERSION,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "instructions": instructions,
+        "frames": frames,
+        "repeat": repeat,
+        "results": results,
+        "skipped": skipped,
+    }
+
+
+# Compare a report against a baseline report, returning (regressions, lines)
+# A benchmark regresses if its time per operation grew by more than threshold (0.1 is 10% slower). Benchmarks the
+# baseline has but this run skipped (see --only) are left out
+def compare(report, baseline, threshold=0.1):
+    regressions = []
+    lines = []
+    for name in sorted(report["results"]):
+        new, old = report["results"][name], baseline["results"].get(name)
+        if old is None:
+            lines.append(f"{name:<24} not in the baseline")
+            continue
+
+        change = new["ns_per_op"] / old["ns_per_op"] - 1
+        line = f"{name:<24} {old['ns_per_op']:>10.1f} -> {new['ns_per_op']:>10.1f} ns/op {change:>+8.1%}"
+        if change > threshold:
+            regressions.append(name)
+            line += "  REGRESSION"
+        elif new["seconds"] > new.get("target", new["seconds"]):
+            regressions.append(name)
+            line += "  OVER TARGET"
+        lines.append(line)
+
+    return regressions, lines
+
+
+def format_report(report):
+    lines = [f"Python {report['python']} ({report['implementation']}, {report['machine']}), "
+             f"best of {report['repeat']}"]
+    for name, r in report["results"].items():
+        line = f"{name:<24} {r['ns_per_op']:>10.1f} ns/op {r['ops_per_sec']:>14,.0f} ops/s"
+        if "fps" in r:
+            line += f" {r['fps']:>12,.0f} fps"
+        if "target" in r:
+            line += f"  {r['seconds'] * 1000:.1f} ms, target {r['target'] * 1000:.0f} ms"
+            if r["seconds"] > r["target"]:
+                line += "  OVER TARGET"
+        lines.append(line)
+    for name, reason in report["skipped"].items():
+        lines.append(f"{name:<24} skipped ({reason})")
+    return lines
@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+import sys
+
+from bench import *
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark the CHIP-8 interpreter and renderer")
+    parser.add_argument("--instructions", type=int, default=200000, help="instructions to time for each ROM")
+    parser.add_argument("--frames", type=int, default=2000, help="frames to time for each renderer benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each benchmark; the best one counts")
+    parser.add_argument("--only", nargs="+", metavar="PREFIX",
+                        help="only run benchmarks whose names start with these, e.g. interpreter/ render/draw_all")
+    parser.add_argument("--window", action="store_true", help="render to a real window instead of SDL's dummy driver")
+    parser.add_argument("--report", help="write the results here as JSON")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown in ns/op that counts as a regression (default 0.1 = 10%%)")
+    parser.add_argument("--dump-roms", metavar="DIR", help="write the benchmark ROMs to DIR and exit")
+    args = parser.parse_args(argv)
+
+    if args.dump_roms:
+        os.makedirs(args.dump_roms, exist_ok=True)
+        for name, rom in ROMS.items():
+            with open(os.path.join(args.dump_roms, f"{name}.ch8"), "wb") as rom_file:
+                rom_file.write(rom)
+        return 0
+
+    report = run_benchmarks(args.instructions, args.frames, args.repeat, args.only, args.window)
+    for line in format_report(report):
+        print(line)
+
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions, lines = compare(report, json.load(baseline_file), args.threshold)
+        print(f"\nCompared with {args.baseline}:")
+        for line in lines:
+            print(line)
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
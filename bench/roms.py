@@ -0,0 +1,84 @@
+# Synthetic microbenchmark ROMs
+# Each one is a tight loop that hammers one class of instructions, so the time per instruction it measures is close
+# to the cost of that class. They loop forever; the benchmark decides how many instructions to run
+
+
+# Turn a list of 16-bit opcodes (and raw data words) into ROM bytes
+def assemble(*words):
+    return b"".join(word.to_bytes(2, "big") for word in words)
+
+
+# ADD, ADDR, SUB, XOR, AND, OR, SHL, SHR and SUBN on two registers
+ALU = assemble(
+    0x6001,     # 200: LD V0, 01
+    0x6103,     # 202: LD V1, 03
+    0x7005,     # 204: ADD V0, 05
+    0x8014,     # 206: ADD V0, V1
+    0x8015,     # 208: SUB V0, V1
+    0x8013,     # 20A: XOR V0, V1
+    0x8012,     # 20C: AND V0, V1
+    0x8011,     # 20E: OR V0, V1
+    0x801E,     # 210: SHL V0
+    0x8016,     # 212: SHR V0
+    0x8017,     # 214: SUBN V0, V1
+    0x1204,     # 216: JP 204
+)
+
+# Every kind of skip, each guarding an ADD, with a counter so the skips go both ways
+BRANCH = assemble(
+    0x6000,     # 200: LD V0, 00
+    0x7001,     # 202: ADD V0, 01
+    0x3000,     # 204: SE V0, 00
+    0x7201,     # 206: ADD V2, 01
+    0x4001,     # 208: SNE V0, 01
+    0x7201,     # 20A: ADD V2, 01
+    0x5010,     # 20C: SE V0, V1
+    0x7201,     # 20E: ADD V2, 01
+    0x9010,     # 210: SNE V0, V1
+    0x7201,     # 212: ADD V2, 01
+    0x1202,     # 214: JP 202
+)
+
+# Nested subroutine calls and returns
+CALL = assemble(
+    0x2204,     # 200: CALL 204
+    0x1200,     # 202: JP 200
+    0x2208,     # 204: CALL 208
+    0x00EE,     # 206: RET
+    0x00EE,     # 208: RET
+)
+
+# An 8x8 sprite drawn over and over, walking diagonally across the screen and wrapping at the edges
+DRAW = assemble(
+    0xA20E,     # 200: LD I, 20E
+    0x6000,     # 202: LD V0, 00
+    0x6100,     # 204: LD V1, 00
+    0xD018,     # 206: DRW V0, V1, 8
+    0x7003,     # 208: ADD V0, 03
+    0x7101,     # 20A: ADD V1, 01
+    0x1206,     # 20C: JP 206
+    0xFF81, 0xBDA5, 0xA5BD, 0x81FF,     # 20E: sprite
+)
+
+# Clearing the screen
+CLS = assemble(
+    0x00E0,     # 200: CLS
+    0x1200,     # 202: JP 200
+)
+
+# Storing and loading all sixteen registers
+MEMORY = assemble(
+    0xA400,     # 200: LD I, 400
+    0xFF55,     # 202: LD [I], VF
+    0xFF65,     # 204: LD VF, [I]
+    0x1202,     # 206: JP 202
+)
+
+ROMS = {
+    "alu": ALU,
+    "branch": BRANCH,
+    "call": CALL,
+    "draw": DRAW,
+    "cls": CLS,
+    "memory": MEMORY,
+}
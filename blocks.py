@@ -0,0 +1,387 @@
+import sys
+
+from core import *
+
+
+# Operations that are compiled straight into a block's function
+STRAIGHT_OPS = {
+    Op.NOP, Op.CLS, Op.LD, Op.ADD, Op.LDR, Op.OR, Op.AND, Op.XOR, Op.ADDR, Op.SUB, Op.SHR, Op.SUBN, Op.SHL,
+    Op.LDI, Op.RND, Op.LDDT, Op.LDDTR, Op.LDST, Op.ADDI, Op.LDS,
+}
+
+# Operations that end a block but are still compiled into it
+BRANCH_OPS = {Op.SYS, Op.JP, Op.SE, Op.SNE, Op.SER, Op.SNER, Op.CALL, Op.RET}
+SKIP_OPS = {Op.SE, Op.SNE, Op.SER, Op.SNER}
+# Of those, the ones whose target is known when compiling, so the block carries on there instead of ending: JP and
+# CALL to their address, and a RET to the address a CALL earlier in the same block pushed
+FOLLOWED_OPS = {Op.SYS, Op.JP, Op.CALL, Op.RET}
+
+# Operations that end a block by calling the CPU's own handler once the registers are written back
+# These are the ones that touch memory, the display, the keypad or the SUPER-CHIP/XO-CHIP state, where a handler call
+# is all there is to it anyway. It saves going back out to the interpreter for them
+# Anything else (LDKP, EXIT and invalid opcodes, which stop the program) is left to the interpreter
+HANDLER_OPS = {
+    Op.JPO, Op.DRW, Op.SKP, Op.SKNP, Op.LDBCD, Op.LDIR, Op.LDRI, Op.SCD, Op.SCR, Op.SCL, Op.LOW, Op.HIGH, Op.LDHF,
+    Op.STRF, Op.LDRF, Op.SCU, Op.SAVE, Op.LOAD, Op.LDIL, Op.PLANE, Op.AUDIO, Op.PITCH,
+}
+
+# Operations on the timers, which only ever start a block
+# The timers tick between engine steps, so the interpreter can see a tick between any two instructions where a block
+# sees none: at the start of a block the timers are exactly what the interpreter would see, anywhere else they may not be
+TIMER_OPS = {Op.LDDT, Op.LDDTR, Op.LDST}
+
+
+# A run of instructions compiled into one Python function, following jumps, calls and returns whose targets are known
+class Block:
+
+    def __init__(self, start, ranges, length, depth, last_op, function, source):
+        self.start = start          # address of the first instruction
+        self.ranges = ranges        # [start, end) of each run of bytes the block was compiled from, and depends on
+        self.length = length        # number of instructions in the block
+        self.depth = depth          # most stack entries the block's CALLs push beyond what it started with
+        self.last_op = last_op      # the Op of the last instruction, left in CPU.op after the block runs
+        # function(cpu, memory, display) -> next program counter, or None to leave the instruction at cpu.pc to the
+        # interpreter: a RET at the end that would underflow the stack (the interpreter reports it), or, before the
+        # block has done anything, CALLs that would overflow it
+        self.function = function
+        self.source = source        # generated Python source, handy for debugging
+
+
+# Turns runs of CHIP-8 instructions into Python functions
+# Registers live in locals for the length of the block and are written back to CPU.v when it exits. A JP or CALL
+# carries on compiling at its target, and a RET matching a CALL in the block at the return address, so a loop around
+# a few subroutine calls can be one block rather than one per instruction
+class BlockCompiler:
+
+    MAX_BLOCK_LENGTH = CHIP8.MAX_STEP
+
+    # stops are addresses the block must end before (besides start), so they get interpreted
+    def compile(self, memory, start, stops=()):
+        lines = []
+        regs = set()    # every V register the block touches
+        written = set() # V registers the block assigns
+        uses_i = False
+        exit_lines = None
+        addr = start
+        last_op = Op.NONE
+        length = 0
+        seen = set()    # bytes compiled so far; running into them again ends the block
+        returns = []    # return addresses pushed by the block's CALLs, for the RETs that match them
+        depth = 0
+        uses_stack = False
+
+        while length < BlockCompiler.MAX_BLOCK_LENGTH and addr + 1 < len(memory.mem):
+            if addr in seen or addr + 1 in seen:
+                break
+            handler, op, opcode, x, y, kk, n, nnn = CPU.predecode(memory.read16(addr))
+            if op not in STRAIGHT_OPS and op not in BRANCH_OPS and op not in HANDLER_OPS:
+                break
+            if op in SKIP_OPS and memory.mem[addr + 2:addr + 4] == b"\xf0\x00":
+                break   # skipping a four byte instruction is left to the interpreter
+            if addr != start and (op in TIMER_OPS or addr in stops):
+                break
+
+            vx, vy = f"v{x:x}", f"v{y:x}"
+            seen.update((addr, addr + 1))
+            length += 1
+            last_op = op
+
+            if op is Op.SYS or op is Op.JP:
+                addr = nnn
+                continue
+            elif op is Op.CALL:
+                lines.extend([f"stack[sp] = {addr + 2:#05x}", "sp += 1"])
+                returns.append(addr + 2)
+                depth = max(depth, len(returns))
+                uses_stack = True
+                addr = nnn
+                continue
+            elif op is Op.RET and returns:
+                lines.append("sp -= 1")
+                addr = returns.pop()
+                continue
+            elif op is Op.RET:
+                uses_stack = True
+                exit_lines = ["if sp == 0:", f"    cpu.pc = {addr:#05x}", "    return None",
+                              "cpu.sp = sp - 1", "return stack[sp - 1]"]
+            elif op is Op.SE:
+                regs.add(x)
+                exit_lines = [f"return {addr + 4:#05x} if {vx} == {kk:#04x} else {addr + 2:#05x}"]
+            elif op is Op.SNE:
+                regs.add(x)
+                exit_lines = [f"return {addr + 4:#05x} if {vx} != {kk:#04x} else {addr + 2:#05x}"]
+            elif op is Op.SER:
+                regs.update((x, y))
+                exit_lines = [f"return {addr + 4:#05x} if {vx} == {vy} else {addr + 2:#05x}"]
+            elif op is Op.SNER:
+                regs.update((x, y))
+                exit_lines = [f"return {addr + 4:#05x} if {vx} != {vy} else {addr + 2:#05x}"]
+            elif op in HANDLER_OPS:
+                exit_lines = [f"cpu.pc = {addr:#05x}",
+                              f"return cpu.{handler.__name__}(memory, display, {x}, {y}, {kk}, {n}, {nnn})"]
+            else:
+                body, reads, writes, touches_i = BlockCompiler.translate(op, x, y, kk, nnn)
+                lines.extend(body)
+                regs.update(reads)
+                regs.update(writes)
+                written.update(writes)
+                uses_i = uses_i or touches_i
+                addr += 2
+                continue
+
+            # A skip also depends on the next instruction not being F000 NNNN
+            if op in SKIP_OPS:
+                seen.update((addr + 2, addr + 3))
+            break
+
+        if length == 0:
+            # The very first instruction has to go through the interpreter
+            return None
+
+        if exit_lines is None:
+            # Ran out of instructions to compile, so carry on with the next one
+            exit_lines = [f"return {addr:#05x}"]
+
+        source = BlockCompiler.generate(start, lines, regs, written, uses_i, uses_stack, depth, exit_lines)
+        namespace = {}
+        exec(compile(source, f"<block {start:#05x}>", "exec"), namespace)
+
+        return Block(start, BlockCompiler.runs(seen), length, depth, last_op, namespace[f"block_{start:03x}"], source)
+
+    # A set of addresses as the [start, end) of each run of consecutive ones, in order
+    @staticmethod
+    def runs(addresses):
+        ranges = []
+        for addr in sorted(addresses):
+            if ranges and ranges[-1][1] == addr:
+                ranges[-1][1] = addr + 1
+            else:
+                ranges.append([addr, addr + 1])
+        return [tuple(r) for r in ranges]
+
+    # Python statements for one straight-line operation, plus the registers it reads and writes and whether it uses I
+    # These must do exactly what the matching CPU handlers do
+    @staticmethod
+    def translate(op, x, y, kk, nnn):
+        vx, vy = f"v{x:x}", f"v{y:x}"
+
+        if op is Op.NOP:
+            return [], (), (), False
+        elif op is Op.CLS:
+            return ["display.clear()"], (), (), False
+        elif op is Op.LD:
+            return [f"{vx} = {kk:#04x}"], (), (x,), False
+        elif op is Op.ADD:
+            return [f"{vx} = ({vx} + {kk:#04x}) & 0xff"], (x,), (x,), False
+        elif op is Op.LDR:
+            return [f"{vx} = {vy}"], (y,), (x,), False
+        elif op is Op.OR:
+            return [f"{vx} = {vx} | {vy}"], (x, y), (x,), False
+        elif op is Op.AND:
+            return [f"{vx} = {vx} & {vy}"], (x, y), (x,), False
+        elif op is Op.XOR:
+            return [f"{vx} = {vx} ^ {vy}"], (x, y), (x,), False
+        elif op is Op.ADDR:
+            # Tuple assignments evaluate both sides first and assign VF last, like the handlers
+            return [f"{vx}, vf = ({vx} + {vy}) & 0xff, ({vx} + {vy}) >> 8"], (x, y), (x, CPU.O), False
+        elif op is Op.SUB:
+            return [f"{vx}, vf = ({vx} - {vy}) & 0xff, 1 if {vx} > {vy} else 0"], (x, y), (x, CPU.O), False
+        elif op is Op.SHR:
+            return [f"{vx}, vf = {vx} >> 1, {vx} & 0x1"], (x,), (x, CPU.O), False
+        elif op is Op.SUBN:
+            return [f"{vx}, vf = ({vy} - {vx}) & 0xff, 1 if {vy} > {vx} else 0"], (x, y), (x, CPU.O), False
+        elif op is Op.SHL:
+            return [f"{vx}, vf = ({vx} << 1) & 0xff, {vx} >> 7"], (x,), (x, CPU.O), False
+        elif op is Op.LDI:
+            return [f"i = {nnn:#05x}"], (), (), True
+        elif op is Op.RND:
+            return [f"{vx} = cpu.rng.getrandbits(8) & {kk:#04x}"], (), (x,), False
+        elif op is Op.LDDT:
+            return [f"{vx} = cpu.dt"], (), (x,), False
+        elif op is Op.LDDTR:
+            return [f"cpu.dt = {vx}"], (x,), (), False
+        elif op is Op.LDST:
+            return [f"cpu.st = {vx}"], (x,), (), False
+        elif op is Op.ADDI:
+            return [f"i = (i + {vx}) & 0xffff"], (x,), (), True
+        elif op is Op.LDS:
+            return [f"i = {FONT_START:#05x} + 5 * ({vx} & 0xf)"], (x,), (), True
+
+        raise ValueError(f"{op} cannot be compiled into a block")
+
+    @staticmethod
+    def generate(start, lines, regs, written, uses_i, uses_stack, depth, exit_lines):
+        src = [f"def block_{start:03x}(cpu, memory, display):"]
+        if depth:
+            # Checked up front, so a CALL never has to stop the block part way; the interpreter reports the overflow
+            src.extend([f"    if cpu.sp > len(cpu.stack) - {depth}:", "        return None"])
+        if uses_stack:
+            src.extend(["    stack = cpu.stack", "    sp = cpu.sp"])
+        if regs:
+            src.append("    v = cpu.v")
+            src.extend(f"    v{r:x} = v[{r}]" for r in sorted(regs))
+        if uses_i:
+            src.append("    i = cpu.i")
+
+        src.extend(f"    {line}" for line in lines)
+
+        src.extend(f"    v[{r}] = v{r:x}" for r in sorted(written))
+        if uses_i:
+            src.append("    cpu.i = i")
+        if depth:
+            src.append("    cpu.sp = sp")
+        src.extend(f"    {line}" for line in exit_lines)
+
+        return "\n".join(src) + "\n"
+
+
+# Optional execution engine that runs compiled blocks instead of single instructions
+# Blocks are cached by start address and dropped when a memory write lands inside them
+class BlockEngine:
+
+    def __init__(self, cpu, memory):
+        self.cpu = cpu
+        self.compiler = BlockCompiler()
+        # Compiled block for each start address, or False if that address has to be interpreted
+        self.blocks = {}
+        # How many cached blocks cover each byte of memory, so a write outside every block is one check
+        self.covered = bytearray(len(memory.mem))
+        # Start addresses of the cached blocks covering each covered byte
+        self.covering = {}
+        # Addresses that always go through the interpreter, so a debugger's breakpoints there are seen
+        self.stops = set()
+
+        memory.invalidators.append(self.invalidate)
+
+    # Run one block (or one interpreted instruction), returning how many instructions ran or False to stop
+    def cycle(self, memory, display):
+        cpu = self.cpu
+        block = self.blocks.get(cpu.pc)
+        if block is None:
+            block = self.load(memory, cpu.pc)
+
+        if block is False:
+            return cpu.cycle(memory, display)
+
+        pc = block.function(cpu, memory, display)
+        if pc is None:
+            # The block left the instruction at cpu.pc to the interpreter: the RET at its end, having run everything
+            # before it, or its first instruction, with CALLs ahead that would overflow the stack
+            return cpu.cycle(memory, display)
+
+        cpu.pc = pc
+        cpu.op = block.last_op
+        return block.length
+
+    def load(self, memory, start):
+        if start + 1 >= len(memory.mem):
+            # Let the interpreter report running off the end of memory
+            return False
+
+        block = self.compiler.compile(memory, start, self.stops) if start not in self.stops else None
+        if block is None:
+            block = False
+
+        self.blocks[start] = block
+        covered = self.covered
+        covering = self.covering
+        for range_start, range_end in BlockEngine.ranges(block, start):
+            for addr in range(range_start, min(range_end, len(covered))):
+                covered[addr] += 1
+                if addr in covering:
+                    covering[addr].append(start)
+                else:
+                    covering[addr] = [start]
+
+        return block
+
+    # The bytes a cached block (or interpreted address) depends on
+    @staticmethod
+    def ranges(block, start):
+        return block.ranges if block is not False else ((start, start + 2),)
+
+    # Memory invalidator: forget every block that covers a byte in [start, end)
+    def invalidate(self, start, end):
+        covered = self.covered
+        if covered.count(0, start, end) == end - start:
+            return  # the usual case: data, not code
+
+        covering = self.covering
+        for addr in range(start, min(end, len(covered))):
+            if covered[addr]:
+                for block_start in covering[addr][:]:
+                    block = self.blocks.pop(block_start)
+                    for range_start, range_end in BlockEngine.ranges(block, block_start):
+                        for a in range(range_start, min(range_end, len(covered))):
+                            covered[a] -= 1
+                            if covered[a]:
+                                covering[a].remove(block_start)
+                            else:
+                                del covering[a]
+
+    # Instructions the next call to cycle would execute, used to keep the interpreter in step
+    def next_length(self, memory):
+        cpu = self.cpu
+        block = self.blocks.get(cpu.pc)
+        if block is None:
+            block = self.load(memory, cpu.pc)
+        if block is False or (block.depth and cpu.sp > len(cpu.stack) - block.depth):
+            return 1
+        return block.length
+
+
+# Snapshot of everything an instruction can change, for comparing two machines
+def machine_state(chip8):
+    cpu = chip8.cpu
+    return (list(cpu.v), cpu.i, cpu.pc, cpu.sp, list(cpu.stack), cpu.dt, cpu.st, bytes(chip8.mem.mem),
+            chip8.display.get_framebuffer())
+
+
+# Run the interpreter and the block engine side by side on the same ROM, comparing the full machine state after
+# every block. Returns the number of instructions that matched, or raises AssertionError on the first difference
+# Both tick their timers every per_frame instructions the way CHIP8.run does: the interpreter exactly on the
+# instruction, the block engine once the block that crossed the tick has finished
+def lockstep(rom_path, max_instructions=100000, per_frame=CHIP8.CYCLES_PER_TICK):
+    # Seeded alike, so both machines draw the same random numbers
+    reference = CHIP8(debug_mode=False, headless=True, seed=0)
+    compiled = CHIP8(debug_mode=False, headless=True, seed=0)
+    reference.load_rom(rom_path)
+    compiled.load_rom(rom_path)
+    engine = BlockEngine(compiled.cpu, compiled.mem)
+
+    executed = 0
+    ref_executed = 0
+    next_tick = ref_next_tick = per_frame
+    while executed < max_instructions:
+        start_pc = compiled.cpu.pc
+        length = engine.next_length(compiled.mem)
+        go = engine.cycle(compiled.mem, compiled.display)
+        if go:
+            executed += length
+            while executed >= next_tick:
+                compiled.tick()
+                next_tick += per_frame
+
+        ref_go = True
+        for _ in range(length):
+            ref_go = reference.cpu.cycle(reference.mem, reference.display)
+            if not ref_go:
+                break
+            ref_executed += 1
+            while ref_executed >= ref_next_tick:
+                reference.tick()
+                ref_next_tick += per_frame
+
+        if bool(go) != ref_go or machine_state(reference) != machine_state(compiled):
+            raise AssertionError(f"Block engine diverged from the interpreter in the block at {format(start_pc, '03X')}")
+
+        if not go:
+            break
+
+    return executed
+
+
+if __name__ == "__main__":
+    # Check the block engine against the interpreter: blocks.py <rom> [max instructions]
+    count = lockstep(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+    print(f"{count} instructions matched")
@@ -0,0 +1,89 @@
+import argparse
+import sys
+
+
+# Command line for the emulator and its tools:
+#   cli.py run ROM          play in a window (--split draws it from a separate process, --phosphor and --blend
+#                           smooth out flicker)
+#   cli.py headless ROM     run without a window
+#                           (--debugger on either starts the program stopped in the debugger console, debugger.py)
+#   cli.py bench ...        the benchmark suite (python -m bench)
+#   cli.py disasm ROM ...   the disassembler (disasm.py)
+#   cli.py serve DIR ...    the streaming server (server.py)
+#   cli.py replay LOG ...   replay a session recorded with --record (replay.py)
+#   cli.py fuzz ...         check the faster engines against the interpreter on random programs (fuzz.py)
+# Only argparse is imported up front; each command imports what it needs when it runs, so the tools that spawn lots
+# of short-lived processes don't pay for pygame (or even the core) unless they use it. The bench suite's startup
+# benchmarks track how long that takes
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="cli.py", description="CHIP-8 emulator")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    for name, help_text in (("run", "play a ROM in a window"), ("headless", "run a ROM without a window")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("rom")
+        command.add_argument("--debug", action="store_true", help="print a trace line for every instruction")
+        command.add_argument("--compiled", action="store_true", help="use the block engine instead of the interpreter")
+        command.add_argument("--profile", action="store_true", help="print an execution profile at exit")
+        command.add_argument("--ipf", type=int, help="instructions per 60 Hz frame")
+        command.add_argument("--cycles", type=int, help="stop after this many instructions")
+        command.add_argument("--record", metavar="LOG", help="save the input to LOG, for replaying the session")
+        command.add_argument("--seed", type=int, help="seed for RND, to make runs repeatable")
+        command.add_argument("--xo", action="store_true", help="give the machine XO-CHIP's 64 KB of memory")
+        command.add_argument("--debugger", action="store_true",
+                             help="start in the debugger console; Ctrl+C goes back to it")
+        if name == "run":
+            command.add_argument("--split", action="store_true",
+                                 help="render and handle input in a separate process over shared memory")
+            smoothing = command.add_mutually_exclusive_group()
+            smoothing.add_argument("--phosphor", type=float, nargs="?", const=0.6, metavar="DECAY",
+                                   help="fade pixels out by DECAY a frame instead of switching them off (default 0.6)")
+            smoothing.add_argument("--blend", type=int, metavar="FRAMES",
+                                   help="show each pixel averaged over the last FRAMES frames")
+
+    # These hand the rest of the command line to the tool's own parser
+    commands.add_parser("bench", help="run the benchmark suite", add_help=False)
+    commands.add_parser("disasm", help="disassemble a ROM", add_help=False)
+    commands.add_parser("serve", help="stream headless sessions to local clients", add_help=False)
+    commands.add_parser("replay", help="replay a recorded session at full speed", add_help=False)
+    commands.add_parser("fuzz", help="check the faster engines against the interpreter", add_help=False)
+
+    args, rest = parser.parse_known_args(argv)
+
+    if args.command == "bench":
+        from bench.__main__ import main as bench_main
+        return bench_main(rest)
+    elif args.command == "disasm":
+        import disasm
+        return disasm.main(rest)
+    elif args.command == "serve":
+        import server
+        return server.main(rest)
+    elif args.command == "replay":
+        import replay
+        return replay.main(rest)
+    elif args.command == "fuzz":
+        import fuzz
+        return fuzz.main(rest)
+
+    if rest:
+        parser.error(f"unrecognized arguments: {' '.join(rest)}")
+
+    post = None
+    if getattr(args, "phosphor", None) is not None:
+        from phosphor import Phosphor
+        post = Phosphor(args.phosphor)
+    elif getattr(args, "blend", None) is not None:
+        from phosphor import FrameBlend
+        post = FrameBlend(args.blend)
+
+    from main import main as play, CHIP8
+    play(args.rom, headless=args.command == "headless", profile=args.profile, debug=args.debug,
+         compiled=args.compiled, instructions_per_frame=args.ipf or CHIP8.CYCLES_PER_TICK, max_cycles=args.cycles,
+         split=getattr(args, "split", False), record=args.record, seed=args.seed,
+         xo=args.xo, post=post, debugger=args.debugger)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
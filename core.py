@@ -0,0 +1,991 @@
+from array import array
+from enum import Enum, auto
+import os
+import random
+import struct
+import sys
+
+from backend import *
+from keypad import Keypad
+from scheduler import Scheduler
+from sprites import CHIP8_SPRITES, SCHIP_SPRITES
+
+
+MEM_SIZE = 4096
+XO_MEM_SIZE = 0x10000   # XO-CHIP's 64K
+PGM_MEM_START = 0x200
+
+# The built-in hex digit fonts, loaded below the program at startup: LDS (Fx29) points I at a 5-byte digit, LDHF
+# (Fx30) at one of SUPER-CHIP's 10-byte ones
+FONT_START = 0x050
+HIRES_FONT_START = 0x0A0
+FONT = bytes(row for digit in "0123456789ABCDEF" for row in CHIP8_SPRITES[digit])
+HIRES_FONT = bytes(row for digit in "0123456789ABCDEF" for row in SCHIP_SPRITES[digit])
+
+
+# Holds the names of all the operations
+class Op(Enum):
+    NONE = auto()   # unrecognized opcode
+    NOP = auto()    # no operation
+    SYS = auto()    # jump to routine (deprecated)
+    CLS = auto()    # clear the display
+    RET = auto()    # return from a subroutine
+    JP = auto()     # jump to location (branch always)
+    CALL = auto()   # call subroutine
+    SE = auto()     # skip instruction if equal
+    SNE = auto()    # skip instruction if not equal
+    SER = auto()    # skip instruction if equal to register
+    LD = auto()     # load
+    ADD = auto()    # add direct
+    LDR = auto()    # load register
+    OR = auto()     # bitwise OR
+    AND = auto()    # bitwise AND
+    XOR = auto()    # bitwise XOR
+    ADDR = auto()   # add register
+    SUB = auto()    # subtract Vx - Vy
+    SHR = auto()    # shift right
+    SUBN = auto()   # subtract Vy - Vx
+    SHL = auto()    # shift left
+    SNER = auto()   # skip instruction if not equal to register
+    LDI = auto()    # load I
+    JPO = auto()    # jump to location plus offset
+    RND = auto()    # random byte
+    DRW = auto()    # display sprite
+    SKP = auto()    # skip instruction if key pressed
+    SKNP = auto()   # skip instruction if key not pressed
+    LDDT = auto()   # load delay timer
+    LDKP = auto()   # load key press (blocks)
+    LDDTR = auto()  # load delay timer from register
+    LDST = auto()   # load sound timer
+    ADDI = auto()   # add Vx to I
+    LDS = auto()    # load I with sprite location
+    LDBCD = auto()  # store Vx in I, I+1, and I+2 in BCD format
+    LDIR = auto()   # load registers V0-VF into memory starting at address I
+    LDRI = auto()   # read starting at address I and store values in V0-VF
+    # SUPER-CHIP
+    SCD = auto()    # scroll down n pixels
+    SCR = auto()    # scroll right 4 pixels
+    SCL = auto()    # scroll left 4 pixels
+    EXIT = auto()   # stop the program
+    LOW = auto()    # switch to low resolution (64x32)
+    HIGH = auto()   # switch to high resolution (128x64)
+    LDHF = auto()   # load I with large sprite location
+    STRF = auto()   # store V0-Vx in the flags registers
+    LDRF = auto()   # load V0-Vx from the flags registers
+    # XO-CHIP
+    SCU = auto()    # scroll up n pixels
+    SAVE = auto()   # store Vx-Vy in memory starting at address I
+    LOAD = auto()   # load Vx-Vy from memory starting at address I
+    LDIL = auto()   # load I with the 16-bit address in the next two bytes (a four byte instruction)
+    PLANE = auto()  # select the bitplanes to draw to
+    AUDIO = auto()  # load the audio pattern from memory at I
+    PITCH = auto()  # set the audio pitch
+    # Never decoded from an opcode
+    BREAK = auto()  # a debugger breakpoint, standing in for the instruction it's on (see debugger.py)
+
+
+class Memory:
+
+    __slots__ = ("mem", "decoded", "invalidators")
+
+    def __init__(self, fill, size=MEM_SIZE):
+        self.mem = bytearray([fill]) * size
+        # Predecoded instruction entries for each address, filled in by the CPU as code executes
+        self.decoded = [None] * size
+        # Callbacks run as callback(start, end) whenever a write lands in memory
+        self.invalidators = []
+
+    def read8(self, addr):
+        return self.mem[addr]
+
+    # Read two bytes from the given address
+    # Two indexes and a shift measure faster than int.from_bytes or a struct unpack on a bytearray
+    def read16(self, addr):
+        return (self.mem[addr] << 8) | self.mem[addr + 1]
+
+    # Write one byte at the given address
+    def write8(self, addr, data):
+        self.mem[addr] = data & 0xFF
+        self.invalidate(addr, addr + 1)
+
+    def write16(self, addr, data):
+        self.mem[addr] = (data >> 8) & 0xFF
+        self.mem[addr + 1] = data & 0xFF
+        self.invalidate(addr, addr + 2)
+
+    # The bytes of a sprite: like read, but rows past the end of memory are left out rather than raising
+    def sprite(self, addr, length):
+        return self.mem[addr:addr + length]
+
+    # Read a run of bytes starting at the given address
+    def read(self, addr, length):
+        if addr + length > len(self.mem):
+            raise IndexError(f"{length} bytes at {format(addr, '03X')} runs past the end of memory")
+        return self.mem[addr:addr + length]
+
+    # Copy a run of bytes into memory starting at the given address
+    def load(self, addr, data):
+        end = addr + len(data)
+        if end > len(self.mem):
+            raise IndexError(f"{len(data)} bytes at {format(addr, '03X')} runs past the end of memory")
+        self.mem[addr:end] = data
+        self.invalidate(addr, end)
+
+    # Drop any predecoded instructions overlapping the written range [start, end)
+    # An instruction starting one byte before the range still reads its first byte, so it goes too
+    def invalidate(self, start, end):
+        decoded = self.decoded
+        for addr in range(max(start - 1, 0), min(end, len(decoded))):
+            decoded[addr] = None
+
+        for callback in self.invalidators:
+            callback(start, end)
+
+
+# Operations class that decodes opcodes and picks out relevant pieces
+class Operator:
+
+    @staticmethod
+    def decode(opcode):
+        operation = Operator.lookup(opcode)
+
+        if operation is Op.NONE: print(f"Invalid opcode: {format(opcode, '04X')}")
+
+        return operation
+
+    # Same as decode, but quietly returns Op.NONE for invalid opcodes
+    @staticmethod
+    def lookup(opcode):
+        op = Operator.op(opcode)
+        n = Operator.n(opcode)
+        kk = Operator.kk(opcode)
+        operation = Op.NONE
+
+        if opcode == 0x00E0: operation = Op.CLS
+        elif opcode == 0x00EE: operation = Op.RET
+        elif opcode == 0x0000: operation = Op.NONE
+        elif opcode & 0xFFF0 == 0x00C0: operation = Op.SCD
+        elif opcode & 0xFFF0 == 0x00D0: operation = Op.SCU
+        elif opcode == 0x00FB: operation = Op.SCR
+        elif opcode == 0x00FC: operation = Op.SCL
+        elif opcode == 0x00FD: operation = Op.EXIT
+        elif opcode == 0x00FE: operation = Op.LOW
+        elif opcode == 0x00FF: operation = Op.HIGH
+        # if op == 0x0000: operation = Op.SYS
+        if op == 0x1000: operation = Op.JP
+        elif op == 0x2000: operation = Op.CALL
+        elif op == 0x3000: operation = Op.SE
+        elif op == 0x4000: operation = Op.SNE
+        elif op == 0x5000:
+            if n == 0x2: operation = Op.SAVE
+            elif n == 0x3: operation = Op.LOAD
+            else: operation = Op.SER
+        elif op == 0x6000: operation = Op.LD
+        elif op == 0x7000: operation = Op.ADD
+        elif op == 0x8000:
+            if n == 0x0: operation = Op.LDR
+            elif n == 0x1: operation = Op.OR
+            elif n == 0x2: operation = Op.AND
+            elif n == 0x3: operation = Op.XOR
+            elif n == 0x4: operation = Op.ADDR
+            elif n == 0x5: operation = Op.SUB
+            elif n == 0x6: operation = Op.SHR
+            elif n == 0x7: operation = Op.SUBN
+            elif n == 0xE: operation = Op.SHL
+        elif op == 0x9000: operation = Op.SNER
+        elif op == 0xA000: operation = Op.LDI
+        elif op == 0xB000: operation = Op.JPO
+        elif op == 0xC000: operation = Op.RND
+        elif op == 0xD000: operation = Op.DRW
+        elif op == 0xE000:
+            if kk == 0x9E: operation = Op.SKP
+            elif kk == 0xA1: operation = Op.SKNP
+        elif op == 0xF000:
+            if opcode == 0xF000: operation = Op.LDIL
+            elif opcode == 0xF002: operation = Op.AUDIO
+            elif kk == 0x01: operation = Op.PLANE
+            elif kk == 0x07: operation = Op.LDDT
+            elif kk == 0x0A: operation = Op.LDKP
+            elif kk == 0x15: operation = Op.LDDTR
+            elif kk == 0x18: operation = Op.LDST
+            elif kk == 0x1E: operation = Op.ADDI
+            elif kk == 0x29: operation = Op.LDS
+            elif kk == 0x33: operation = Op.LDBCD
+            elif kk == 0x55: operation = Op.LDIR
+            elif kk == 0x65: operation = Op.LDRI
+            elif kk == 0x30: operation = Op.LDHF
+            elif kk == 0x3A: operation = Op.PITCH
+            elif kk == 0x75: operation = Op.STRF
+            elif kk == 0x85: operation = Op.LDRF
+
+        return operation
+
+    @staticmethod
+    def op(opcode):
+        return opcode & 0xF000
+
+    @staticmethod
+    def nnn(opcode):
+        return opcode & 0x0FFF
+
+    @staticmethod
+    def x(opcode):
+        return (opcode & 0x0F00) >> 8
+
+    @staticmethod
+    def y(opcode):
+        return (opcode & 0x00F0) >> 4
+
+    @staticmethod
+    def kk(opcode):
+        return opcode & 0x00FF
+
+    @staticmethod
+    def n(opcode):
+        return opcode & 0xF
+
+
+class CPU:
+
+    BYTE_MAX_VALUE = 255    # Max value that can be stored in a byte (2**8)
+    O = 0xF                 # CPU overflow register
+    NUM_VREGS = 16          # The number of V registers
+
+    # Predecoded instructions keyed by opcode, shared by every CPU
+    # Each entry is (handler, op, opcode, x, y, kk, n, nnn)
+    predecoded = {}
+
+    # Layout of get_state: I, PC, SP, DT, ST, the register a suspended LDKP is waiting to fill (-1 for none),
+    # V0-VF, the SUPER-CHIP flags registers and XO-CHIP's audio pattern and pitch, followed by the stack as
+    # little-endian 16-bit words
+    STATE = struct.Struct("<HHBBBb16s16s16sB")
+
+    __slots__ = ("v", "i", "st", "dt", "pc", "sp", "op", "stack", "keypad", "waiting", "wait_since", "rng", "flags",
+                 "pattern", "pitch")
+
+    def __init__(self, stack_size, keypad=None, rng=None):
+        self.v = bytearray(CPU.NUM_VREGS)  # the V registers, which only ever hold bytes
+        self.i = 0   # The I register
+        self.st = 0  # The sound timer register
+        self.dt = 0  # The delay timer register
+        self.pc = PGM_MEM_START  # The program counter
+        self.sp = 0  # The stack pointer, the number of return addresses on the stack
+        self.op = Op.NONE
+
+        self.stack = array("H", bytes(2 * stack_size))
+
+        self.keypad = Keypad() if keypad is None else keypad
+        self.waiting = None     # while LDKP is suspended, the register it will load the key into
+        self.wait_since = 0     # keypad.presses when LDKP suspended; only a press after that resumes it
+        self.rng = random.Random() if rng is None else rng     # where RND gets its bytes, one generator per machine
+
+        self.flags = bytearray(CPU.NUM_VREGS)   # SUPER-CHIP's flags registers (persistent storage on the HP-48)
+        self.pattern = bytes(16)                # XO-CHIP's 1-bit audio pattern, played while the sound timer runs
+        self.pitch = 64                         # and its playback rate, 4000 * 2 ** ((pitch - 64) / 48) Hz
+
+    def cycle(self, memory, display):
+
+        entry = memory.decoded[self.pc]
+        if entry is None:
+            # First time executing this address (or it was overwritten), so decode it and remember the result
+            entry = memory.decoded[self.pc] = CPU.predecode(memory.read16(self.pc))
+
+        handler, self.op, opcode, x, y, kk, n, nnn = entry
+        next_pc = handler(self, memory, display, x, y, kk, n, nnn)
+
+        if next_pc is None:
+            return self.stopped(opcode)
+
+        self.pc = next_pc
+        return True
+
+    # The instruction at pc didn't hand back a next PC: reports an invalid opcode, and always returns False
+    def stopped(self, opcode):
+        if self.waiting is not None or self.op is Op.EXIT or self.op is Op.BREAK:
+            return False # suspended in LDKP (see resume), the program exited, or it hit a breakpoint
+        print(f"CHIP-8 encountered an error @ {format(self.pc, '03X')}")
+        self.trace(opcode)
+        return False # If the opcode we received was invalid, stop execution
+
+    # Same as cycle, but prints a trace line for every instruction
+    # Used in place of cycle while debugging, so cycle itself never pays for tracing
+    def debug_cycle(self, memory, display):
+        pc = self.pc
+        opcode = memory.read16(pc)
+        go = self.cycle(memory, display)
+        if go or self.waiting is not None:
+            print(CPU.format_trace(pc, opcode, self.op, CPU.format_args(self.op, self.v, opcode)))
+        return go
+
+    # The registers, timers and stack as one flat buffer (see STATE), cheap to snapshot or send to another process
+    # V and the stack are buffers themselves, so memoryview(cpu.v) and memoryview(cpu.stack) share them without copying
+    def get_state(self):
+        stack = self.stack
+        if sys.byteorder != "little":
+            stack = array("H", stack)
+            stack.byteswap()
+        waiting = -1 if self.waiting is None else self.waiting
+        return CPU.STATE.pack(self.i, self.pc, self.sp, self.dt, self.st, waiting, self.v, self.flags, self.pattern,
+                              self.pitch) + stack.tobytes()
+
+    # A restored LDKP waits for a key pressed after the restore
+    def set_state(self, data):
+        self.i, self.pc, self.sp, self.dt, self.st, waiting, self.v[:], self.flags[:], self.pattern, self.pitch = \
+            CPU.STATE.unpack_from(data)
+        self.waiting = None if waiting < 0 else waiting
+        self.wait_since = self.keypad.presses
+        stack = array("H", data[CPU.STATE.size:CPU.STATE.size + 2 * len(self.stack)])
+        if sys.byteorder != "little":
+            stack.byteswap()
+        self.stack[:] = stack
+
+    # Decode an opcode into its handler and all of its operands
+    @staticmethod
+    def predecode(opcode):
+        entry = CPU.predecoded.get(opcode)
+        if entry is None:
+            op = Operator.lookup(opcode)
+            entry = (CPU.HANDLERS[op], op, opcode, Operator.x(opcode), Operator.y(opcode), Operator.kk(opcode),
+                     Operator.n(opcode), Operator.nnn(opcode))
+            CPU.predecoded[opcode] = entry
+
+        return entry
+
+    # Each handler performs one operation and returns the next program counter, or None if execution has to stop
+
+    def op_none(self, memory, display, x, y, kk, n, nnn):
+        print(f"Invalid opcode: {format(memory.read16(self.pc), '04X')}")
+        return None
+
+    def op_nop(self, memory, display, x, y, kk, n, nnn):
+        return self.pc + 2
+
+    def op_jp(self, memory, display, x, y, kk, n, nnn):
+        return nnn
+
+    def op_cls(self, memory, display, x, y, kk, n, nnn):
+        display.clear()
+        return self.pc + 2
+
+    def op_ret(self, memory, display, x, y, kk, n, nnn):
+        # return from subroutine
+        if self.sp == 0:
+            print("Stack underflow")
+            return None
+        self.sp -= 1
+        return self.stack[self.sp]
+
+    def op_call(self, memory, display, x, y, kk, n, nnn):
+        # call subroutine, pushing the address of the next instruction
+        if self.sp == len(self.stack):
+            print("Stack overflow")
+            return None
+        self.stack[self.sp] = self.pc + 2
+        self.sp += 1
+        return nnn
+
+    def op_se(self, memory, display, x, y, kk, n, nnn):
+        # skip inst if equal
+        return self.skip(memory) if self.v[x] == kk else self.pc + 2
+
+    def op_sne(self, memory, display, x, y, kk, n, nnn):
+        # skip inst if not equal
+        return self.skip(memory) if self.v[x] != kk else self.pc + 2
+
+    def op_ser(self, memory, display, x, y, kk, n, nnn):
+        # skip inst if equal to register
+        return self.skip(memory) if self.v[x] == self.v[y] else self.pc + 2
+
+    def op_ld(self, memory, display, x, y, kk, n, nnn):
+        # load
+        self.v[x] = kk
+        return self.pc + 2
+
+    def op_add(self, memory, display, x, y, kk, n, nnn):
+        # add direct
+        self.v[x] = (self.v[x] + kk) & 0xFF
+        return self.pc + 2
+
+    def op_ldr(self, memory, display, x, y, kk, n, nnn):
+        # load register
+        self.v[x] = self.v[y]
+        return self.pc + 2
+
+    def op_or(self, memory, display, x, y, kk, n, nnn):
+        # bitwise OR
+        self.v[x] = self.v[x] | self.v[y]
+        return self.pc + 2
+
+    def op_and(self, memory, display, x, y, kk, n, nnn):
+        # bitwise AND
+        self.v[x] = self.v[x] & self.v[y]
+        return self.pc + 2
+
+    def op_xor(self, memory, display, x, y, kk, n, nnn):
+        # bitwise XOR
+        self.v[x] = self.v[x] ^ self.v[y]
+        return self.pc + 2
+
+    def op_addr(self, memory, display, x, y, kk, n, nnn):
+        # add register, VF = carry
+        total = self.v[x] + self.v[y]
+        self.v[x] = total & 0xFF
+        self.v[CPU.O] = 0 if total <= CPU.BYTE_MAX_VALUE else 1
+        return self.pc + 2
+
+    def op_sub(self, memory, display, x, y, kk, n, nnn):
+        # subtract Vx - Vy, VF = Vx > Vy
+        vx, vy = self.v[x], self.v[y]
+        self.v[x] = (vx - vy) & 0xFF
+        self.v[CPU.O] = 1 if vx > vy else 0
+        return self.pc + 2
+
+    def op_shr(self, memory, display, x, y, kk, n, nnn):
+        # shift right, VF = the bit shifted out
+        vx = self.v[x]
+        self.v[x] = vx >> 1
+        self.v[CPU.O] = vx & 0x1
+        return self.pc + 2
+
+    def op_subn(self, memory, display, x, y, kk, n, nnn):
+        # subtract Vy - Vx, VF = Vy > Vx
+        vx, vy = self.v[x], self.v[y]
+        self.v[x] = (vy - vx) & 0xFF
+        self.v[CPU.O] = 1 if vy > vx else 0
+        return self.pc + 2
+
+    def op_shl(self, memory, display, x, y, kk, n, nnn):
+        # shift left, VF = the bit shifted out
+        vx = self.v[x]
+        self.v[x] = (vx << 1) & 0xFF
+        self.v[CPU.O] = vx >> 7
+        return self.pc + 2
+
+    def op_sner(self, memory, display, x, y, kk, n, nnn):
+        # skip inst if not equal to register
+        return self.skip(memory) if self.v[x] != self.v[y] else self.pc + 2
+
+    def op_ldi(self, memory, display, x, y, kk, n, nnn):
+        # load I
+        self.i = nnn
+        return self.pc + 2
+
+    def op_jpo(self, memory, display, x, y, kk, n, nnn):
+        # jump to location + offset
+        return nnn + self.v[0]
+
+    def op_rnd(self, memory, display, x, y, kk, n, nnn):
+        # random byte
+        self.v[x] = self.rng.getrandbits(8) & kk
+        return self.pc + 2
+
+    def op_drw(self, memory, display, x, y, kk, n, nnn):
+        # read n bytes from address in I and draw them at (Vx, Vy)
+        # DXY0 draws a 16x16 sprite instead (SUPER-CHIP), and with more than one XO-CHIP plane selected each plane
+        # takes the next sprite's worth of bytes
+        size = n or 32
+        if display.plane_mask != 1:
+            size *= bin(display.plane_mask).count("1")
+        sprite = memory.sprite(self.i, size)
+        # set register VF to the result of the draw_sprite function
+        self.v[CPU.O] = display.draw_sprite(self.v[x], self.v[y], sprite, 8 if n else 16)
+        return self.pc + 2
+
+    def op_skp(self, memory, display, x, y, kk, n, nnn):
+        # skip inst if key Vx is pressed
+        return self.skip(memory) if (self.keypad.pressed >> (self.v[x] & 0xF)) & 0x1 else self.pc + 2
+
+    def op_sknp(self, memory, display, x, y, kk, n, nnn):
+        # skip inst if key Vx is not pressed
+        return self.pc + 2 if (self.keypad.pressed >> (self.v[x] & 0xF)) & 0x1 else self.skip(memory)
+
+    def op_lddt(self, memory, display, x, y, kk, n, nnn):
+        # load delay timer into register
+        self.v[x] = self.dt
+        return self.pc + 2
+
+    def op_ldkp(self, memory, display, x, y, kk, n, nnn):
+        # load key press (blocking)
+        # Rather than running this instruction over and over, the CPU suspends: cycle returns False so whatever is
+        # running it stops, and resume loads the key once one is pressed
+        self.waiting = x
+        self.wait_since = self.keypad.presses
+        self.pc += 2
+        return None
+
+    # Finish a suspended LDKP if a key has been pressed since it started, returning True if the CPU can run again
+    def resume(self):
+        if self.waiting is None:
+            return True
+
+        key = self.keypad.new_press(self.wait_since)
+        if key is None:
+            return False
+        self.v[self.waiting] = key
+        self.waiting = None
+        return True
+
+    def op_lddtr(self, memory, display, x, y, kk, n, nnn):
+        # load delay timer from register
+        self.dt = self.v[x]
+        return self.pc + 2
+
+    def op_ldst(self, memory, display, x, y, kk, n, nnn):
+        # load sound timer
+        self.st = self.v[x]
+        return self.pc + 2
+
+    def op_addi(self, memory, display, x, y, kk, n, nnn):
+        # add Vx to I
+        self.i = (self.i + self.v[x]) & 0xFFFF
+        return self.pc + 2
+
+    def op_lds(self, memory, display, x, y, kk, n, nnn):
+        # load I with the location of the font sprite for the digit in Vx
+        self.i = FONT_START + 5 * (self.v[x] & 0xF)
+        return self.pc + 2
+
+    def op_ldbcd(self, memory, display, x, y, kk, n, nnn):
+        # store Vx in I, I+1, and I+2 in BCD format
+        memory.load(self.i, bytes(CPU.bcd(self.v[x])))
+        return self.pc + 2
+
+    def op_ldir(self, memory, display, x, y, kk, n, nnn):
+        # load registers V0-Vx into memory starting at address I
+        memory.load(self.i, self.v[:x + 1])
+        return self.pc + 2
+
+    def op_ldri(self, memory, display, x, y, kk, n, nnn):
+        # read starting at address I and store values in V0-Vx
+        self.v[:x + 1] = memory.read(self.i, x + 1)
+        return self.pc + 2
+
+    # SUPER-CHIP
+
+    def op_scd(self, memory, display, x, y, kk, n, nnn):
+        # scroll down n pixels
+        display.scroll_down(n)
+        return self.pc + 2
+
+    def op_scr(self, memory, display, x, y, kk, n, nnn):
+        # scroll right 4 pixels
+        display.scroll_right(4)
+        return self.pc + 2
+
+    def op_scl(self, memory, display, x, y, kk, n, nnn):
+        # scroll left 4 pixels
+        display.scroll_left(4)
+        return self.pc + 2
+
+    def op_exit(self, memory, display, x, y, kk, n, nnn):
+        # stop the program; cycle stops quietly rather than reporting an error
+        return None
+
+    def op_low(self, memory, display, x, y, kk, n, nnn):
+        # switch to 64x32, which clears the screen
+        display.resize(NATIVE_WIDTH, NATIVE_HEIGHT)
+        return self.pc + 2
+
+    def op_high(self, memory, display, x, y, kk, n, nnn):
+        # switch to 128x64, which clears the screen
+        display.resize(HIRES_WIDTH, HIRES_HEIGHT)
+        return self.pc + 2
+
+    def op_ldhf(self, memory, display, x, y, kk, n, nnn):
+        # load I with the location of the large font sprite for the digit in Vx
+        self.i = HIRES_FONT_START + 10 * (self.v[x] & 0xF)
+        return self.pc + 2
+
+    def op_strf(self, memory, display, x, y, kk, n, nnn):
+        # store V0-Vx in the flags registers
+        self.flags[:x + 1] = self.v[:x + 1]
+        return self.pc + 2
+
+    def op_ldrf(self, memory, display, x, y, kk, n, nnn):
+        # load V0-Vx from the flags registers
+        self.v[:x + 1] = self.flags[:x + 1]
+        return self.pc + 2
+
+    # XO-CHIP
+
+    def op_scu(self, memory, display, x, y, kk, n, nnn):
+        # scroll up n pixels
+        display.scroll_up(n)
+        return self.pc + 2
+
+    def op_save(self, memory, display, x, y, kk, n, nnn):
+        # store Vx-Vy in memory starting at address I, backwards if x > y; I doesn't change
+        if x <= y:
+            memory.load(self.i, self.v[x:y + 1])
+        else:
+            memory.load(self.i, self.v[y:x + 1][::-1])
+        return self.pc + 2
+
+    def op_load(self, memory, display, x, y, kk, n, nnn):
+        # load Vx-Vy from memory starting at address I, backwards if x > y; I doesn't change
+        values = memory.read(self.i, abs(x - y) + 1)
+        if x <= y:
+            self.v[x:y + 1] = values
+        else:
+            self.v[y:x + 1] = values[::-1]
+        return self.pc + 2
+
+    def op_ldil(self, memory, display, x, y, kk, n, nnn):
+        # load I with the 16-bit address that follows the opcode
+        self.i = memory.read16(self.pc + 2)
+        return self.pc + 4
+
+    def op_plane(self, memory, display, x, y, kk, n, nnn):
+        # select the bitplanes drawn to, cleared and scrolled
+        display.plane_mask = x & 0x3
+        return self.pc + 2
+
+    def op_audio(self, memory, display, x, y, kk, n, nnn):
+        # load the 16-byte audio pattern from address I
+        self.pattern = bytes(memory.read(self.i, 16))
+        return self.pc + 2
+
+    def op_pitch(self, memory, display, x, y, kk, n, nnn):
+        # set the audio pitch
+        self.pitch = self.v[x]
+        return self.pc + 2
+
+    # Where a taken skip goes: past the next instruction, which is four bytes long if it's XO-CHIP's F000 NNNN
+    def skip(self, memory):
+        pc = self.pc + 2
+        return pc + 4 if memory.mem[pc:pc + 2] == b"\xf0\x00" else pc + 2
+
+    # Handler for each operation
+    HANDLERS = {
+        Op.NONE: op_none, Op.NOP: op_nop, Op.SYS: op_jp, Op.CLS: op_cls, Op.RET: op_ret, Op.JP: op_jp,
+        Op.CALL: op_call, Op.SE: op_se, Op.SNE: op_sne, Op.SER: op_ser, Op.LD: op_ld, Op.ADD: op_add,
+        Op.LDR: op_ldr, Op.OR: op_or, Op.AND: op_and, Op.XOR: op_xor, Op.ADDR: op_addr, Op.SUB: op_sub,
+        Op.SHR: op_shr, Op.SUBN: op_subn, Op.SHL: op_shl, Op.SNER: op_sner, Op.LDI: op_ldi, Op.JPO: op_jpo,
+        Op.RND: op_rnd, Op.DRW: op_drw, Op.SKP: op_skp, Op.SKNP: op_sknp, Op.LDDT: op_lddt, Op.LDKP: op_ldkp,
+        Op.LDDTR: op_lddtr, Op.LDST: op_ldst, Op.ADDI: op_addi, Op.LDS: op_lds, Op.LDBCD: op_ldbcd,
+        Op.LDIR: op_ldir, Op.LDRI: op_ldri,
+        Op.SCD: op_scd, Op.SCR: op_scr, Op.SCL: op_scl, Op.EXIT: op_exit, Op.LOW: op_low, Op.HIGH: op_high,
+        Op.LDHF: op_ldhf, Op.STRF: op_strf, Op.LDRF: op_ldrf, Op.SCU: op_scu, Op.SAVE: op_save, Op.LOAD: op_load,
+        Op.LDIL: op_ldil, Op.PLANE: op_plane, Op.AUDIO: op_audio, Op.PITCH: op_pitch,
+    }
+
+    # Operands shown in the trace line for each operation
+    TRACE_ARGS = {
+        Op.SYS: "nnn", Op.JP: "nnn", Op.CALL: "nnn", Op.LDI: "nnn", Op.JPO: "nnn",
+        Op.SE: "xkk", Op.SNE: "xkk", Op.LD: "xkk", Op.ADD: "xkk", Op.RND: "xkk",
+        Op.SER: "xy", Op.LDR: "xy", Op.OR: "xy", Op.AND: "xy", Op.XOR: "xy", Op.ADDR: "xy", Op.SUB: "xy",
+        Op.SUBN: "xy", Op.SNER: "xy",
+        Op.SHR: "x", Op.SHL: "x", Op.LDDT: "x", Op.LDDTR: "x", Op.LDST: "x", Op.ADDI: "x",
+        Op.LDBCD: "bcd",
+        Op.SCD: "n", Op.SCU: "n", Op.SAVE: "xy", Op.LOAD: "xy", Op.PLANE: "x", Op.PITCH: "x", Op.LDHF: "x",
+        Op.STRF: "x", Op.LDRF: "x",
+    }
+
+    def tick60(self):
+        if self.st > 0:
+            self.st -= 1
+
+        if self.dt > 0:
+            self.dt -= 1
+
+    # The same as calling tick60 frames times
+    def tick_frames(self, frames):
+        self.st -= min(frames, self.st)
+        self.dt -= min(frames, self.dt)
+
+    # turns value into a 3-byte BCD representation
+    @staticmethod
+    def bcd(value):
+        hundreds = value // 100
+        tens = (value - (hundreds * 100)) // 10
+        ones = value % 10
+        return hundreds, tens, ones
+
+    # Format the operand string shown in the trace of an operation, given the registers after it ran
+    @staticmethod
+    def format_args(op, v, opcode):
+        kind = CPU.TRACE_ARGS.get(op, "")
+        x = Operator.x(opcode)
+        x_t = f"V{format(x, '1X')}"
+
+        if kind == "nnn": return format(Operator.nnn(opcode), '#03X')
+        elif kind == "xkk": return f"{x_t} {format(Operator.kk(opcode), '#02X')}"
+        elif kind == "xy": return f"{x_t} V{format(Operator.y(opcode), '1X')}"
+        elif kind == "x": return x_t
+        elif kind == "n": return str(Operator.n(opcode))
+        elif kind == "bcd":
+            h, t, o = CPU.bcd(v[x])
+            return f"{h} {t} {o}"
+        return ""
+
+    # A trace line of the program counter, the opcode, the name of the opcode, and a opcode specific arg string
+    @staticmethod
+    def format_trace(pc, opcode, op, args=""):
+        return f"{format(pc, '#03X')}: {format(opcode, '#04X')} {op}{' ' * (8 - len(str(op)))} {args}"
+
+    # Display a trace line for the current program counter
+    def trace(self, opcode, args=""):
+        print(CPU.format_trace(self.pc, opcode, self.op, args))
+
+
+class CHIP8:
+
+    __slots__ = ("mem", "debug_mode", "stack_size", "display", "keypad", "cpu", "cycles", "next_tick", "scheduler",
+                 "engine", "tick", "skip_idle", "blocks", "debugger")
+
+    CYCLES_PER_TICK = 10    # default instructions per 60 Hz frame (and timer tick)
+    MAX_STEP = 64           # most instructions a single engine step may run
+
+    def __init__(self, debug_mode=True, compiled=False, headless=False, display=None,
+                 instructions_per_frame=CYCLES_PER_TICK, skip_idle=True, seed=None, memory_size=MEM_SIZE):
+        self.mem = Memory(0, memory_size)   # XO-CHIP programs want XO_MEM_SIZE
+        self.mem.load(FONT_START, FONT)
+        self.mem.load(HIRES_FONT_START, HIRES_FONT)
+        self.debug_mode = debug_mode
+        self.stack_size = 16
+        if display is None:
+            if headless:
+                display = HeadlessDisplay(NATIVE_WIDTH, NATIVE_HEIGHT)
+            else:
+                # Only load pygame when a window is actually wanted
+                from display import Display
+                display = Display(NATIVE_WIDTH, NATIVE_HEIGHT)
+        self.display = display
+        self.keypad = Keypad()
+        display.keypad = self.keypad    # the window feeds its key events in here
+        # The same seed gives the same RND results; without one every machine gets its own random sequence
+        self.cpu = CPU(self.stack_size, self.keypad, random.Random(seed))
+        self.cycles = 0     # instructions executed so far
+        self.next_tick = instructions_per_frame     # the instruction count the timers next tick at
+        self.scheduler = Scheduler(instructions_per_frame)
+
+        # The engine runs one step of the program and returns how many instructions it executed (False to stop)
+        # That's a single instruction for the interpreter, or a whole block when compiled
+        # Debug traces are printed per instruction, so debugging always uses the interpreter
+        self.blocks = None  # the BlockEngine when compiled
+        if debug_mode:
+            self.engine = self.cpu.debug_cycle
+        elif compiled:
+            from blocks import BlockEngine
+            self.blocks = BlockEngine(self.cpu, self.mem)
+            self.engine = self.blocks.cycle
+        else:
+            self.engine = self.cpu.cycle
+        # Ticks the 60 Hz timers; like the engine, something watching the machine can swap it out
+        self.tick = self.cpu.tick60
+
+        # Fast-forward through idle loops (see fast_forward); off while debugging, which traces every instruction
+        self.skip_idle = skip_idle and not debug_mode
+        self.debugger = None    # an attached debugger.Debugger, which gets control when it stops the program
+
+    # Load a ROM into the program area
+    # offset and size pick a ROM out of a larger file (a ROM pack); use_mmap maps the file instead of reading it,
+    # so only the pages holding the ROM are ever touched
+    def load_rom(self, path, offset=0, size=None, use_mmap=False):
+        with open(path, "rb") as rom_file:
+            if size is None:
+                size = os.fstat(rom_file.fileno()).st_size - offset
+            room = len(self.mem.mem) - PGM_MEM_START
+            if size > room:
+                raise ValueError(f"{path} is {size} bytes, only {room} fit in memory")
+
+            if use_mmap:
+                import mmap
+                with mmap.mmap(rom_file.fileno(), 0, access=mmap.ACCESS_READ) as rom_map:
+                    self.mem.load(PGM_MEM_START, rom_map[offset:offset + size])
+            else:
+                # Read the ROM from the filesystem straight into ram
+                rom_file.seek(offset)
+                rom_file.readinto(memoryview(self.mem.mem)[PGM_MEM_START:PGM_MEM_START + size])
+                self.mem.invalidate(PGM_MEM_START, PGM_MEM_START + size)
+
+    def play(self, max_cycles=None):
+        if self.debug_mode: print("<addr>: <opcode> <op> <args...>")
+
+        if self.display.headless:
+            # Run flat out, sleeping whenever the program waits for a key
+            remaining = max_cycles
+            while remaining is None or remaining > 0:
+                executed = self.run(remaining)
+                if remaining is not None:
+                    remaining -= executed
+                if self.debugger is not None and self.debugger.stop is not None:
+                    if self.debugger.interact():
+                        continue
+                    break
+                if self.cpu.waiting is None:
+                    break
+                self.scheduler.start()
+                if not self.wait_for_key():
+                    break
+        else:
+            self.run_windowed(max_cycles)
+
+        self.display.close()
+
+    # Run flat out with no rendering or event handling, ticking the timers every frame's worth of instructions
+    # Returns the number of instructions executed. Stops early if the program halts or waits for a key (LDKP); in
+    # that case cpu.waiting is set, and the next run carries on once a key has been pressed
+    def run(self, max_cycles=None):
+        if not self.cpu.resume():
+            return 0
+
+        start = self.cycles
+        per_frame = self.scheduler.instructions_per_frame
+        next_tick = self.next_tick
+        step = self.engine
+        # Only the block engine runs more than one instruction a step, so only it can overshoot max_cycles; anything
+        # wrapping it (a tracer, the profiler) goes one instruction at a time
+        blocks = self.blocks if max_cycles is not None and self.blocks is not None and step == self.blocks.cycle \
+            else None
+
+        while max_cycles is None or self.cycles - start < max_cycles:
+            if blocks is not None and start + max_cycles - self.cycles < CHIP8.MAX_STEP and \
+                    blocks.next_length(self.mem) > start + max_cycles - self.cycles:
+                # Interpret the next instruction rather than let a block overshoot
+                executed = self.cpu.cycle(self.mem, self.display)
+            else:
+                executed = step(self.mem, self.display)
+            if not executed:
+                break
+
+            self.cycles += executed
+            while self.cycles >= next_tick:
+                self.tick()
+                next_tick += per_frame
+                # Once a frame, skip over any idle loop the program is sitting in; the skipped instructions can
+                # cross more ticks, which this loop then runs. skip_idle is read every time, since a debugger pausing
+                # the machine from another thread turns it off so the next instruction gets fetched
+                if self.skip_idle and self.cycles < next_tick:
+                    budget = None if max_cycles is None else start + max_cycles - self.cycles
+                    self.cycles += self.fast_forward(next_tick - self.cycles, per_frame, budget)
+                    # A JP to itself can skip a whole budget of frames: run all but the last tick at once (nothing
+                    # wraps tick while idle loops are skipped)
+                    frames = (self.cycles - next_tick) // per_frame
+                    if frames > 0:
+                        self.cpu.tick_frames(frames)
+                        next_tick += frames * per_frame
+
+        # Keep the frame phase for the next call, so running in small chunks ticks just as often as one long run
+        self.next_tick = next_tick
+        return self.cycles - start
+
+    # Run in real time: every frame executes the scheduler's instructions per frame, handles input, ticks the timers,
+    # presents the display and then sleeps until the next frame is due
+    def run_windowed(self, max_cycles=None):
+        scheduler = self.scheduler
+        end = None if max_cycles is None else self.cycles + max_cycles
+        go = True
+
+        scheduler.start()
+        while go:
+            # Frames end where run() would tick, so switching between the two keeps the timers in phase
+            frame_end = self.next_tick
+            if end is not None and frame_end >= end:
+                frame_end = end
+                go = False
+
+            # An idle program skips the rest of the frame; the timers only tick at the end of it
+            if self.skip_idle and self.cycles < frame_end:
+                self.cycles += self.fast_forward(frame_end - self.cycles, scheduler.instructions_per_frame,
+                                                 frame_end - self.cycles)
+
+            # An engine step can run past the end of the frame; the next frame just gets that much less
+            while self.cycles < frame_end:
+                executed = self.engine(self.mem, self.display)
+                if not executed:
+                    if self.debugger is not None and self.debugger.stop is not None:
+                        if not self.debugger.interact():
+                            go = False
+                            break
+                        scheduler.start()   # don't race to catch up on the time spent stopped
+                        if self.cpu.waiting is None:
+                            continue
+                    if self.cpu.waiting is not None and self.wait_for_key():
+                        continue
+                    go = False
+                    break
+                self.cycles += executed
+
+            # process inputs
+            if not self.display.poll():
+                go = False
+
+            # Run the 60 Hz tick actions, unless the frame was cut short
+            if self.cycles >= self.next_tick:
+                self.tick()
+                self.next_tick += scheduler.instructions_per_frame
+            self.display.present()
+            scheduler.wait()
+
+
+    # Sleep until a key press lets a suspended LDKP finish, meanwhile ticking the timers and presenting the display
+    # once a frame in real time. Returns False if the window was closed instead, True early if a debugger paused
+    def wait_for_key(self):
+        scheduler = self.scheduler
+        while not self.cpu.resume():
+            if self.debugger is not None and self.debugger.stop is not None:
+                return True     # paused: the debugger takes over, with LDKP still waiting
+            if not self.display.wait_input(self.cpu.wait_since, max(scheduler.remaining(), 0)):
+                return False
+            if self.keypad.new_press(self.cpu.wait_since) is None:
+                # No key this frame: tick the timers and sleep out whatever is left of it
+                self.tick()
+                self.display.present()
+                scheduler.wait()
+
+        return True
+
+    # If the program is sitting in an idle loop, run the loop forward without executing it and return how many
+    # instructions that skipped (0 if it isn't idle). ticks_due is how many instructions until the next timer tick,
+    # per_frame how many between ticks after that, and budget the most instructions to skip (None for no limit).
+    # The caller ticks the timers for the skipped instructions; the CPU is left exactly as if the loop had run:
+    #   JP self                             skips the whole budget, or up to the next tick if there isn't one
+    #   LDDT Vx / SE Vx, 00 / JP (LDDT)     skips to the LDDT that will read the expired delay timer
+    def fast_forward(self, ticks_due, per_frame, budget):
+        cpu = self.cpu
+        mem = self.mem.mem
+        pc = cpu.pc
+        if pc > len(mem) - 2 or pc > 0xFFF:
+            return 0    # off the end, or past the 4K a JP can reach
+
+        if mem[pc] == 0x10 | (pc >> 8) and mem[pc + 1] == pc & 0xFF:
+            skipped = ticks_due if budget is None else budget
+            if skipped > 0:
+                cpu.op = Op.JP
+            return skipped
+
+        # Find the start of a delay timer loop around pc
+        for offset in (0, 2, 4):
+            head = pc - offset
+            if head >= 0 and head + 6 <= len(mem) and mem[head] & 0xF0 == 0xF0 and mem[head + 1] == 0x07 and \
+                    mem[head + 2] == 0x30 | (mem[head] & 0xF) and mem[head + 3] == 0x00 and \
+                    mem[head + 4] == 0x10 | (head >> 8) and mem[head + 5] == head & 0xFF:
+                break
+        else:
+            return 0
+
+        x = mem[head] & 0xF
+        dt = cpu.dt
+        if dt == 0 or (offset == 2 and cpu.v[x] == 0):
+            return 0    # the loop is about to exit anyway
+
+        # The instruction k instructions from now sees no ticks before ticks_due, then one more every per_frame;
+        # skip whole trips around the loop up to the first LDDT that will have seen dt ticks
+        first = (0, 2, 1)[offset // 2]  # instructions until the next LDDT
+        trips = max(0, -(-(ticks_due + (dt - 1) * per_frame - first) // 3))
+        if budget is not None and first + 3 * trips > budget:
+            trips = (budget - first) // 3
+            if trips < 0:
+                return 0
+
+        if trips > 0:
+            # Vx holds whatever the last skipped LDDT read
+            last = first + 3 * (trips - 1)
+            cpu.v[x] = dt - (0 if last < ticks_due else 1 + (last - ticks_due) // per_frame)
+
+        skipped = first + 3 * trips
+        if skipped > 0:
+            cpu.pc = head
+            cpu.op = Op.JP
+        return skipped
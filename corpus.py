@@ -0,0 +1,155 @@
+import argparse
+import contextlib
+import csv
+import hashlib
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from core import *
+
+
+ROM_EXTENSIONS = (".ch8", ".c8", ".rom")
+
+
+def framebuffer_hash(chip8):
+    return hashlib.blake2b(chip8.display.get_framebuffer(), digest_size=8).hexdigest()
+
+
+# Run one ROM headless for the given number of instructions, hashing the framebuffer every checkpoint instructions
+# Runs in a worker process, so everything it returns has to be picklable
+def run_rom(path, cycles, checkpoint, compiled=False):
+    try:
+        with open(path, "rb") as rom_file:
+            rom_hash = hashlib.blake2b(rom_file.read(), digest_size=8).hexdigest()
+    except OSError:
+        rom_hash = None     # load_rom fails the same way below, which reports it
+
+    result = {"rom": os.path.basename(path), "rom_hash": rom_hash, "status": "ok", "checkpoints": []}
+
+    # Invalid opcodes get reported on stdout, which would just interleave between workers
+    with contextlib.redirect_stdout(io.StringIO()):
+        # Seeded from the ROM, so RND gives the same results in every report
+        chip8 = CHIP8(debug_mode=False, compiled=compiled, headless=True, seed=rom_hash)
+
+        # A ROM that can't be loaded is just reported as failed, like one that crashes, rather than stopping the run
+        try:
+            chip8.load_rom(path)
+            while chip8.cycles < cycles:
+                target = min(cycles, chip8.cycles - chip8.cycles % checkpoint + checkpoint)
+                chip8.run(target - chip8.cycles)
+                if chip8.cycles < target:
+                    # Nothing presses keys here, so a program waiting for one is stuck for good
+                    result["status"] = "halted" if chip8.cpu.waiting is None else "waiting for key"
+                    break
+                result["checkpoints"].append([chip8.cycles, framebuffer_hash(chip8)])
+        except Exception as e:
+            result["status"] = f"error: {type(e).__name__}: {e}"
+
+    cpu = chip8.cpu
+    result.update({
+        "cycles": chip8.cycles,
+        "final_hash": framebuffer_hash(chip8),
+        "v": list(cpu.v),
+        "i": cpu.i,
+        "pc": cpu.pc,
+        "sp": cpu.sp,
+    })
+    return result
+
+
+def find_roms(rom_dir):
+    return sorted(os.path.join(rom_dir, name) for name in os.listdir(rom_dir)
+                  if name.lower().endswith(ROM_EXTENSIONS))
+
+
+def run_corpus(rom_dir, cycles, checkpoint, jobs=None, compiled=False):
+    roms = find_roms(rom_dir)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(run_rom, roms, [cycles] * len(roms), [checkpoint] * len(roms),
+                                [compiled] * len(roms)))
+
+    return {"cycles": cycles, "checkpoint": checkpoint, "roms": {r["rom"]: r for r in results}}
+
+
+def write_report(report, path):
+    if path.lower().endswith(".csv"):
+        with open(path, "w", newline="") as report_file:
+            writer = csv.writer(report_file)
+            writer.writerow(["rom", "rom_hash", "status", "cycles", "final_hash", "v", "i", "pc", "sp", "checkpoints"])
+            for r in report["roms"].values():
+                writer.writerow([r["rom"], r["rom_hash"], r["status"], r["cycles"], r["final_hash"],
+                                 " ".join(format(v, "02X") for v in r["v"]), r["i"], r["pc"], r["sp"],
+                                 " ".join(f"{c}:{h}" for c, h in r["checkpoints"])])
+    else:
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent=1)
+
+
+# Compare a report against a golden baseline report (JSON), returning a list of human-readable differences
+def compare(report, baseline):
+    problems = []
+    if (report["cycles"], report["checkpoint"]) != (baseline["cycles"], baseline["checkpoint"]):
+        problems.append(f"run length differs: {report['cycles']}/{report['checkpoint']} cycles/checkpoint vs "
+                        f"{baseline['cycles']}/{baseline['checkpoint']} in the baseline")
+
+    for name in sorted(set(report["roms"]) | set(baseline["roms"])):
+        new, old = report["roms"].get(name), baseline["roms"].get(name)
+        if new is None:
+            problems.append(f"{name}: missing from this run")
+            continue
+        if old is None:
+            problems.append(f"{name}: not in the baseline")
+            continue
+        if new["rom_hash"] != old["rom_hash"]:
+            problems.append(f"{name}: ROM contents changed since the baseline")
+            continue
+
+        for (cycle, new_hash), (_, old_hash) in zip(new["checkpoints"], old["checkpoints"]):
+            if new_hash != old_hash:
+                problems.append(f"{name}: framebuffer differs at cycle {cycle}")
+                break
+
+        for field in ("status", "cycles", "final_hash", "v", "i", "pc", "sp"):
+            if new[field] != old[field]:
+                problems.append(f"{name}: {field} is {new[field]}, baseline has {old[field]}")
+
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a directory of ROMs headless and check them against a baseline")
+    parser.add_argument("rom_dir", help="directory of ROMs to run")
+    length = parser.add_mutually_exclusive_group()
+    length.add_argument("--cycles", type=int, default=100000, help="instructions to run each ROM for")
+    length.add_argument("--frames", type=int, help=f"60 Hz frames to run each ROM for "
+                                                   f"({CHIP8.CYCLES_PER_TICK} instructions each)")
+    parser.add_argument("--checkpoint", type=int, default=10000, help="hash the framebuffer every N instructions")
+    parser.add_argument("--report", help="write the results here (.json or .csv)")
+    parser.add_argument("--baseline", help="golden JSON report to compare against")
+    parser.add_argument("--jobs", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--compiled", action="store_true", help="use the block engine instead of the interpreter")
+    args = parser.parse_args(argv)
+
+    cycles = args.frames * CHIP8.CYCLES_PER_TICK if args.frames is not None else args.cycles
+    report = run_corpus(args.rom_dir, cycles, args.checkpoint, args.jobs, args.compiled)
+    print(f"Ran {len(report['roms'])} ROMs for {cycles} cycles")
+
+    if args.report:
+        write_report(report, args.report)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            problems = compare(report, json.load(baseline_file))
+        for problem in problems:
+            print(problem)
+        print(f"{len(problems)} difference(s) from {args.baseline}")
+        return 1 if problems else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
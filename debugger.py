@@ -0,0 +1,580 @@
+import cmd
+
+from core import *
+from disasm import format_operands, length
+
+
+# Names a breakpoint condition can use, with the values they have on this CPU: v0-vf, i, pc, sp, dt and st
+def registers(cpu):
+    names = {f"v{r:x}": value for r, value in enumerate(cpu.v)}
+    names.update(i=cpu.i, pc=cpu.pc, sp=cpu.sp, dt=cpu.dt, st=cpu.st)
+    return names
+
+
+# Stop before the instruction at addr runs, if condition (a Python expression over the registers, like "v3 == 2 and
+# i > 0x300") holds there
+class Breakpoint:
+
+    def __init__(self, addr, condition=None):
+        self.addr = addr
+        self.condition = condition
+        self.code = None if condition is None else compile(condition, "<condition>", "eval")
+        self.hits = 0
+
+    def test(self, cpu):
+        return self.code is None or bool(eval(self.code, {"__builtins__": {}}, registers(cpu)))
+
+    def __str__(self):
+        return f"{self.addr:03X}" + ("" if self.condition is None else f" if {self.condition}")
+
+
+# Stop after an instruction reads ("r") or writes ("w") any byte in [start, end)
+class Watchpoint:
+
+    def __init__(self, start, end, kinds="w"):
+        self.start = start
+        self.end = end
+        self.kinds = kinds
+        self.hits = 0
+
+    def __str__(self):
+        return f"{self.start:03X}-{self.end - 1:03X} ({self.kinds})"
+
+
+# Memory with its reads and writes reported to a debugger, swapped in for a machine's Memory (by changing its class)
+# only while that debugger has watchpoints. Swapping the class puts every data read and write the machine makes
+# through these methods, not just the ones in watched ranges; each first looks its bytes up in the debugger's maps of
+# watched addresses (Debugger.reads and writes), so one outside every watchpoint costs a lookup and a branch on top
+# of the plain Memory method. Instruction fetches (read16) and the decoded cache aren't watched, and neither are the
+# handful of places that go to mem directly to look for code: idle loops and block compilation
+# Debugger.watch makes a subclass per debugger, with the debugger as a class attribute, since Memory has no room for
+# one more field
+class WatchedMemory(Memory):
+
+    __slots__ = ()
+
+    debugger = None
+
+    def read8(self, addr):
+        if self.debugger.reads[addr]:
+            self.debugger.touch(addr, addr + 1, "r")
+        return Memory.read8(self, addr)
+
+    def read(self, addr, length):
+        if self.debugger.reads.find(1, addr, addr + length) != -1:
+            self.debugger.touch(addr, addr + length, "r")
+        return Memory.read(self, addr, length)
+
+    def sprite(self, addr, length):
+        if self.debugger.reads.find(1, addr, addr + length) != -1:
+            self.debugger.touch(addr, addr + length, "r")
+        return Memory.sprite(self, addr, length)
+
+    # Writes are reported once they're done, so they're invalidated in the real caches even if the debugger halts
+    def write8(self, addr, data):
+        Memory.write8(self, addr, data)
+        if self.debugger.writes[addr]:
+            self.debugger.touch(addr, addr + 1, "w")
+
+    def write16(self, addr, data):
+        Memory.write16(self, addr, data)
+        if self.debugger.writes.find(1, addr, addr + 2) != -1:
+            self.debugger.touch(addr, addr + 2, "w")
+
+    def load(self, addr, data):
+        Memory.load(self, addr, data)
+        if self.debugger.writes.find(1, addr, addr + len(data)) != -1:
+            self.debugger.touch(addr, addr + len(data), "w")
+
+
+# Stands in for a cache (Memory.decoded or BlockEngine.blocks) while a debugger is halting the machine: every lookup
+# finds the same entry, so whatever address the program goes to next stops it. Changes go through to the real cache
+class Halted:
+
+    def __init__(self, cache, entry):
+        self.cache = cache
+        self.entry = entry
+
+    def __getitem__(self, key):
+        return self.entry
+
+    def get(self, key, default=None):
+        return self.entry
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+
+    def pop(self, key):
+        return self.cache.pop(key)
+
+    def __len__(self):
+        return len(self.cache)
+
+
+# Breakpoints, watchpoints and stepping for a running machine, which can be attached and detached at any time without
+# restarting it. Nothing is hooked that isn't in use, so a machine with no breakpoints or watchpoints runs exactly as
+# fast as one without a debugger:
+#   A breakpoint replaces the decoded entry (see Memory.decoded) at its address with one for Op.BREAK, whose handler
+#   checks the condition and either stops there or runs the real instruction. While there are any, writes that drop
+#   the entry re-arm it (see rearm), the block engine ends its blocks before breakpoints so they're interpreted, and
+#   idle loops aren't skipped
+#   Watchpoints swap the machine's Memory for a WatchedMemory, until the last one is removed. That slows every data
+#   read and write a little while any watchpoint is set, not only those in the watched ranges
+#   Pausing (from anywhere: another thread, a signal handler, a watchpoint halfway through an instruction) swaps the
+#   decoded cache, and the block cache of a compiled machine, for Halted ones, and stops idle loops being skipped. The
+#   next instruction fetched, wherever it is, stops the machine and puts the real caches back
+# Breakpoints and watchpoints stay with the debugger when it's detached, and are set again by the next attach
+# A stopped machine's engine returns False, so CHIP8.play hands over to interact, which runs the console and carries
+# on when it returns. Anything else driving the machine can check stop after the engine returns instead
+class Debugger:
+
+    def __init__(self):
+        self.chip8 = None
+        self.breakpoints = {}   # address -> Breakpoint
+        self.watchpoints = []
+        self.reads = bytearray()    # 1 for every address a watchpoint on reads covers, 0 elsewhere
+        self.writes = bytearray()   # and the same for writes
+        self.until = None       # (address, stack pointer) to stop at for step_over and finish
+        self.stop = None        # why the machine stopped, or None while it runs
+        self.break_pc = None    # where the last breakpoint (or until) stopped it, so carrying on runs that instruction
+        self.resume_pc = None   # the breakpoint to run through once, rather than stopping on it again
+        self.halted = False
+        self.console = None
+
+    def attach(self, chip8):
+        self.chip8 = chip8
+        self.memory_class = chip8.mem.__class__
+        self.decoded = chip8.mem.decoded
+        self.block_cache = None if chip8.blocks is None else chip8.blocks.blocks
+        self.skip_idle = chip8.skip_idle
+        self.halt_entry = (self.halt_trap, Op.BREAK, 0, 0, 0, 0, 0, 0)
+        chip8.debugger = self
+        for addr in self.armed():
+            self.arm(addr)
+        if self.watchpoints:
+            self.watch_memory()
+
+    # Take every hook out and let the machine run on as it was
+    def detach(self):
+        chip8 = self.chip8
+        self.unhalt()
+        # Take the traps out as if there were no breakpoints, then keep the breakpoints for the next attach
+        breakpoints = self.breakpoints
+        armed = self.armed()
+        self.breakpoints = {}
+        self.until = None
+        for addr in armed:
+            self.arm(addr)
+        self.breakpoints = breakpoints
+        chip8.mem.__class__ = self.memory_class
+        chip8.skip_idle = self.skip_idle
+        chip8.debugger = None
+        self.chip8 = None
+        self.stop = None
+
+    # Breakpoints
+
+    def break_at(self, addr, condition=None):
+        if self.chip8 is not None and not 0 <= addr < len(self.chip8.mem.mem) - 1:
+            raise ValueError(f"{addr:03X} is outside memory")
+        breakpoint = self.breakpoints[addr] = Breakpoint(addr, condition)
+        if self.chip8 is not None:
+            self.arm(addr)
+        return breakpoint
+
+    def delete(self, addr):
+        del self.breakpoints[addr]
+        if self.chip8 is not None:
+            self.arm(addr)
+
+    def armed(self):
+        addresses = set(self.breakpoints)
+        if self.until is not None:
+            addresses.add(self.until[0])
+        return addresses
+
+    # Put the trap at addr in or take it out, whichever it should be now
+    # rearm only watches memory writes while there's a trap to re-arm
+    def arm(self, addr):
+        chip8 = self.chip8
+        armed = self.armed()
+        invalidators = chip8.mem.invalidators
+        if armed and self.rearm not in invalidators:
+            invalidators.append(self.rearm)
+        elif not armed and self.rearm in invalidators:
+            invalidators.remove(self.rearm)
+        if addr in armed:
+            self.decoded[addr] = (self.trap, Op.BREAK) + CPU.predecode(chip8.mem.read16(addr))[2:]
+        else:
+            self.decoded[addr] = None
+        if chip8.blocks is not None:
+            if addr in armed:
+                chip8.blocks.stops.add(addr)
+            else:
+                chip8.blocks.stops.discard(addr)
+            chip8.blocks.invalidate(addr, addr + 1)
+        chip8.skip_idle = self.skip_idle and not armed
+
+    # Memory invalidator: a write dropped the decoded entries for [start - 1, end), which may have been traps
+    def rearm(self, start, end):
+        decoded = self.decoded
+        for addr in self.armed():
+            if start - 1 <= addr < end and decoded[addr] is None:
+                decoded[addr] = (self.trap, Op.BREAK) + CPU.predecode(self.chip8.mem.read16(addr))[2:]
+
+    # Handler for the decoded entry at a breakpoint, run in place of the instruction there
+    def trap(self, cpu, memory, display, x, y, kk, n, nnn):
+        pc = cpu.pc
+        if pc == self.resume_pc:
+            self.resume_pc = self.break_pc = None
+        elif self.until is not None and self.until == (pc, cpu.sp):
+            self.stopped(pc, f"stopped at {pc:03X}")
+            return None
+        else:
+            breakpoint = self.breakpoints.get(pc)
+            if breakpoint is not None and breakpoint.test(cpu):
+                breakpoint.hits += 1
+                self.stopped(pc, f"breakpoint {breakpoint}")
+                return None
+
+        handler, cpu.op = CPU.predecode(memory.read16(pc))[:2]
+        return handler(cpu, memory, display, x, y, kk, n, nnn)
+
+    def stopped(self, pc, reason):
+        self.stop = reason
+        self.break_pc = pc
+        if self.until is not None:
+            addr = self.until[0]
+            self.until = None
+            self.arm(addr)
+
+    # Watchpoints
+
+    def watch(self, start, size=1, kinds="w"):
+        if self.chip8 is not None and not 0 <= start < start + size <= len(self.chip8.mem.mem):
+            raise ValueError(f"{size} bytes at {start:03X} aren't all in memory")
+        if not kinds or set(kinds) - set("rw"):
+            raise ValueError(f"watchpoints are for reads (r), writes (w) or both (rw), not {kinds!r}")
+        watchpoint = Watchpoint(start, start + size, kinds)
+        self.watchpoints.append(watchpoint)
+        if self.chip8 is not None:
+            self.watch_memory()
+        return watchpoint
+
+    # Remove the watchpoints starting at start
+    def unwatch(self, start):
+        self.watchpoints = [watchpoint for watchpoint in self.watchpoints if watchpoint.start != start]
+        if self.chip8 is not None:
+            if self.watchpoints:
+                self.watch_memory()
+            else:
+                self.chip8.mem.__class__ = self.memory_class
+
+    # Map the watched addresses and make sure the machine's memory is watched
+    def watch_memory(self):
+        memory = self.chip8.mem
+        self.reads = bytearray(len(memory.mem))
+        self.writes = bytearray(len(memory.mem))
+        for watchpoint in self.watchpoints:
+            covered = b"\x01" * (watchpoint.end - watchpoint.start)
+            if "r" in watchpoint.kinds:
+                self.reads[watchpoint.start:watchpoint.end] = covered
+            if "w" in watchpoint.kinds:
+                self.writes[watchpoint.start:watchpoint.end] = covered
+        if not isinstance(memory, WatchedMemory):
+            memory.__class__ = type("WatchedMemory", (WatchedMemory, self.memory_class),
+                                    {"__slots__": (), "debugger": self})
+
+    # Called by WatchedMemory with every range [start, end) an instruction reads or writes
+    def touch(self, start, end, kind):
+        for watchpoint in self.watchpoints:
+            if kind in watchpoint.kinds and start < watchpoint.end and watchpoint.start < end:
+                watchpoint.hits += 1
+                # A compiled block only updates pc when it finishes, so there this is the start of the block
+                action = "read" if kind == "r" else "written"
+                self.pause(f"watchpoint {watchpoint} {action} by the instruction at {self.chip8.cpu.pc:03X}")
+                return
+
+    # Running
+
+    # Stop the machine before its next instruction. Safe to call from another thread or a signal handler
+    # Idle loops aren't skipped while halted, or a program sitting in one would never fetch that instruction
+    def pause(self, reason="paused"):
+        if self.stop is not None:
+            return
+        self.stop = reason
+        self.break_pc = None
+        if not self.halted:
+            self.halted = True
+            chip8 = self.chip8
+            chip8.mem.decoded = Halted(self.decoded, self.halt_entry)
+            if self.block_cache is not None:
+                chip8.blocks.blocks = Halted(self.block_cache, False)
+            chip8.skip_idle = False
+
+    def unhalt(self):
+        if self.halted:
+            self.halted = False
+            chip8 = self.chip8
+            chip8.mem.decoded = self.decoded
+            if self.block_cache is not None:
+                chip8.blocks.blocks = self.block_cache
+            chip8.skip_idle = self.skip_idle and not self.armed()
+
+    # Handler for every address while halted
+    def halt_trap(self, cpu, memory, display, x, y, kk, n, nnn):
+        self.unhalt()
+        return None
+
+    # Let the machine carry on from where it stopped, running the instruction there even if it's a breakpoint
+    def resume(self):
+        self.unhalt()
+        self.stop = None
+        self.resume_pc = self.break_pc if self.break_pc == self.chip8.cpu.pc else None
+
+    # Run count instructions through the interpreter, stopping early at a breakpoint or watchpoint, or if the program
+    # halts or waits for a key. Returns the number run
+    def step(self, count=1):
+        chip8 = self.chip8
+        executed = 0
+        while executed < count:
+            self.resume()
+            if not chip8.run(1):
+                break
+            executed += 1
+            if self.stop is not None:
+                break
+        return executed
+
+    # Step over a CALL, stopping when it returns; anything else is a single step. Returns True if the caller has to
+    # run the machine on (as after continuing) to get to the return
+    def step_over(self):
+        cpu = self.chip8.cpu
+        if Operator.lookup(self.chip8.mem.read16(cpu.pc)) is not Op.CALL:
+            self.step()
+            return False
+        self.run_until(cpu.pc + 2, cpu.sp)
+        return True
+
+    # Set the machine running until the current subroutine returns. Returns False if it isn't in one
+    def finish(self):
+        cpu = self.chip8.cpu
+        if cpu.sp == 0:
+            return False
+        self.run_until(cpu.stack[cpu.sp - 1], cpu.sp - 1)
+        return True
+
+    def run_until(self, addr, sp):
+        previous = self.until
+        self.until = (addr, sp)
+        if previous is not None:
+            self.arm(previous[0])
+        self.arm(addr)
+        self.resume()
+
+    # Hand over to the console, returning True to carry on running or False to quit
+    def interact(self):
+        if self.console is None:
+            self.console = Console(self)
+        return self.console.interact()
+
+    # Inspection
+
+    def registers(self):
+        return registers(self.chip8.cpu)
+
+    # Lines of a hex dump of size bytes from start, 16 to a line
+    def dump(self, start, size=64):
+        mem = self.chip8.mem.mem
+        lines = []
+        for addr in range(start, min(start + size, len(mem)), 16):
+            row = mem[addr:min(addr + 16, start + size, len(mem))]
+            lines.append(f"{addr:03X}: {row.hex(' ').upper():<47}  "
+                         f"{''.join(chr(b) if 0x20 <= b < 0x7F else '.' for b in row)}")
+        return lines
+
+    # Lines of a disassembly of count instructions from start, marking pc and the breakpoints
+    def listing(self, start, count=8):
+        mem = self.chip8.mem
+        lines = []
+        addr = start
+        for _ in range(count):
+            if addr + 1 >= len(mem.mem):
+                break
+            opcode = mem.read16(addr)
+            op = Operator.lookup(opcode)
+            long = mem.read16(addr + 2) if op is Op.LDIL and addr + 3 < len(mem.mem) else None
+            mark = ("=>" if addr == self.chip8.cpu.pc else "  ") + ("*" if addr in self.breakpoints else " ")
+            lines.append(f"{mark} {addr:03X}: {opcode:04X}  {op.name:<6} {format_operands(op, opcode, long)}")
+            addr += length(opcode)
+        return lines
+
+
+# Parse a number for the console: hex, with or without 0x
+def parse_number(text):
+    return int(text, 16)
+
+
+def parse_key(text):
+    key = parse_number(text)
+    if not 0 <= key <= 0xF:
+        raise ValueError(f"there is no key {text}")
+    return key
+
+
+# The interactive console: a gdb-like prompt on stdin whenever the debugger stops the machine
+# Addresses and lengths are hex. An empty line repeats the last command, so stepping is one key after the first
+class Console(cmd.Cmd):
+
+    prompt = "(chip8) "
+
+    def __init__(self, debugger):
+        super().__init__()
+        self.debugger = debugger
+        self.go = True
+
+    def interact(self):
+        debugger = self.debugger
+        print(debugger.stop)
+        self.show_waiting()
+        self.show_pc()
+        debugger.chip8.display.present()
+        self.go = True
+        self.cmdloop()
+        return self.go
+
+    def show_waiting(self):
+        cpu = self.debugger.chip8.cpu
+        if cpu.waiting is not None:
+            print(f"waiting for a key (LDKP into V{cpu.waiting:X}); press one and continue")
+
+    def show_pc(self):
+        print(self.debugger.listing(self.debugger.chip8.cpu.pc, 1)[0])
+
+    def onecmd(self, line):
+        try:
+            return super().onecmd(line)
+        except (ValueError, KeyError, IndexError, SyntaxError) as error:
+            print(f"error: {error}")
+            return False
+
+    def emptyline(self):
+        if self.lastcmd.split()[:1] in (["step"], ["s"], ["next"], ["n"], ["x"], ["list"], ["l"]):
+            return self.onecmd(self.lastcmd)
+        return False
+
+    # Show where a synchronous step left the machine
+    def after_step(self, executed):
+        debugger = self.debugger
+        cpu = debugger.chip8.cpu
+        debugger.chip8.display.present()
+        if debugger.stop is not None:
+            print(debugger.stop)
+        elif cpu.waiting is not None:
+            self.show_waiting()
+        elif executed == 0:
+            print("the program has stopped")
+        self.show_pc()
+
+    def do_break(self, arg):
+        "break ADDR [if CONDITION]: stop before ADDR runs, when CONDITION (Python over v0-vf, i, pc, sp, dt, st) holds"
+        addr, _, condition = arg.partition(" if ")
+        breakpoint = self.debugger.break_at(parse_number(addr.strip()), condition.strip() or None)
+        print(f"breakpoint {breakpoint}")
+
+    def do_delete(self, arg):
+        "delete [ADDR]: remove the breakpoint at ADDR, or all of them"
+        addresses = [parse_number(arg)] if arg else list(self.debugger.breakpoints)
+        for addr in addresses:
+            if addr not in self.debugger.breakpoints:
+                raise ValueError(f"no breakpoint at {addr:03X}")
+            self.debugger.delete(addr)
+
+    def do_watch(self, arg):
+        "watch ADDR [LEN] [r|w|rw]: stop after an instruction reads or writes (default w) LEN (default 1) bytes at ADDR"
+        args = arg.split()
+        kinds = args.pop() if args and args[-1] in ("r", "w", "rw", "wr") else "w"
+        size = parse_number(args[1]) if len(args) > 1 else 1
+        print(f"watchpoint {self.debugger.watch(parse_number(args[0]), size, kinds)}")
+
+    def do_unwatch(self, arg):
+        "unwatch [ADDR]: remove the watchpoints starting at ADDR, or all of them"
+        starts = [parse_number(arg)] if arg else [watchpoint.start for watchpoint in self.debugger.watchpoints]
+        for start in starts:
+            self.debugger.unwatch(start)
+
+    def do_info(self, arg):
+        "info: list the breakpoints and watchpoints"
+        debugger = self.debugger
+        for breakpoint in debugger.breakpoints.values():
+            print(f"breakpoint {breakpoint}, hit {breakpoint.hits} times")
+        for watchpoint in debugger.watchpoints:
+            print(f"watchpoint {watchpoint}, hit {watchpoint.hits} times")
+        if not debugger.breakpoints and not debugger.watchpoints:
+            print("no breakpoints or watchpoints")
+
+    def do_continue(self, arg):
+        "continue: run on until a breakpoint or watchpoint, or the program ends"
+        self.debugger.resume()
+        return True
+
+    def do_step(self, arg):
+        "step [N]: run N (default 1) instructions"
+        self.after_step(self.debugger.step(int(arg) if arg else 1))
+
+    def do_next(self, arg):
+        "next: step, running a CALL through to its return"
+        if self.debugger.step_over():
+            return True
+        self.after_step(1)
+
+    def do_finish(self, arg):
+        "finish: run until the current subroutine returns"
+        if self.debugger.finish():
+            return True
+        print("not in a subroutine")
+
+    def do_regs(self, arg):
+        "regs: show the registers, timers and stack"
+        cpu = self.debugger.chip8.cpu
+        print(" ".join(f"V{r:X}={value:02X}" for r, value in enumerate(cpu.v)))
+        print(f"I={cpu.i:03X} PC={cpu.pc:03X} SP={cpu.sp} DT={cpu.dt} ST={cpu.st}  "
+              f"stack: {' '.join(f'{addr:03X}' for addr in cpu.stack[:cpu.sp]) or 'empty'}")
+
+    def do_x(self, arg):
+        "x [ADDR] [LEN]: dump LEN (default 40) bytes of memory at ADDR (default I)"
+        args = arg.split()
+        start = parse_number(args[0]) if args else self.debugger.chip8.cpu.i
+        for line in self.debugger.dump(start, parse_number(args[1]) if len(args) > 1 else 0x40):
+            print(line)
+
+    def do_list(self, arg):
+        "list [ADDR] [N]: disassemble N (default 8) instructions from ADDR (default PC)"
+        args = arg.split()
+        start = parse_number(args[0]) if args else self.debugger.chip8.cpu.pc
+        for line in self.debugger.listing(start, int(args[1]) if len(args) > 1 else 8):
+            print(line)
+
+    def do_press(self, arg):
+        "press KEY: hold a keypad key (0-F) down"
+        self.debugger.chip8.keypad.press(parse_key(arg))
+
+    def do_release(self, arg):
+        "release KEY: let a keypad key (0-F) go"
+        self.debugger.chip8.keypad.release(parse_key(arg))
+
+    def do_quit(self, arg):
+        "quit: stop the program"
+        self.go = False
+        return True
+
+    def do_EOF(self, arg):
+        print()
+        return self.do_quit(arg)
+
+    do_b = do_break
+    do_c = do_continue
+    do_s = do_step
+    do_n = do_next
+    do_l = do_list
+    do_q = do_quit
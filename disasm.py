@@ -0,0 +1,346 @@
+import argparse
+import bisect
+import hashlib
+import json
+import os
+
+from core import *
+
+
+ANALYSIS_VERSION = 2    # bump whenever the analysis changes, so stale cache entries are ignored
+CACHE_DIR = os.environ.get("CHIP8_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "chip8", "disasm"))
+
+# Instructions that end a basic block; everything else falls through to the next instruction
+SKIP_OPS = {Op.SE, Op.SNE, Op.SER, Op.SNER, Op.SKP, Op.SKNP}
+END_OPS = {Op.JP, Op.CALL, Op.RET, Op.JPO, Op.EXIT, Op.NONE} | SKIP_OPS
+
+# Operand layout for the listing; CPU.TRACE_ARGS plus the ops the trace doesn't show arguments for
+OPERANDS = {
+    **CPU.TRACE_ARGS,
+    Op.DRW: "xyn", Op.SKP: "x", Op.SKNP: "x", Op.LDKP: "x", Op.LDS: "x", Op.LDBCD: "x", Op.LDIR: "x", Op.LDRI: "x",
+}
+
+
+# Bytes taken by the instruction with this opcode: XO-CHIP's F000 NNNN is the only four byte one
+def length(opcode):
+    return 4 if opcode == 0xF000 else 2
+
+
+def rom_hash(rom):
+    return hashlib.blake2b(rom, digest_size=16).hexdigest()
+
+
+# Where control can go after the instruction at addr, as (target, kind) pairs
+# kind is "fall" (next instruction), "jump", "skip" (the instruction after next) or "return" (back from a CALL)
+# A skip needs the opcode after it (next_opcode), since skipping an F000 NNNN skips all four bytes
+def successors(addr, opcode, op, next_opcode=None):
+    if op is Op.JP:
+        return [(Operator.nnn(opcode), "jump")]
+    elif op is Op.CALL:
+        return [(addr + 2, "return")]
+    elif op in SKIP_OPS:
+        return [(addr + 2, "fall"), (addr + 2 + length(next_opcode), "skip")]
+    elif op in (Op.RET, Op.JPO, Op.EXIT, Op.NONE):
+        return []
+    return [(addr + length(opcode), "fall")]
+
+
+# long is the NNNN after an F000 (LDIL)
+def format_operands(op, opcode, long=None):
+    kind = OPERANDS.get(op, "")
+    x = f"V{Operator.x(opcode):X}"
+    y = f"V{Operator.y(opcode):X}"
+
+    if kind == "nnn": return f"{Operator.nnn(opcode):03X}" + (" + V0" if op is Op.JPO else "")
+    elif kind == "xkk": return f"{x}, {Operator.kk(opcode):02X}"
+    elif kind == "xy": return f"{x}, {y}"
+    elif kind == "xyn": return f"{x}, {y}, {Operator.n(opcode)}"
+    elif kind in ("x", "bcd"): return x
+    elif kind == "n": return str(Operator.n(opcode))
+    elif op is Op.LDIL and long is not None: return f"{long:04X}"
+    return ""
+
+
+# A straight-line run of instructions with a single entry at start
+class Block:
+
+    def __init__(self, start, end, successors):
+        self.start = start              # address of the first instruction
+        self.end = end                  # address just past the last instruction
+        self.successors = successors    # [(target, kind)], see successors()
+
+    def __repr__(self):
+        return f"Block({self.start:03X}-{self.end:03X})"
+
+
+# The result of disassembling a ROM: its instructions, basic blocks, control-flow edges and subroutines
+# Code is found by following control flow from the entry point, so bytes that are never reached are data. A JPO can
+# go anywhere from its base address to 0xFF past it, so it ends its block with no known successors and the bytes it
+# might land on are marked "unknown" rather than data
+class Analysis:
+
+    def __init__(self, rom_hash, origin, size, instructions, blocks, calls, indirect, data_refs):
+        self.rom_hash = rom_hash
+        self.origin = origin
+        self.size = size
+        self.instructions = instructions    # address -> opcode, for every reachable instruction
+        self.blocks = blocks                # start address -> Block
+        self.calls = calls                  # [(address of the CALL, subroutine address)]
+        self.indirect = indirect            # addresses of JPO instructions
+        self.data_refs = data_refs          # addresses loaded into I, which are usually sprites or tables
+
+        self.starts = sorted(blocks)
+        self.predecessors_of = {}
+        for block in blocks.values():
+            for target, kind in block.successors:
+                self.predecessors_of.setdefault(target, []).append((block.start, kind))
+
+        self.subroutines = {}   # entry address -> sorted block starts reachable from it without following CALLs
+        for entry in [origin] + sorted({target for _, target in calls}):
+            if entry in blocks:
+                self.subroutines[entry] = self.reachable(entry)
+
+    def reachable(self, entry):
+        seen = {entry}
+        work = [entry]
+        while work:
+            for target, kind in self.blocks[work.pop()].successors:
+                if target in self.blocks and target not in seen:
+                    seen.add(target)
+                    work.append(target)
+        return sorted(seen)
+
+    def op_at(self, addr):
+        opcode = self.instructions.get(addr)
+        return None if opcode is None else Operator.lookup(opcode)
+
+    # The block holding the instruction at addr, or None
+    def block_at(self, addr):
+        index = bisect.bisect_right(self.starts, addr) - 1
+        while index >= 0:
+            block = self.blocks[self.starts[index]]
+            if block.start <= addr < block.end:
+                return block
+            if block.end <= addr:
+                return None
+            index -= 1
+        return None
+
+    def successors(self, start):
+        return self.blocks[start].successors
+
+    def predecessors(self, start):
+        return self.predecessors_of.get(start, [])
+
+    # Every (source block, target, kind) edge of the control-flow graph
+    def edges(self):
+        return [(block.start, target, kind) for block in self.blocks.values() for target, kind in block.successors]
+
+    # Entry addresses of the subroutines whose body holds addr
+    def subroutines_containing(self, addr):
+        block = self.block_at(addr)
+        if block is None:
+            return []
+        return [entry for entry, starts in self.subroutines.items() if block.start in starts]
+
+    # "code", "data" or "unknown" (possibly reached through a JPO) for a byte of the ROM
+    def classify(self, addr):
+        if addr in self.instructions or addr - 1 in self.instructions:
+            return "code"
+        if self.instructions.get(addr - 2) == 0xF000 or self.instructions.get(addr - 3) == 0xF000:
+            return "code"   # the address half of an LDIL
+        for jpo in self.indirect:
+            base = Operator.nnn(self.instructions[jpo])
+            if base <= addr <= base + 0xFF + 1:
+                return "unknown"
+        return "data"
+
+    def listing(self, rom):
+        labels = {start: f"L_{start:03X}" for start in self.blocks}
+        labels.update({entry: f"sub_{entry:03X}" for entry in self.subroutines})
+        labels.update({addr: f"data_{addr:03X}" for addr in self.data_refs if addr not in labels})
+
+        lines = []
+        data = []
+        addr = self.origin
+        end = self.origin + self.size
+
+        def flush_data():
+            if data:
+                start = addr - len(data)
+                kind = self.classify(start)
+                lines.append(f"  {start:03X}: {' '.join(f'{b:02X}' for b in data):<24}  db  ; {kind}")
+                data.clear()
+
+        while addr < end:
+            if addr in labels:
+                flush_data()
+                lines.append(f"{labels[addr]}:")
+
+            opcode = self.instructions.get(addr)
+            if opcode is None:
+                if data and (len(data) == 8 or self.classify(addr) != self.classify(addr - len(data))):
+                    flush_data()
+                data.append(rom[addr - self.origin])
+                addr += 1
+                continue
+
+            flush_data()
+            op = Operator.lookup(opcode)
+            target = Operator.nnn(opcode)
+            long = None
+            if op is Op.LDIL:
+                target = long = int.from_bytes(rom[addr - self.origin + 2:addr - self.origin + 4], "big")
+            line = f"  {addr:03X}: {opcode:04X}  {op.name:<6} {format_operands(op, opcode, long)}"
+            if op in (Op.JP, Op.CALL, Op.LDI, Op.LDIL) and target in labels:
+                line = f"{line:<36}; {labels[target]}"
+            lines.append(line)
+            addr += length(opcode)
+
+        flush_data()
+        return lines
+
+    def to_json(self):
+        return {
+            "version": ANALYSIS_VERSION,
+            "rom_hash": self.rom_hash,
+            "origin": self.origin,
+            "size": self.size,
+            "instructions": sorted(self.instructions.items()),
+            "blocks": [[b.start, b.end, b.successors] for b in self.blocks.values()],
+            "calls": self.calls,
+            "indirect": self.indirect,
+            "data_refs": self.data_refs,
+        }
+
+    @staticmethod
+    def from_json(data):
+        blocks = {start: Block(start, end, [tuple(s) for s in succs]) for start, end, succs in data["blocks"]}
+        return Analysis(data["rom_hash"], data["origin"], data["size"], dict(data["instructions"]), blocks,
+                        [tuple(c) for c in data["calls"]], data["indirect"], data["data_refs"])
+
+
+# Disassemble a ROM by following every path from origin
+def analyze(rom, origin=PGM_MEM_START):
+    end = origin + len(rom)
+    instructions = {}
+    leaders = {origin}
+    calls = []
+    indirect = []
+    data_refs = set()
+
+    def fetch(addr):
+        return (rom[addr - origin] << 8) | rom[addr - origin + 1] if origin <= addr <= end - 2 else None
+
+    work = [origin]
+    while work:
+        addr = work.pop()
+        opcode = fetch(addr)
+        if addr in instructions or opcode is None or addr + length(opcode) > end:
+            continue
+
+        op = Operator.lookup(opcode)
+        instructions[addr] = opcode
+
+        if op is Op.CALL:
+            calls.append((addr, Operator.nnn(opcode)))
+            leaders.add(Operator.nnn(opcode))
+            work.append(Operator.nnn(opcode))
+        elif op is Op.JPO:
+            indirect.append(addr)
+        elif op is Op.LDI:
+            data_refs.add(Operator.nnn(opcode))
+        elif op is Op.LDIL:
+            data_refs.add(fetch(addr + 2))
+
+        for target, kind in successors(addr, opcode, op, fetch(addr + 2)):
+            if op in END_OPS:
+                leaders.add(target)
+            work.append(target)
+
+    blocks = {}
+    for start in sorted(leaders):
+        if start not in instructions:
+            continue
+        addr = start
+        while True:
+            opcode = instructions[addr]
+            op = Operator.lookup(opcode)
+            if op in END_OPS:
+                succs = successors(addr, opcode, op, fetch(addr + 2))
+                addr += 2
+                break
+            addr += length(opcode)
+            if addr in leaders or addr not in instructions:
+                succs = [(addr, "fall")] if addr in instructions else []
+                break
+        blocks[start] = Block(start, addr, succs)
+
+    data_refs = sorted(ref for ref in data_refs if origin <= ref < end and ref not in instructions)
+    return Analysis(rom_hash(rom), origin, len(rom), instructions, blocks, sorted(calls), sorted(indirect), data_refs)
+
+
+# The analysis of a ROM, from the on-disk cache if it was analyzed before
+# Entries are keyed by the hash of the ROM's contents, so a renamed or copied ROM still hits and an edited one misses
+def load(rom, origin=PGM_MEM_START, cache_dir=CACHE_DIR, use_cache=True):
+    key = rom_hash(rom)
+    path = os.path.join(cache_dir, f"{key}-{origin:03x}.json")
+
+    if use_cache:
+        try:
+            with open(path) as cache_file:
+                data = json.load(cache_file)
+            if data.get("version") == ANALYSIS_VERSION and data.get("rom_hash") == key:
+                return Analysis.from_json(data)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    analysis = analyze(rom, origin)
+    if use_cache:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file and rename it, so a concurrent reader never sees half an entry
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as cache_file:
+                json.dump(analysis.to_json(), cache_file)
+            os.replace(temp_path, path)
+        except OSError:
+            pass    # a read-only or missing cache only costs time
+
+    return analysis
+
+
+def load_file(path, **kwargs):
+    with open(path, "rb") as rom_file:
+        return load(rom_file.read(), **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Disassemble a CHIP-8 ROM and show its control flow")
+    parser.add_argument("rom")
+    parser.add_argument("--blocks", action="store_true", help="list basic blocks and their edges instead")
+    parser.add_argument("--subroutines", action="store_true", help="list subroutines and the blocks in them instead")
+    parser.add_argument("--no-cache", action="store_true", help="always re-analyze, and don't save the result")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help=f"where analyses are cached (default {CACHE_DIR})")
+    args = parser.parse_args(argv)
+
+    with open(args.rom, "rb") as rom_file:
+        rom = rom_file.read()
+    analysis = load(rom, cache_dir=args.cache_dir, use_cache=not args.no_cache)
+
+    if args.blocks:
+        for block in analysis.blocks.values():
+            succs = ", ".join(f"{kind} {target:03X}" for target, kind in block.successors) or "none"
+            preds = ", ".join(f"{source:03X}" for source, _ in analysis.predecessors(block.start)) or "none"
+            print(f"{block.start:03X}-{block.end - 2:03X}  to: {succs}  from: {preds}")
+    elif args.subroutines:
+        for entry, starts in analysis.subroutines.items():
+            callers = ", ".join(f"{site:03X}" for site, target in analysis.calls if target == entry) or "entry point"
+            print(f"sub_{entry:03X}  blocks: {' '.join(f'{s:03X}' for s in starts)}  called from: {callers}")
+    else:
+        for line in analysis.listing(rom):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,116 +1,132 @@
 import pygame
 import sys
 
+from backend import *
 from colors import *
 from sprites import *
 
 SCALE_FACTOR = 10
-NATIVE_WIDTH = 64
-NATIVE_HEIGHT = 32
 
 DISPLAY_WIDTH = NATIVE_WIDTH * SCALE_FACTOR
 DISPLAY_HEIGHT = NATIVE_HEIGHT * SCALE_FACTOR
 DISPLAY_SIZE = DISPLAY_WIDTH, DISPLAY_HEIGHT
 
 
-class Pixel:
-
-    def __init__(self, x, y, on_color=WHITE, scale_factor=SCALE_FACTOR):
-        self.x = x
-        self.y = y
-        self.sf = scale_factor
-        # pygame Rect objects use x, y, width, height, so specify our pixel coordinates and the pixel width/height
-        self.rect = pygame.Rect(self.x * self.sf, self.y * self.sf, self.sf, self.sf)
-        self.state = 0  # initialize to black
-        self.on_color = on_color
-
-    def set(self):
-        self.state = 1
-
-    def clear(self):
-        self.state = 0
-
-    def toggle(self):
-        self.state = not self.state
-
-    def set_color(self, color):
-        self.on_color = color
-
-    def draw(self, screen):
-        self.rect = pygame.Rect(self.x * self.sf, self.y * self.sf, self.sf, self.sf)
-        pygame.draw.rect(screen, self.on_color if self.state else BLACK, self.rect)
-
-
-class Display:
-
-    def __init__(self, width, height, scale_factor=SCALE_FACTOR):
-        self.width = width
-        self.height = height
-        self.scale_factor = scale_factor
-        self.screen = pygame.display.set_mode((self.width * self.scale_factor, self.height * self.scale_factor))
-        self.pixels = self.create_pixels()
-
-    def get_pixel(self, x, y):
-        if 0 <= x < self.width:
-            if 0 <= y < self.height:
-                return self.pixels[x][y]
-            else:
-                print(f"Invalid y coord of {y} (max is {self.height - 1})")
-        else:
-            print(f"Invalid x coord of {x} (max is {self.width -1})")
+# pygame window backend
+# The framebuffer rows are unpacked into a width x height 8-bit surface whose palette maps each pixel's color (0-3, see
+# get_row) to an RGB color, then scaled up in one go. Only the rows that changed since the last present get copied,
+# blitted and updated, so a frame costs the same however many pixels there are. The window keeps its size when the
+# program switches resolution; the scale factor changes instead
+# With a post-processing stage (post, see phosphor.py) every frame goes through it whole instead, as an RGB image
+class Display(DisplayBackend):
+
+    def __init__(self, width, height, scale_factor=SCALE_FACTOR, on_color=WHITE, colors=(RED, BLUE), post=None):
+        self.screen = pygame.display.set_mode((width * scale_factor, height * scale_factor))
+        # Off, on, then the colors of XO-CHIP's second plane alone and of both planes
+        self.palette = [BLACK, on_color, *colors] + [BLACK] * 252
+        self.post = post
+        super().__init__(width, height)
+        self.draw_all()
+
+    def resize(self, width, height):
+        super().resize(width, height)
+        self.scale_factor = self.screen.get_width() // width
+        self.surface = pygame.Surface((width, height), depth=8)
+        self.surface.set_palette(self.palette)
+        self.scaled = pygame.Surface(self.screen.get_size(), depth=8)
+        self.scaled.set_palette(self.palette)
+        self.start_post()
+
+    # Switch the post-processing stage (None for none), starting it from the current framebuffer
+    def set_post(self, post):
+        self.post = post
+        self.start_post()
+        self.draw_all()
+
+    # Reset the post-processing stage for the current resolution, with RGB surfaces for its output
+    def start_post(self):
+        if self.post is not None:
+            self.post.reset(self.width, self.height)
+            self.image = pygame.Surface((self.width, self.height), depth=24)
+            self.scaled_image = pygame.Surface(self.screen.get_size(), depth=24)
 
     def get_screen(self):
         return self.screen
 
-    # Draw the given sprite to the screen starting at the given x and y coordinates
-    # The sprite is a list of bytes, the upper nibble of each contains the sprite info
-    def draw_sprite(self, start_x, start_y, sprite):
-        collision = 0
-        for x in range(4):
-            px = x + start_x
-
-            if px >= self.width:
-                # wrap around if we go off screen
-                px -= self.width
-
-            for y in range(len(sprite)):
-                py = y + start_y
-
-                if py >= len(self.pixels[px]):
-                    # wrap around if we go off screen
-                    py -= self.height
-
-                p = self.pixels[px][py]
-                sprite_bit = (sprite[y] >> (7 - x)) & 0x1
-
-                new_state = p.state ^ sprite_bit
-                if p.state == 1 and new_state == 0:
-                    # print(f"Collision! (x={x}, y={y})")
-                    collision = 1
-
-                p.state = new_state
-
-        return collision
+    def present(self):
+        if self.post is not None:
+            self.present_post()
+            return
+
+        dirty_rects = self.dirty_rects()
+        if not dirty_rects:
+            return
+
+        # Unpack the changed rows into the native-resolution surface
+        pitch = self.surface.get_pitch()
+        buffer = self.surface.get_buffer()
+        for rect in dirty_rects:
+            for row in range(rect.y // self.scale_factor, rect.bottom // self.scale_factor):
+                buffer.write(self.get_row(row), row * pitch)
+        del buffer  # releases the surface lock
+
+        pygame.transform.scale(self.surface, self.scaled.get_size(), self.scaled)
+        for rect in dirty_rects:
+            self.screen.blit(self.scaled, rect, rect)
+        pygame.display.update(dirty_rects)
+        self.dirty[:] = bytes(self.height)
+
+    # Run the whole framebuffer through the post-processing stage and show the result, unless neither has changed
+    def present_post(self):
+        if self.dirty.find(1) == -1 and self.post.settled:
+            return
+
+        pygame.surfarray.blit_array(self.image, self.post.process(self, self.palette))
+        pygame.transform.scale(self.image, self.scaled_image.get_size(), self.scaled_image)
+        self.screen.blit(self.scaled_image, (0, 0))
+        pygame.display.update()
+        self.dirty[:] = bytes(self.height)
+
+    # Screen rectangles covering each run of consecutive dirty rows
+    def dirty_rects(self):
+        rects = []
+        dirty = self.dirty
+        sf = self.scale_factor
+        row = dirty.find(1)
+        while row != -1:
+            end = dirty.find(0, row)
+            if end == -1:
+                end = self.height
+            rects.append(pygame.Rect(0, row * sf, self.width * sf, (end - row) * sf))
+            row = dirty.find(1, end)
+
+        return rects
+
+    def poll(self):
+        go = True
+        for event in pygame.event.get():
+            go = self.handle(event) and go
 
-    def draw_all(self):
-        for col in self.pixels:
-            for p in col:
-                p.draw(self.screen)
+        return go
 
-    def clear(self):
-        for col in self.pixels:
-            for p in col:
-                p.set_color(WHITE)
-                p.clear()
+    # Sleep on the event queue until something happens or timeout seconds pass
+    # Presses from other threads only show up in the keypad, so they're seen once the timeout is up
+    def wait_input(self, since, timeout):
+        timeout_ms = int(timeout * 1000)
+        if timeout_ms <= 0:
+            return self.poll()   # pygame.event.wait(0) would wait forever
+        return self.handle(pygame.event.wait(timeout_ms)) and self.poll()
 
-    def create_pixels(self):
-        pixels = []
-        for x in range(self.width):
-            pixels.append([])
-            for y in range(self.height):
-                pixels[x].append(Pixel(x, y))
+    # Handle one event, returning False on QUIT
+    def handle(self, event):
+        if event.type == pygame.QUIT:
+            return False
+        if event.type in (pygame.KEYDOWN, pygame.KEYUP) and self.keypad is not None:
+            self.keypad.host_key(event.key, event.type == pygame.KEYDOWN)
+        return True
 
-        return pixels
+    def close(self):
+        pygame.quit()
 
 
 def display_test():
@@ -165,25 +181,17 @@ def display_test():
         # if event.type == pygame.MOUSEBUTTONDOWN:
         mouse1, mouse2, mouse3 = pygame.mouse.get_pressed()
         if mouse1 or mouse2 or mouse3:
-            p = my_display.get_pixel(px, py)
-
             # print(f"Mouse button {event.button} pressed")
             if mouse1:
-                p.set_color(GREEN)
-                p.set()
+                my_display.set_pixel(px, py, 1)
                 # my_display.draw_sprite(px, py, CUSTOM_SPRITES['pixel'])
             elif mouse2:
                 my_display.clear()
                 # my_display.draw_sprite(px, py, CUSTOM_SPRITES['pixel'])
             elif mouse3:
-                # p.set_color(GREEN)
-                p.clear()
-
-        my_display.get_screen().fill(BLACK)
-
-        my_display.draw_all()
+                my_display.set_pixel(px, py, 0)
 
-        pygame.display.flip()
+        my_display.present()
         dx, dy = 0, 0
 
     pygame.quit()
@@ -0,0 +1,204 @@
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+
+from backend import *
+from keypad import KEYMAP
+from scheduler import Scheduler
+
+
+# Layout of the shared block. Every field has exactly one writer, so neither side ever takes a lock:
+#   SEQ       frames published so far; frame n is in buffer n & 1                  (written by the emulator)
+#   KEY_HEAD  key events pushed so far                                              (frontend)
+#   KEY_TAIL  key events taken so far                                               (emulator)
+#   CLOSED    set once the emulator has stopped                                     (emulator)
+#   QUIT      set when the window was closed                                        (frontend)
+# then the key ring, then the two frame buffers: each the frame's width and height (FRAME_HEADER), then every plane of
+# the framebuffer in the get_packed layout. Buffers are sized for the largest frame, so a program switching resolution
+# doesn't need a new block
+SEQ = 0
+KEY_HEAD = 4
+KEY_TAIL = 8
+CLOSED = 12
+QUIT = 13
+KEY_RING = 16
+KEY_RING_SIZE = 64      # a power of two, so positions stay in step when the counters wrap
+BUFFERS = KEY_RING + KEY_RING_SIZE
+FRAME_HEADER = struct.Struct("<HH")
+FRAME_SIZE = FRAME_HEADER.size + PLANES * HIRES_WIDTH * HIRES_HEIGHT // 8
+
+COUNTER = struct.Struct("<I")
+COUNTER_MASK = 0xFFFFFFFF
+
+KEY_DOWN = 0x80         # set in a key event for a press, clear for a release
+KEY_POLL = 0.001        # longest the emulator sleeps between looks at the key ring while waiting for a key
+
+
+# A framebuffer and a key queue in shared memory, for an emulator and a frontend in separate processes
+# The framebuffer is double buffered under a sequence counter: the emulator writes frame n + 1 into the buffer the
+# frontend isn't meant to be reading, then bumps the counter. The frontend copies the buffer for the counter it saw and
+# keeps the copy only if the counter hasn't moved since, since that means the emulator never started on that buffer
+# again. Key events go the other way through a single-producer, single-consumer ring of bytes.
+# This relies on each side's stores becoming visible to the other in the order they were made, which x86 guarantees
+class SharedFrame:
+
+    def __init__(self, name=None):
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=BUFFERS + 2 * FRAME_SIZE)
+            self.memory.buf[:BUFFERS] = bytes(BUFFERS)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.buf = self.memory.buf
+
+    def load(self, field):
+        return COUNTER.unpack_from(self.buf, field)[0]
+
+    def store(self, field, value):
+        COUNTER.pack_into(self.buf, field, value & COUNTER_MASK)
+
+    def buffer(self, seq):
+        return BUFFERS + (seq & 1) * FRAME_SIZE
+
+    # Emulator side: make packed, the planes of a width x height framebuffer one after another, the latest frame
+    def publish(self, width, height, packed):
+        seq = (self.load(SEQ) + 1) & COUNTER_MASK
+        start = self.buffer(seq)
+        FRAME_HEADER.pack_into(self.buf, start, width, height)
+        self.buf[start + FRAME_HEADER.size:start + FRAME_HEADER.size + len(packed)] = packed
+        self.store(SEQ, seq)
+
+    # Frontend side: the latest frame as (seq, width, height, packed), or None if it's still frame last
+    def read(self, last=None):
+        while True:
+            seq = self.load(SEQ)
+            if seq == last:
+                return None
+            start = self.buffer(seq)
+            width, height = FRAME_HEADER.unpack_from(self.buf, start)
+            start += FRAME_HEADER.size
+            packed = bytes(self.buf[start:start + PLANES * height * width // 8])
+            if self.load(SEQ) == seq:
+                return seq, width, height, packed
+
+    # Frontend side: queue a key event, dropping it if the emulator has fallen a whole ring behind
+    def push_key(self, key, down):
+        head = self.load(KEY_HEAD)
+        if (head - self.load(KEY_TAIL)) & COUNTER_MASK < KEY_RING_SIZE:
+            self.buf[KEY_RING + head % KEY_RING_SIZE] = key | (KEY_DOWN if down else 0)
+            self.store(KEY_HEAD, head + 1)
+
+    # Frontend side: the keypad interface Display feeds host key events into
+    def host_key(self, code, down):
+        key = KEYMAP.get(code)
+        if key is None:
+            return False
+        self.push_key(key, down)
+        return True
+
+    # Emulator side: the queued key events as (key, down) pairs, oldest first
+    def pop_keys(self):
+        tail = self.load(KEY_TAIL)
+        head = self.load(KEY_HEAD)
+        events = []
+        while tail != head:
+            event = self.buf[KEY_RING + tail % KEY_RING_SIZE]
+            events.append((event & 0xF, bool(event & KEY_DOWN)))
+            tail = (tail + 1) & COUNTER_MASK
+        self.store(KEY_TAIL, tail)
+        return events
+
+    def set_flag(self, field):
+        self.buf[field] = 1
+
+    def flag(self, field):
+        return self.buf[field] != 0
+
+    def close(self):
+        del self.buf    # the block can't be closed while a view of it is alive
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+
+# The emulator's end of split mode: a display that publishes frames to a frontend process, which draws them in a
+# pygame window and sends key events back (see run_frontend). The emulator process never loads pygame, and rendering,
+# vsync and window operations run on another core instead of stalling the CPU under the same GIL
+class SharedDisplay(DisplayBackend):
+
+    def __init__(self, width=NATIVE_WIDTH, height=NATIVE_HEIGHT, scale_factor=None, post=None):
+        super().__init__(width, height)
+        self.frame = SharedFrame()
+        # A fresh interpreter rather than a fork, so SDL starts from a clean process
+        context = multiprocessing.get_context("spawn")
+        self.frontend = context.Process(target=run_frontend, args=(self.frame.name, width, height, scale_factor, post),
+                                        daemon=True)
+        self.frontend.start()
+
+    def present(self):
+        if self.dirty.find(1) != -1:
+            self.frame.publish(self.width, self.height, b"".join([self.get_packed(p) for p in range(PLANES)]))
+            self.dirty[:] = bytes(self.height)
+
+    def poll(self):
+        for key, down in self.frame.pop_keys():
+            if down:
+                self.keypad.press(key)
+            else:
+                self.keypad.release(key)
+
+        return not self.frame.flag(QUIT) and self.frontend.is_alive()
+
+    # Key events only arrive through the ring, so look at it every KEY_POLL seconds
+    def wait_input(self, since, timeout):
+        deadline = time.perf_counter() + timeout
+        while self.poll():
+            left = deadline - time.perf_counter()
+            if left <= 0 or self.keypad.wait_press(since, min(left, KEY_POLL)) is not None:
+                return True
+        return False
+
+    def close(self):
+        self.frame.set_flag(CLOSED)
+        self.frontend.join(1)
+        if self.frontend.is_alive():
+            self.frontend.terminate()
+        self.frame.close()
+        self.frame.unlink()
+
+
+# The frontend's end of split mode, run in its own process: show the frames the emulator publishes in the shared
+# block called name, at 60 frames a second, until the emulator stops or the window is closed
+# post is the window's post-processing stage (see phosphor.py), which runs here rather than in the emulator
+def run_frontend(name, width, height, scale_factor=None, post=None):
+    import pygame
+    from display import Display, SCALE_FACTOR
+
+    frame = SharedFrame(name)
+    pygame.init()
+    pygame.display.set_caption("CHIP-8 EMULATOR")
+    display = Display(width, height, scale_factor or SCALE_FACTOR, post=post)
+    display.keypad = frame  # key events go straight into the ring
+    scheduler = Scheduler()
+    seq = None
+
+    while not frame.flag(CLOSED):
+        if not display.poll():
+            frame.set_flag(QUIT)
+            break
+
+        latest = frame.read(seq)
+        if latest is not None:
+            seq, width, height, packed = latest
+            if (width, height) != (display.width, display.height):
+                display.resize(width, height)
+            plane_size = height * width // 8
+            for p in range(PLANES):
+                display.set_packed(packed[p * plane_size:(p + 1) * plane_size], p)
+            display.present()
+        scheduler.wait()
+
+    display.close()
+    frame.close()
@@ -0,0 +1,392 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from core import *
+
+
+# The parts of a machine that get compared, in the order machine states list them
+FIELDS = ("V", "I", "PC", "SP", "stack", "DT", "ST", "waiting", "memory", "framebuffer")
+
+NEUTRAL = 0x8000    # LDR V0, V0: does nothing, and every engine runs it; minimizing swaps it in for instructions
+
+STACK_SIZE = 16         # CHIP8's stack
+PROGRAM_LENGTH = 32     # instructions in a generated program
+STEPS = 64              # engine steps each case is run for
+
+# Every opcode of each operation, found by decoding all 65536 of them the first time they're needed
+_opcodes = None
+
+
+def opcodes():
+    global _opcodes
+    if _opcodes is None:
+        _opcodes = {}
+        for opcode in range(0x10000):
+            _opcodes.setdefault(Operator.lookup(opcode), []).append(opcode)
+        del _opcodes[Op.NONE]
+    return _opcodes
+
+
+# A random starting state and program, as a dict of plain values so it can be pickled, saved and shrunk
+# Memory is random bytes throughout, so a jump anywhere still lands on something to run; the program at PC is drawn
+# an operation at a time, so every operation turns up about as often as any other. Jumps, calls and loads of I
+# mostly aim into the program. The timers tick every tick_every instructions, as often as every one, so ticks land
+# between engine steps the way run() puts them there
+def generate(seed, supports, length=PROGRAM_LENGTH, steps=STEPS):
+    rng = random.Random(seed)
+    ops = [op for op, codes in opcodes().items() if any(supports(op, opcode) for opcode in codes[:64])]
+
+    program = []
+    while len(program) < length:
+        op = rng.choice(ops)
+        opcode = rng.choice(opcodes()[op])
+        if op in (Op.JP, Op.CALL, Op.LDI, Op.JPO) and rng.random() < 0.8:
+            opcode = (opcode & 0xF000) | (PGM_MEM_START + 2 * rng.randrange(length))
+        if supports(op, opcode):
+            program.append(opcode)
+
+    sp = rng.randrange(STACK_SIZE + 1)
+    return {
+        "seed": seed,
+        "steps": steps,
+        "v": [rng.getrandbits(8) for _ in range(CPU.NUM_VREGS)],
+        "i": rng.randrange(MEM_SIZE),
+        "sp": sp,
+        "stack": [PGM_MEM_START + 2 * rng.randrange(length) for _ in range(sp)],
+        "dt": rng.getrandbits(8),
+        "st": rng.getrandbits(8),
+        "keys": rng.getrandbits(16),
+        "memory": rng.randbytes(MEM_SIZE).hex(),
+        "program": program,
+        "tick_every": rng.randrange(1, 17),
+    }
+
+
+def case_memory(case):
+    memory = bytearray.fromhex(case["memory"])
+    program = b"".join(opcode.to_bytes(2, "big") for opcode in case["program"])
+    memory[PGM_MEM_START:PGM_MEM_START + len(program)] = program
+    return memory
+
+
+# A headless machine in the state a case starts in, running its program from the start of program memory
+def build(case):
+    chip8 = CHIP8(debug_mode=False, headless=True, seed=case["seed"])
+    chip8.mem.load(0, case_memory(case))
+    cpu = chip8.cpu
+    cpu.v[:] = bytes(case["v"])
+    cpu.i = case["i"]
+    cpu.pc = PGM_MEM_START
+    cpu.sp = case["sp"]
+    cpu.stack[:case["sp"]] = array("H", case["stack"])
+    cpu.dt = case["dt"]
+    cpu.st = case["st"]
+    chip8.keypad.pressed = case["keys"]
+    return chip8
+
+
+def machine_state(chip8):
+    cpu = chip8.cpu
+    return (list(cpu.v), cpu.i, cpu.pc, cpu.sp, list(cpu.stack[:cpu.sp]), cpu.dt, cpu.st,
+            -1 if cpu.waiting is None else cpu.waiting, bytes(chip8.mem.mem), chip8.display.get_framebuffer())
+
+
+# The reference: one instruction at a time through CPU.cycle
+class Interpreter:
+
+    def __init__(self, case):
+        self.chip8 = build(case)
+        self.executed = 0
+
+    # Run n instructions, ticking the timers after every every-th one (never if every is 0)
+    # Returns False if the machine stopped on the way
+    def run(self, n, every):
+        chip8 = self.chip8
+        cpu = chip8.cpu
+        for _ in range(n):
+            if not cpu.cycle(chip8.mem, chip8.display):
+                return False
+            self.executed += 1
+            if every and self.executed % every == 0:
+                chip8.tick()
+        return True
+
+    def state(self):
+        return machine_state(self.chip8)
+
+    # Whether engine can run the next instruction
+    def supported_by(self, engine):
+        memory = self.chip8.mem
+        pc = self.chip8.cpu.pc
+        if pc + 1 >= len(memory.mem):
+            return True     # every engine has to stop here
+        opcode = memory.read16(pc)
+        return engine.supports(Operator.lookup(opcode), opcode)
+
+
+# Engines checked against the interpreter. Each one says how many instructions its next step runs, so the interpreter
+# can run as many and the two be compared; supports says which opcodes the engine can run at all, and tick ticks its
+# timers between steps
+
+# The block engine (blocks.py)
+class Compiled:
+
+    def __init__(self, case):
+        from blocks import BlockEngine
+        self.chip8 = build(case)
+        self.engine = BlockEngine(self.chip8.cpu, self.chip8.mem)
+
+    @staticmethod
+    def supports(op, opcode):
+        return True
+
+    def next_length(self):
+        return self.engine.next_length(self.chip8.mem)
+
+    # Run one step, returning whether the machine is still going
+    def step(self):
+        return bool(self.engine.cycle(self.chip8.mem, self.chip8.display))
+
+    def tick(self):
+        self.chip8.tick()
+
+    def state(self):
+        return machine_state(self.chip8)
+
+
+# The NumPy batch engine (batch.py), as a batch of one
+# Batches run plain CHIP-8 and draw their own random numbers, so SUPER-CHIP and XO-CHIP operations, DXY0 and RND
+# are left out
+class Batch:
+
+    def __init__(self, case):
+        import numpy as np
+        from batch import BatchCHIP8
+        machines = BatchCHIP8(1, seed=case["seed"])
+        machines.mem[0] = np.frombuffer(bytes(case_memory(case)), dtype=np.uint8)
+        machines.v[0] = case["v"]
+        machines.i[0] = case["i"]
+        machines.sp[0] = case["sp"]
+        machines.stack[0, :case["sp"]] = case["stack"]
+        machines.dt[0] = case["dt"]
+        machines.st[0] = case["st"]
+        machines.keys[0] = case["keys"]
+        self.machines = machines
+
+    @staticmethod
+    def supports(op, opcode):
+        from batch import BatchCHIP8
+        return BatchCHIP8.HANDLERS[op] is not BatchCHIP8.op_none and op is not Op.RND and \
+            not (op is Op.DRW and opcode & 0xF == 0)
+
+    def next_length(self):
+        return 1
+
+    def step(self):
+        machines = self.machines
+        machines.cycle()
+        return bool(machines.running[0]) and machines.waiting[0] < 0
+
+    def tick(self):
+        self.machines.tick60()
+
+    def state(self):
+        m = self.machines
+        sp = int(m.sp[0])
+        return (m.v[0].tolist(), int(m.i[0]), int(m.pc[0]), sp, m.stack[0, :sp].tolist(), int(m.dt[0]),
+                int(m.st[0]), int(m.waiting[0]), m.mem[0].tobytes(), m.fb[0].tobytes())
+
+
+ENGINES = {"compiled": Compiled, "batch": Batch}
+
+
+# Run a case through the interpreter and an engine side by side, comparing the machines after every engine step
+# Returns None if they agree throughout, or (step, fields that differ, what happened) at the first difference.
+# Either side raising counts as the machine stopping, since the interpreter raises where other engines just stop. The
+# machines aren't compared once the engine has raised: a compiled block that raises part way through leaves the
+# registers as they were when it started, and the error ends the program anyway.
+# A case ends early, passing, once the program gets to an opcode the engine doesn't support (in random memory, say).
+# The interpreter ticks the timers after every tick_every-th instruction, the engine after the step that gets there,
+# like run() does; an engine that reads a timer part way through a step sees it differently and fails the case
+def check(case, engine):
+    if isinstance(engine, str):
+        engine = ENGINES[engine]
+    every = case.get("tick_every", 0)    # cases saved before ticks were fuzzed have none
+    executed = 0
+
+    # Invalid opcodes and stack errors get reported on stdout, which would just interleave between workers
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference = Interpreter(case)
+        candidate = engine(case)
+
+        for step in range(case["steps"]):
+            if not reference.supported_by(engine):
+                break
+            length = candidate.next_length()
+            try:
+                go = candidate.step()
+            except Exception as e:
+                go, raised = False, f"{type(e).__name__}: {e}"
+            else:
+                raised = None
+            # A step that stops the machine stops on its last instruction, which doesn't count, as in the interpreter
+            ran = length if go else length - 1
+            if every:
+                for _ in range((executed + ran) // every - executed // every):
+                    candidate.tick()
+            executed += ran
+            try:
+                ref_go = reference.run(length, every)
+            except Exception:
+                ref_go = False
+
+            expected, actual = reference.state(), candidate.state()
+            if go != ref_go:
+                note = raised or f"the engine {'kept going' if go else 'stopped'}, the interpreter didn't"
+                return step, [name for name, a, b in zip(FIELDS, expected, actual) if a != b], note
+            if raised is None and expected != actual:
+                return step, [name for name, a, b in zip(FIELDS, expected, actual) if a != b], ""
+            if not go:
+                break
+
+    return None
+
+
+# Shrink a failing case to a smaller one that still fails the same way: as few steps as it takes, then as many
+# instructions as possible swapped for NEUTRAL and as much of the starting state as possible zeroed. Each change is
+# kept only if the case still fails with the same fields differing
+def minimize(case, engine):
+    failure = check(case, engine)
+    if failure is None:
+        return case
+    step, fields, _ = failure
+    case = dict(case, steps=step + 1)
+
+    def still_fails(candidate):
+        result = check(candidate, engine)
+        return result is not None and result[1] == fields
+
+    def attempts(case):
+        for k in reversed(range(len(case["program"]))):
+            if case["program"][k] != NEUTRAL:
+                yield dict(case, program=case["program"][:k] + [NEUTRAL] + case["program"][k + 1:])
+        for r in range(CPU.NUM_VREGS):
+            if case["v"][r]:
+                yield dict(case, v=case["v"][:r] + [0] + case["v"][r + 1:])
+        for field in ("i", "dt", "st", "keys", "tick_every"):
+            if case.get(field):
+                yield dict(case, **{field: 0})
+        if case["sp"]:
+            yield dict(case, sp=0, stack=[])
+        # Zero memory in halves, then quarters, and so on down to single bytes
+        memory = bytearray.fromhex(case["memory"])
+        size = len(memory) // 2
+        while size >= 1:
+            for start in range(0, len(memory), size):
+                if any(memory[start:start + size]):
+                    zeroed = memory[:start] + bytes(size) + memory[start + size:]
+                    yield dict(case, memory=zeroed.hex())
+            size //= 2
+
+    changed = True
+    while changed:
+        changed = False
+        for candidate in attempts(case):
+            if still_fails(candidate):
+                case = candidate
+                changed = True
+                break
+
+    return case
+
+
+# A failing case written out for a person: the program up to the last instruction that matters, the non-zero starting
+# state and what differed
+def describe(case, engine):
+    step, fields, note = check(case, engine)
+    lines = [f"seed {case['seed']}: {', '.join(fields) or 'running state'} differ after step {step}"
+             + (f" ({note})" if note else "")]
+    for k, opcode in enumerate(case["program"]):
+        if opcode == NEUTRAL:
+            continue
+        op = Operator.lookup(opcode)
+        lines.append("  " + CPU.format_trace(PGM_MEM_START + 2 * k, opcode, op, CPU.format_args(op, case["v"], opcode)))
+    state = [f"V{r:X}={v:02X}" for r, v in enumerate(case["v"]) if v]
+    state += [f"{field.upper()}={case[field]:X}" for field in ("i", "dt", "st", "keys") if case[field]]
+    if case.get("tick_every"):
+        state.append(f"ticking every {case['tick_every']} instructions")
+    if case["sp"]:
+        state.append(f"stack={' '.join(f'{addr:03X}' for addr in case['stack'])}")
+    memory = bytearray.fromhex(case["memory"])
+    used = [addr for addr, byte in enumerate(memory) if byte and not
+            PGM_MEM_START <= addr < PGM_MEM_START + 2 * len(case["program"])]
+    if used:
+        state.append(f"{len(used)} non-zero bytes of memory outside the program")
+    lines.append("  state: " + (" ".join(state) or "all zero"))
+    return "\n".join(lines)
+
+
+# Check count cases starting from seed first; runs in a worker process, so it returns plain minimized cases
+def fuzz_range(engine, first, count, length, steps):
+    supports = ENGINES[engine].supports
+    failures = []
+    for seed in range(first, first + count):
+        case = generate(seed, supports, length, steps)
+        if check(case, engine) is not None:
+            failures.append(minimize(case, engine))
+    return failures
+
+
+# Check cases seeds seed, seed + 1, ... across a pool of worker processes, returning the minimized failures
+def fuzz(engine, cases, seed=0, jobs=None, length=PROGRAM_LENGTH, steps=STEPS, chunk=100):
+    firsts = range(seed, seed + cases, chunk)
+    counts = [min(chunk, seed + cases - first) for first in firsts]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = pool.map(fuzz_range, [engine] * len(firsts), firsts, counts, [length] * len(firsts),
+                           [steps] * len(firsts))
+        return [case for failures in results for case in failures]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the faster engines against the interpreter on random programs")
+    parser.add_argument("--engine", choices=sorted(ENGINES), action="append",
+                        help="engine to check (default: all of them)")
+    parser.add_argument("--cases", type=int, default=1000, help="random cases per engine")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first case; case n uses seed + n")
+    parser.add_argument("--jobs", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--length", type=int, default=PROGRAM_LENGTH, help="instructions in each program")
+    parser.add_argument("--steps", type=int, default=STEPS, help="engine steps to run each case for")
+    parser.add_argument("--save", metavar="DIR", help="write each minimized failure here as JSON")
+    parser.add_argument("--case", metavar="FILE", help="re-check one saved failure instead of fuzzing")
+    args = parser.parse_args(argv)
+
+    if args.case:
+        with open(args.case) as case_file:
+            saved = json.load(case_file)
+        failure = check(saved["case"], saved["engine"])
+        print(describe(saved["case"], saved["engine"]) if failure else "passes now")
+        return 1 if failure else 0
+
+    failed = 0
+    for engine in args.engine or sorted(ENGINES):
+        failures = fuzz(engine, args.cases, args.seed, args.jobs, args.length, args.steps)
+        print(f"{engine}: {len(failures)} of {args.cases} cases differ from the interpreter")
+        for case in failures:
+            print(describe(case, engine))
+            if args.save:
+                os.makedirs(args.save, exist_ok=True)
+                with open(os.path.join(args.save, f"{engine}-{case['seed']}.json"), "w") as case_file:
+                    json.dump({"engine": engine, "case": case}, case_file)
+        failed += len(failures)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
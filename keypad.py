@@ -0,0 +1,83 @@
+import struct
+import threading
+
+
+# Host keys for the 16 CHIP-8 keys, using the usual layout on the left of a QWERTY keyboard:
+#   1 2 3 C        1 2 3 4
+#   4 5 6 D   <-   Q W E R
+#   7 8 9 E        A S D F
+#   A 0 B F        Z X C V
+# Keyed by character code, which is also what pygame uses for these keys
+KEYMAP = {ord(char): key for char, key in zip("1234qwerasdfzxcv", [0x1, 0x2, 0x3, 0xC, 0x4, 0x5, 0x6, 0xD,
+                                                                    0x7, 0x8, 0x9, 0xE, 0xA, 0x0, 0xB, 0xF])}
+
+# How many recent presses the keypad remembers the keys of, so a poll can find the first of several new presses
+HISTORY = 16
+
+
+# The CHIP-8 hex keypad as a 16-bit mask of the keys held down, with bit k set while key k is pressed
+# Anything can press and release keys: the pygame window, a script, another thread. SKP/SKNP just test a bit of
+# pressed, and a CPU waiting in LDKP sleeps on the condition until presses changes
+class Keypad:
+
+    # pressed, presses and history, for save states
+    STATE = struct.Struct("<HQ16s")
+
+    def __init__(self):
+        self.pressed = 0            # bit k set while key k is down
+        self.presses = 0            # number of key presses so far, for spotting new ones
+        self.history = bytearray(HISTORY)   # the key of press number p is at history[p % HISTORY]
+        self.condition = threading.Condition()
+        self.listener = None        # called with (key, down) on every press and release, e.g. to record input
+
+    def press(self, key):
+        with self.condition:
+            self.pressed |= 1 << key
+            self.history[self.presses % HISTORY] = key
+            self.presses += 1
+            if self.listener is not None:
+                self.listener(key, True)
+            self.condition.notify_all()
+
+    def release(self, key):
+        with self.condition:
+            self.pressed &= ~(1 << key)
+            if self.listener is not None:
+                self.listener(key, False)
+
+    # The keys held and the press history as bytes (see STATE); the listener isn't part of it
+    def get_state(self):
+        with self.condition:
+            return Keypad.STATE.pack(self.pressed, self.presses, self.history)
+
+    def set_state(self, data):
+        with self.condition:
+            self.pressed, self.presses, self.history[:] = Keypad.STATE.unpack_from(data)
+
+    def is_pressed(self, key):
+        return (self.pressed >> key) & 0x1
+
+    # Handle a host key going down or up, returning False if it isn't a CHIP-8 key
+    def host_key(self, code, down):
+        key = KEYMAP.get(code)
+        if key is None:
+            return False
+        if down:
+            self.press(key)
+        else:
+            self.release(key)
+        return True
+
+    # The first key pressed after the first since presses, or None if there hasn't been one
+    # If more than HISTORY presses came since then, the oldest one still remembered stands in for it
+    def new_press(self, since):
+        if self.presses == since:
+            return None
+        return self.history[max(since, self.presses - HISTORY) % HISTORY]
+
+    # Sleep until a key is pressed after the first since presses, or for at most timeout seconds
+    # Returns the key, or None on timeout
+    def wait_press(self, since, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.presses != since, timeout)
+            return self.new_press(since)
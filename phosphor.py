@@ -0,0 +1,94 @@
+import numpy as np
+
+from backend import PLANES
+
+
+# Post-processing stages for the pygame window (see Display.post), which smooth over the flicker of CHIP-8 programs
+# erasing a sprite with XOR and drawing it again a moment later
+# A stage turns the whole framebuffer into an RGB image as a few NumPy operations on width x height arrays, so a frame
+# costs the same however many sprites were drawn. The window then blits that image scaled in one go
+class PostProcess:
+
+    def __init__(self):
+        self.image = None   # the last frame put out, as floats (height x width x 3)
+
+    # Start over on a blank width x height screen
+    def reset(self, width, height):
+        self.image = np.zeros((height, width, 3), dtype=np.float32)
+
+    # True while the output would be the same as the last, with the framebuffer unchanged: the window can skip the frame
+    @property
+    def settled(self):
+        return True
+
+    # The framebuffer as RGB (height x width x 3 floats): each pixel's color (0-3, see DisplayBackend.get_row) looked
+    # up in the window's palette
+    @staticmethod
+    def frame(display, palette):
+        colors = np.array(palette[:4], dtype=np.float32)
+        index = np.zeros((display.height, display.width), dtype=np.uint8)
+        for p in range(PLANES):
+            bits = np.unpackbits(np.frombuffer(display.get_packed(p), dtype=np.uint8))
+            index |= bits.reshape(display.height, display.width) << p
+        return colors[index]
+
+    # Blend the framebuffer into the output, returning it in the (width x height x 3) layout pygame.surfarray takes
+    def process(self, display, palette):
+        self.image = self.blend(PostProcess.frame(display, palette))
+        return self.image.transpose(1, 0, 2).astype(np.uint8)
+
+    def blend(self, frame):
+        return frame
+
+
+# Phosphor persistence: a lit pixel shows at full brightness, then fades by decay every frame once it goes dark, like
+# the afterglow of a CRT. A sprite erased and redrawn within a couple of frames never visibly goes out
+class Phosphor(PostProcess):
+
+    CUTOFF = 1.0    # a fading pixel dimmer than this (out of 255) goes straight to black
+
+    def __init__(self, decay=0.6):
+        super().__init__()
+        self.decay = decay
+        self.fading = False
+
+    @property
+    def settled(self):
+        return not self.fading
+
+    def blend(self, frame):
+        faded = self.image * self.decay
+        faded[faded < Phosphor.CUTOFF] = 0
+        image = np.maximum(frame, faded)
+        self.fading = bool((image != frame).any())
+        return image
+
+
+# Frame blending: each pixel shows its average over the last frames frames, so one that's only lit some of the time
+# shows dimmed rather than blinking
+class FrameBlend(PostProcess):
+
+    def __init__(self, frames=3):
+        super().__init__()
+        self.frames = frames
+
+    def reset(self, width, height):
+        super().reset(width, height)
+        self.history = np.zeros((self.frames, height, width, 3), dtype=np.float32)
+        self.total = np.zeros((height, width, 3), dtype=np.float32)
+        self.next = 0           # slot in history the next frame replaces
+        self.unchanged = 0      # frames in a row that were the same as the one before
+
+    @property
+    def settled(self):
+        return self.unchanged >= self.frames
+
+    def blend(self, frame):
+        previous = self.history[self.next - 1]
+        self.unchanged = self.unchanged + 1 if np.array_equal(frame, previous) else 0
+
+        # Keep a running total, so a frame costs the same however many frames are blended
+        self.total += frame - self.history[self.next]
+        self.history[self.next] = frame
+        self.next = (self.next + 1) % self.frames
+        return self.total / self.frames
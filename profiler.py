@@ -0,0 +1,189 @@
+import argparse
+import atexit
+import json
+import time
+
+from core import *
+
+
+def format_address(pc):
+    return "top" if pc is None else format(pc, "03X")
+
+
+# Counts executions and wall time per Op and per address, finds hot loops and builds the call graph
+# Like TraceRecorder, it works by swapping CHIP8.engine for its own cycle while attached and putting the original back
+# on detach, so an unprofiled machine runs exactly as fast as before. While attached, every instruction goes through
+# the interpreter one at a time, so a compiled machine is profiled as if it were interpreted. Idle loops aren't
+# fast-forwarded while attached either, or the loops worth profiling would come out with too few trips.
+# A hot loop is a backward JP, keyed by (target, address of the JP); its trip count is the number of times the jump
+# was taken. The call graph comes from pairing CALLs with RETs on a shadow stack: each subroutine gets its call count
+# and inclusive time, and each caller -> callee edge its call count, with None as the caller for top-level code.
+# All times are the time spent inside CPU.cycle, so the profiler's own bookkeeping isn't counted
+class Profiler:
+
+    def __init__(self, clock=time.perf_counter, report_at_exit=False, top=10):
+        self.clock = clock
+        self.top = top
+        self.reset()
+
+        self.chip8 = None
+        self.engine = None
+        self.skip_idle = False
+        if report_at_exit:
+            atexit.register(self.print_report)
+
+    # Forget everything counted so far
+    def reset(self):
+        self.instructions = 0
+        self.elapsed = 0.0
+        self.ops = {}           # Op -> [executions, seconds]
+        self.addresses = {}     # pc -> [executions, seconds, opcode]
+        self.loops = {}         # (target, pc of the JP) -> trips
+        self.subroutines = {}   # subroutine address -> [calls, inclusive seconds]
+        self.edges = {}         # (caller subroutine or None, callee) -> calls
+        self.frames = []        # shadow stack of (subroutine, elapsed when it was called)
+
+    def attach(self, chip8):
+        self.chip8 = chip8
+        self.engine = chip8.engine
+        self.skip_idle = chip8.skip_idle
+        chip8.engine = self.cycle
+        chip8.skip_idle = False
+
+    def detach(self):
+        self.chip8.engine = self.engine
+        self.chip8.skip_idle = self.skip_idle
+        self.chip8 = None
+
+    def cycle(self, memory, display):
+        cpu = self.chip8.cpu
+        clock = self.clock
+        pc = cpu.pc
+
+        start = clock()
+        executed = cpu.cycle(memory, display)
+        elapsed = clock() - start
+
+        op = cpu.op
+        self.instructions += 1
+        self.elapsed += elapsed
+
+        stats = self.ops.get(op)
+        if stats is None:
+            stats = self.ops[op] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += elapsed
+
+        stats = self.addresses.get(pc)
+        if stats is None:
+            stats = self.addresses[pc] = [0, 0.0, memory.read16(pc)]
+        stats[0] += 1
+        stats[1] += elapsed
+
+        if executed:
+            if op is Op.JP:
+                if cpu.pc <= pc:
+                    loop = (cpu.pc, pc)
+                    self.loops[loop] = self.loops.get(loop, 0) + 1
+            elif op is Op.CALL:
+                callee = cpu.pc
+                edge = (self.frames[-1][0] if self.frames else None, callee)
+                self.edges[edge] = self.edges.get(edge, 0) + 1
+                self.frames.append((callee, self.elapsed - elapsed))
+            elif op is Op.RET and self.frames:
+                callee, called = self.frames.pop()
+                stats = self.subroutines.get(callee)
+                if stats is None:
+                    stats = self.subroutines[callee] = [0, 0.0]
+                stats[0] += 1
+                stats[1] += self.elapsed - called
+
+        return executed
+
+    # Everything counted so far, with the top hot spots first in each list; usable at any time, even while running
+    # Times are in seconds. Subroutines still on the shadow stack aren't counted until they return
+    def report(self, top=None):
+        top = top or self.top
+        hot_addresses = sorted(self.addresses.items(), key=lambda item: item[1][1], reverse=True)[:top]
+        hot_loops = sorted(self.loops.items(), key=lambda item: item[1], reverse=True)[:top]
+
+        return {
+            "instructions": self.instructions,
+            "seconds": self.elapsed,
+            "ops": [{"op": op.name, "count": count, "seconds": seconds, "ns_per_op": seconds * 1e9 / count}
+                    for op, (count, seconds) in sorted(self.ops.items(), key=lambda item: item[1][1], reverse=True)],
+            "addresses": [{"pc": pc, "opcode": opcode, "count": count, "seconds": seconds}
+                          for pc, (count, seconds, opcode) in hot_addresses],
+            "loops": [{"start": start, "end": end, "trips": trips, "seconds": self.range_time(start, end)}
+                      for (start, end), trips in hot_loops],
+            "subroutines": [{"address": address, "calls": calls, "seconds": seconds}
+                            for address, (calls, seconds) in sorted(self.subroutines.items(),
+                                                                    key=lambda item: item[1][1], reverse=True)[:top]],
+            "calls": [{"caller": caller, "callee": callee, "calls": calls}
+                      for (caller, callee), calls in sorted(self.edges.items(), key=lambda item: item[1], reverse=True)],
+        }
+
+    # Time spent in the instructions from start to end inclusive, i.e. in the body of a loop
+    def range_time(self, start, end):
+        return sum(stats[1] for pc, stats in self.addresses.items() if start <= pc <= end)
+
+    def format_report(self, top=None):
+        report = self.report(top)
+        total = report["seconds"] or 1.0
+
+        lines = [f"{report['instructions']} instructions in {report['seconds'] * 1000:.1f} ms"]
+        lines.append("\nOps by time:")
+        for r in report["ops"]:
+            lines.append(f"  {r['op']:<6} {r['count']:>10} {r['seconds'] * 1000:>10.2f} ms {r['seconds'] / total:>7.1%}"
+                         f" {r['ns_per_op']:>8.0f} ns/op")
+
+        lines.append("\nHot spots:")
+        for r in report["addresses"]:
+            op = Operator.lookup(r["opcode"])
+            lines.append(f"  {CPU.format_trace(r['pc'], r['opcode'], op):<20} {r['count']:>10} "
+                         f"{r['seconds'] * 1000:>10.2f} ms {r['seconds'] / total:>7.1%}")
+
+        lines.append("\nHot loops:")
+        for r in report["loops"]:
+            lines.append(f"  {format_address(r['start'])}-{format_address(r['end'])} {r['trips']:>10} trips "
+                         f"{r['seconds'] * 1000:>10.2f} ms {r['seconds'] / total:>7.1%}")
+
+        lines.append("\nSubroutines by inclusive time:")
+        for r in report["subroutines"]:
+            lines.append(f"  {format_address(r['address'])} {r['calls']:>10} calls {r['seconds'] * 1000:>10.2f} ms "
+                         f"{r['seconds'] / total:>7.1%}")
+
+        lines.append("\nCall graph:")
+        for r in report["calls"]:
+            lines.append(f"  {format_address(r['caller'])} -> {format_address(r['callee'])} {r['calls']:>10} calls")
+
+        return lines
+
+    def print_report(self, top=None):
+        for line in self.format_report(top):
+            print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile a CHIP-8 ROM by opcode and address")
+    parser.add_argument("rom")
+    parser.add_argument("--cycles", type=int, default=100000, help="instructions to run")
+    parser.add_argument("--top", type=int, default=10, help="hot spots to list")
+    parser.add_argument("--json", help="also write the report here as JSON")
+    args = parser.parse_args(argv)
+
+    chip8 = CHIP8(debug_mode=False, headless=True)
+    chip8.load_rom(args.rom)
+    profiler = Profiler(top=args.top)
+    profiler.attach(chip8)
+    chip8.run(args.cycles)
+    profiler.detach()
+
+    profiler.print_report()
+    if args.json:
+        with open(args.json, "w") as report_file:
+            json.dump(profiler.report(), report_file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
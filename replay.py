@@ -0,0 +1,249 @@
+import argparse
+import hashlib
+import struct
+import time
+import zlib
+from collections import deque
+
+from core import *
+from savestate import HEADER as SNAPSHOT, RNG, snapshot, restore
+
+
+MAGIC = b"C8RC"
+VERSION = 1
+
+# magic, version and the length of the starting snapshot; then, zlib-compressed, the snapshot and the events
+HEADER = struct.Struct("<4sBI")
+
+# Every event is a varint of (instructions since the previous event << 3 | kind), then its payload
+# WAIT marks where an LDKP suspended: the instruction count doesn't move while it waits, so without it there'd be no
+# telling whether input at that count came before the LDKP ran or while it was waiting
+TICK, PRESS, RELEASE, RND, HASH, END, WAIT = range(7)
+PAYLOAD = {TICK: 0, PRESS: 1, RELEASE: 1, RND: 1, HASH: 8, END: 8, WAIT: 0}
+
+HASH_EVERY = 60     # timer ticks between state hashes, so about one a second
+
+
+# Leaves out the snapshot's next tick, since replay takes its ticks from the log rather than from run()'s frame phase,
+# and the generator state, since replay takes the RND results from the log too
+def state_hash(chip8):
+    data = snapshot(chip8)
+    return hashlib.blake2b(data[:SNAPSHOT.size - 8] + data[SNAPSHOT.size:-RNG.size], digest_size=8).digest()
+
+
+def write_varint(out, value):
+    while value > 0x7F:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+# Logs everything that comes into a machine from outside, so replay can run it again and end up in the same state:
+# the keypad changes, the 60 Hz timer ticks and the RND results, each tagged with the instruction count it arrived at,
+# plus a hash of the whole machine every hash_every ticks to check the replay against
+# Ticks are logged rather than worked out from the instruction count because the live loops pace them by the clock:
+# they keep ticking while LDKP waits for a key, and a compiled block can run past a frame boundary. Idle loops aren't
+# fast-forwarded while recording, so every tick lands where the program really saw it
+class Recorder:
+
+    def __init__(self, path=None, hash_every=HASH_EVERY):
+        self.path = path
+        self.hash_every = hash_every
+        self.chip8 = None
+
+    def attach(self, chip8):
+        self.chip8 = chip8
+        self.tick60 = chip8.tick
+        self.rng = chip8.cpu.rng
+        self.listener = chip8.keypad.listener
+        self.skip_idle = chip8.skip_idle
+        chip8.tick = self.tick
+        chip8.cpu.rng = self
+        chip8.keypad.listener = self.key
+        chip8.skip_idle = False
+
+        self.start = snapshot(chip8)
+        self.events = bytearray()
+        self.last = chip8.cycles
+        self.ticks = 0
+        # wait_since of the last suspended LDKP logged, which already happened if the machine is waiting now
+        self.wait_since = chip8.cpu.wait_since if chip8.cpu.waiting is not None else None
+
+    # Stop recording and save the log if there's a path for it
+    def detach(self):
+        self.log(END, state_hash(self.chip8))
+        chip8 = self.chip8
+        chip8.tick = self.tick60
+        chip8.cpu.rng = self.rng
+        chip8.keypad.listener = self.listener
+        chip8.skip_idle = self.skip_idle
+        self.chip8 = None
+        if self.path is not None:
+            self.save(self.path)
+
+    def log(self, kind, payload=b""):
+        cpu = self.chip8.cpu
+        if cpu.waiting is not None and cpu.wait_since != self.wait_since:
+            self.wait_since = cpu.wait_since
+            self.write(WAIT)
+        self.write(kind, payload)
+
+    def write(self, kind, payload=b""):
+        cycles = self.chip8.cycles
+        write_varint(self.events, (cycles - self.last) << 3 | kind)
+        self.events += payload
+        self.last = cycles
+
+    def tick(self):
+        self.tick60()
+        self.log(TICK)
+        self.ticks += 1
+        if self.ticks % self.hash_every == 0:
+            self.log(HASH, state_hash(self.chip8))
+
+    def key(self, key, down):
+        self.log(PRESS if down else RELEASE, bytes([key]))
+
+    # Stands in for the machine's random.Random, which only RND uses
+    def getrandbits(self, bits):
+        value = self.rng.getrandbits(bits)
+        self.log(RND, bytes([value]))
+        return value
+
+    # So snapshots taken while recording save and restore the real generator
+    def getstate(self):
+        return self.rng.getstate()
+
+    def setstate(self, state):
+        self.rng.setstate(state)
+
+    def data(self):
+        return HEADER.pack(MAGIC, VERSION, len(self.start)) + zlib.compress(self.start + self.events)
+
+    def save(self, path):
+        with open(path, "wb") as log_file:
+            log_file.write(self.data())
+
+
+# The starting snapshot and the events of a log, as [(cycle, kind, payload)]
+def parse(data):
+    magic, version, snapshot_size = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not an input log, or one from another version")
+    body = zlib.decompress(data[HEADER.size:])
+
+    events = []
+    cycle = SNAPSHOT.unpack_from(body)[7]     # event times count on from the snapshot's instruction count
+    offset = snapshot_size
+    while offset < len(body):
+        value, offset = read_varint(body, offset)
+        kind = value & 0x7
+        cycle += value >> 3
+        size = PAYLOAD[kind]
+        events.append((cycle, kind, body[offset:offset + size]))
+        offset += size
+
+    return body[:snapshot_size], events
+
+
+# Feeds RND the results from a log, in order
+class LoggedRandom:
+
+    def __init__(self, values):
+        self.values = deque(values)
+
+    def getrandbits(self, bits):
+        if not self.values:
+            raise ValueError("replay diverged: the program drew more random numbers than were recorded")
+        return self.values.popleft()
+
+
+# Run the machine up to the instruction count end, with no timer ticks or input on the way
+# Returns False if it stops short: it halted, or it's waiting for a key the log doesn't have yet
+def advance(chip8, end):
+    cpu = chip8.cpu
+    if chip8.cycles < end and cpu.resume():
+        # Nothing ticks before end, so an idle loop can skip straight there
+        left = end - chip8.cycles
+        chip8.cycles += chip8.fast_forward(left, left, left)
+
+    while chip8.cycles < end:
+        if not cpu.resume():
+            return False
+        step = chip8.engine if end - chip8.cycles >= CHIP8.MAX_STEP else cpu.cycle
+        executed = step(chip8.mem, chip8.display)
+        if not executed:
+            return False
+        chip8.cycles += executed
+
+    return True
+
+
+# Re-run a recorded session headless, as fast as it will go, checking the state hashes along the way
+# Raises ValueError at the first point the replay doesn't match the recording; returns the machine and some counts
+def replay(data, compiled=False):
+    start, events = parse(data)
+    memory_size = SNAPSHOT.unpack_from(start)[6]
+    chip8 = CHIP8(debug_mode=False, compiled=compiled, headless=True, memory_size=memory_size)
+    restore(chip8, start)
+    chip8.cpu.rng = LoggedRandom([payload[0] for cycle, kind, payload in events if kind == RND])
+
+    counts = {"ticks": 0, "keys": 0, "hashes": 0}
+    for cycle, kind, payload in events:
+        if kind == RND:
+            continue
+        if not advance(chip8, cycle):
+            raise ValueError(f"replay diverged: stopped at instruction {chip8.cycles}, the next input is at {cycle}")
+
+        if kind == WAIT:
+            # Run the LDKP that suspended here
+            if not chip8.cpu.resume() or chip8.cpu.cycle(chip8.mem, chip8.display) or chip8.cpu.waiting is None:
+                raise ValueError(f"replay diverged: no LDKP waiting for a key at instruction {cycle}")
+        elif kind == TICK:
+            chip8.tick()
+            counts["ticks"] += 1
+        elif kind == PRESS or kind == RELEASE:
+            if kind == PRESS:
+                chip8.keypad.press(payload[0])
+            else:
+                chip8.keypad.release(payload[0])
+            counts["keys"] += 1
+        elif state_hash(chip8) != payload:
+            raise ValueError(f"replay diverged: the state differs from the recording at instruction {cycle}")
+        else:
+            counts["hashes"] += 1
+
+    counts["draws"] = sum(1 for _, kind, _ in events if kind == RND)
+    return chip8, counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded CHIP-8 session at full speed")
+    parser.add_argument("log", help="an input log, from --record")
+    parser.add_argument("--compiled", action="store_true", help="use the block engine instead of the interpreter")
+    args = parser.parse_args(argv)
+
+    with open(args.log, "rb") as log_file:
+        data = log_file.read()
+
+    start = time.perf_counter()
+    chip8, counts = replay(data, args.compiled)
+    elapsed = time.perf_counter() - start
+    print(f"replayed {chip8.cycles:,} instructions, {counts['ticks']:,} ticks, {counts['keys']:,} key events and "
+          f"{counts['draws']:,} random numbers in {elapsed:.2f} s ({chip8.cycles / elapsed:,.0f} instructions/s)")
+    print(f"{counts['hashes']} state hashes matched the recording")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import re
+import struct
+from collections import deque
+
+from core import *
+
+
+MAGIC = b"C8SS"
+VERSION = 6
+
+# magic, version, stack size, display width and height, selected planes, memory size, cycles, the cycle count the
+# timers next tick at; the CPU state (CPU.STATE and the stack) and the keypad state (Keypad.STATE) follow
+HEADER = struct.Struct("<4sBBBBBIQQ")
+
+# The version of the random.Random state (0 if the machine's generator can't save one), then its 625 words
+# Always last in a snapshot, so a state hash can leave it out
+RNG = struct.Struct("<B625I")
+
+# A run of non-zero bytes in an XOR delta
+CHANGED = re.compile(rb"[^\x00]+")
+# offset and length of one run in an encoded delta (32-bit, since XO-CHIP's memory alone is 64 KB)
+RUN = struct.Struct("<II")
+
+
+# The whole machine as bytes: header, CPU and keypad state, memory, each plane of the framebuffer packed 8 pixels to a
+# byte, then the state of the generator RND draws from, so a restored machine draws the same numbers
+def snapshot(chip8):
+    cpu = chip8.cpu
+    display = chip8.display
+    return b"".join((
+        HEADER.pack(MAGIC, VERSION, len(cpu.stack), display.width, display.height, display.plane_mask,
+                    len(chip8.mem.mem), chip8.cycles, chip8.next_tick),
+        cpu.get_state(),
+        chip8.keypad.get_state(),
+        chip8.mem.mem,
+        *[display.get_packed(p) for p in range(PLANES)],
+        get_rng_state(cpu.rng),
+    ))
+
+
+def get_rng_state(rng):
+    if not hasattr(rng, "getstate"):
+        return RNG.pack(0, *[0] * 625)
+    version, words, gauss_next = rng.getstate()
+    return RNG.pack(version, *words)
+
+
+# RND only calls getrandbits, which doesn't use gauss_next
+def set_rng_state(rng, data):
+    version, *words = RNG.unpack_from(data)
+    if version and hasattr(rng, "setstate"):
+        rng.setstate((version, tuple(words), None))
+
+
+# Put the machine back into the state a snapshot was taken in
+def restore(chip8, data):
+    magic, version, stack_size, width, height, plane_mask, memory_size, cycles, next_tick = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a CHIP-8 save state")
+
+    cpu = chip8.cpu
+    display = chip8.display
+    if stack_size != len(cpu.stack) or memory_size != len(chip8.mem.mem):
+        raise ValueError("save state is for a differently configured machine")
+    # The resolution is part of the program's state (SUPER-CHIP's LOW and HIGH), so follow it
+    if (width, height) != (display.width, display.height):
+        display.resize(width, height)
+    display.plane_mask = plane_mask
+
+    # The keypad first, so a restored LDKP counts presses from the restored keypad's
+    offset = HEADER.size + CPU.STATE.size + 2 * stack_size
+    chip8.keypad.set_state(data[offset:])
+    cpu.set_state(data[HEADER.size:])
+    offset += Keypad.STATE.size
+    chip8.cycles = cycles
+    chip8.next_tick = next_tick
+
+    load_memory(chip8.mem, data[offset:offset + memory_size])
+    offset += memory_size
+
+    row_bytes = width // 8
+    for plane in display.planes:
+        plane[:] = [int.from_bytes(data[offset + y * row_bytes:offset + (y + 1) * row_bytes], "big")
+                    for y in range(height)]
+        offset += height * row_bytes
+    display.dirty[:] = b"\x01" * height
+
+    set_rng_state(cpu.rng, data[offset:])
+
+
+# Overwrite memory with new contents, only writing (and invalidating decoded code for) the ranges that changed
+def load_memory(memory, contents):
+    for start, end in changed_ranges(memory.mem, contents):
+        memory.load(start, contents[start:end])
+
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+
+def changed_ranges(old, new):
+    return [match.span() for match in CHANGED.finditer(xor_bytes(old, new))]
+
+
+# Encode the difference between two equal-length snapshots as the runs of their XOR that aren't zero
+def encode_delta(old, new):
+    diff = xor_bytes(old, new)
+    parts = []
+    for match in CHANGED.finditer(diff):
+        start, end = match.span()
+        parts.append(RUN.pack(start, end - start))
+        parts.append(match.group())
+    return b"".join(parts)
+
+
+# Apply an encoded delta to a snapshot; XOR works in both directions, so this goes forwards or backwards
+def apply_delta(data, delta):
+    data = bytearray(data)
+    offset = 0
+    while offset < len(delta):
+        start, length = RUN.unpack_from(delta, offset)
+        offset += RUN.size
+        end = start + length
+        data[start:end] = xor_bytes(data[start:end], delta[offset:offset + length])
+        offset += length
+    return bytes(data)
+
+
+# Bounded history of snapshots for rewinding
+# Every keyframe_interval-th snapshot is kept whole; the ones in between are stored as deltas from the snapshot
+# before them, so memory use stays small and any frame is at most keyframe_interval - 1 deltas from a keyframe.
+# Once the history holds more than capacity snapshots, the oldest keyframe and its deltas are dropped together
+class RewindBuffer:
+
+    def __init__(self, capacity=600, keyframe_interval=30):
+        self.capacity = capacity
+        self.keyframe_interval = keyframe_interval
+        self.groups = deque()   # [keyframe, delta, delta, ...] for each keyframe
+        self.latest = None      # the newest snapshot, kept whole to make the next delta
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, data):
+        # A snapshot of another size (the program switched resolution) can't be a delta, so it starts a new keyframe
+        if not self.groups or len(self.groups[-1]) == self.keyframe_interval or len(data) != len(self.latest):
+            self.groups.append([data])
+        else:
+            self.groups[-1].append(encode_delta(self.latest, data))
+
+        self.latest = data
+        self.size += 1
+        while self.size - len(self.groups[0]) >= self.capacity:
+            self.size -= len(self.groups.popleft())
+
+    # Take a snapshot of the machine and add it to the history
+    def record(self, chip8):
+        self.push(snapshot(chip8))
+
+    # Drop the newest frames snapshots and return the one before them, which becomes the newest
+    # Returns None if the history doesn't go back that far
+    def rewind(self, frames=1):
+        if frames >= self.size:
+            return None
+
+        for _ in range(frames):
+            group = self.groups[-1]
+            if len(group) == 1:
+                self.groups.pop()
+                self.latest = self.groups[-1][0]
+                for delta in self.groups[-1][1:]:
+                    self.latest = apply_delta(self.latest, delta)
+            else:
+                self.latest = apply_delta(self.latest, group.pop())
+            self.size -= 1
+
+        return self.latest
+
+    # Bytes held by the history, for keeping an eye on memory use
+    def footprint(self):
+        return sum(len(item) for group in self.groups for item in group)
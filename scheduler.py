@@ -0,0 +1,84 @@
+import math
+import time
+
+
+# Paces the emulator at a fixed frame rate: each frame runs a set number of instructions, ticks the timers once and
+# then sleeps until the next frame is due
+# Deadlines advance by exactly one period per frame from the start time, so rounding and oversleeping never
+# accumulate into drift. A frame that starts after its deadline counts as late; if the emulator falls more than
+# MAX_LAG frames behind it gives up on catching up and restarts the schedule from now
+class Scheduler:
+
+    MAX_LAG = 5     # frames we'll run back-to-back to catch up before resyncing
+
+    def __init__(self, instructions_per_frame=10, frame_rate=60, clock=time.perf_counter, sleep=time.sleep):
+        self.instructions_per_frame = instructions_per_frame
+        self.frame_rate = frame_rate
+        self.period = 1 / frame_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.start()
+
+    # Begin a new schedule, with the first frame due one period from now
+    def start(self):
+        now = self.clock()
+        self.next_frame = now + self.period
+        self.last_frame = now
+
+        self.frames = 0
+        self.late_frames = 0
+        self.resyncs = 0
+        self.slept = 0.0
+        # Running mean and sum of squared differences of the frame times (Welford's method)
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.max_frame = 0.0
+
+    # Sleep until the next frame is due, then record how long this frame took
+    def wait(self):
+        now = self.clock()
+        delay = self.next_frame - now
+        if delay > 0:
+            self.sleep(delay)
+            self.slept += delay
+            now = self.clock()
+        else:
+            self.late_frames += 1
+            if -delay > Scheduler.MAX_LAG * self.period:
+                self.resyncs += 1
+                self.next_frame = now
+
+        self.next_frame += self.period
+        self.record(now - self.last_frame)
+        self.last_frame = now
+
+    # Seconds until the next frame is due, negative if it's late
+    def remaining(self):
+        return self.next_frame - self.clock()
+
+    def record(self, frame_time):
+        self.frames += 1
+        delta = frame_time - self.mean
+        self.mean += delta / self.frames
+        self.m2 += delta * (frame_time - self.mean)
+        self.max_frame = max(self.max_frame, frame_time)
+
+    # Pacing statistics so far, times in milliseconds
+    def stats(self):
+        jitter = math.sqrt(self.m2 / self.frames) if self.frames else 0.0
+        return {
+            "frames": self.frames,
+            "instructions_per_frame": self.instructions_per_frame,
+            "mean_frame_ms": self.mean * 1000,
+            "jitter_ms": jitter * 1000,
+            "max_frame_ms": self.max_frame * 1000,
+            "late_frames": self.late_frames,
+            "resyncs": self.resyncs,
+            "idle_fraction": self.slept / (self.frames * self.period) if self.frames else 0.0,
+        }
+
+    def summary(self):
+        s = self.stats()
+        return (f"{s['frames']} frames @ {s['instructions_per_frame']} instructions/frame: "
+                f"mean {s['mean_frame_ms']:.2f} ms, jitter {s['jitter_ms']:.2f} ms, max {s['max_frame_ms']:.2f} ms, "
+                f"{s['late_frames']} late, {s['resyncs']} resyncs, {s['idle_fraction']:.0%} idle")
@@ -0,0 +1,328 @@
+import argparse
+import asyncio
+import os
+import struct
+import time
+import zlib
+
+from core import *
+
+
+# Every message is a type byte and a payload length, then the payload:
+#   client -> server   JOIN   ROM name (UTF-8), sent once to start a session running that ROM
+#                      ACK    <I> the seq of a frame the client has applied
+#                      KEY    <B> a key event: the key, plus KEY_DOWN for a press
+#   server -> client   HELLO  <HHI> width, height, session id; sent again whenever the program switches resolution,
+#                             after which the screen is blank and the next frame builds on that
+#                      FRAME  <II> seq and base seq, then a chunk of the connection's zlib stream that inflates to
+#                             (row index, packed row) pairs for the rows that differ from frame base, in the first
+#                             bitplane
+#                      HALT   the program stopped, after its last frame; the payload says why if it crashed (UTF-8)
+#                      ERROR  what went wrong (UTF-8), then the server closes the connection
+HEADER = struct.Struct("<cI")
+JOIN, ACK, KEY, HELLO, FRAME, HALT, ERROR = b"J", b"A", b"K", b"H", b"F", b"X", b"E"
+HELLO_BODY = struct.Struct("<HHI")
+FRAME_BODY = struct.Struct("<II")
+SEQ = struct.Struct("<I")
+
+KEY_DOWN = 0x80
+MAX_MESSAGE = 0x10000   # longest payload a client may send
+MAX_IN_FLIGHT = 4       # frames sent past the last ack before a session stops sending; a slow client gets fewer frames
+
+
+def message(kind, payload=b""):
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+async def read_message(reader):
+    kind, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_MESSAGE:
+        raise ValueError(f"{length} byte message")
+    return kind, await reader.readexactly(length)
+
+
+# One client's machine, and what that client has seen of its framebuffer
+# Frames are numbered from 1; frame 0 is the blank screen every client starts with. Each frame is sent as the rows
+# that differ from the last frame the client acknowledged, so a frame is never built on one that might not have arrived
+class Session:
+
+    def __init__(self, session_id, rom_path, writer, instructions_per_frame):
+        self.id = session_id
+        self.chip8 = CHIP8(debug_mode=False, headless=True, instructions_per_frame=instructions_per_frame)
+        self.chip8.load_rom(rom_path)
+        self.writer = writer
+        self.compressor = zlib.compressobj(1)
+
+        display = self.chip8.display
+        self.width = display.width
+        self.height = display.height
+        self.row_bytes = display.width // 8
+        self.seq = 0
+        self.acked = 0
+        self.sent = {0: [0] * display.height}   # seq -> rows, for the acked frame and every frame sent after it
+        self.halted = False
+        self.halt_reason = None     # sent once the last frame is out
+        self.cpu_time = 0.0     # seconds spent running this session, which the server shares out fairly
+
+    # Run a frame's worth of instructions, ticking the timers once
+    def run_frame(self, clock):
+        start = clock()
+        chip8 = self.chip8
+        per_frame = chip8.scheduler.instructions_per_frame
+        try:
+            executed = chip8.run(per_frame)
+        except Exception as e:
+            # A crashing program only stops its own session
+            self.halted = True
+            self.halt_reason = f"{type(e).__name__}: {e}"
+            executed = per_frame
+        if executed < per_frame:
+            if chip8.cpu.waiting is None:
+                self.halted = True
+                self.halt_reason = ""
+            elif executed == 0:
+                chip8.tick()            # the timers keep running while the program waits for a key
+        self.cpu_time += clock() - start
+
+    def hello(self):
+        self.writer.write(message(HELLO, HELLO_BODY.pack(self.width, self.height, self.id)))
+
+    # Send the framebuffer if it changed and the client is keeping up, then the HALT if the program has stopped
+    def send_frame(self):
+        display = self.chip8.display
+        if (display.width, display.height) != (self.width, self.height):
+            # The client starts over from a blank screen at the new size, as of the last frame sent
+            self.width, self.height = display.width, display.height
+            self.row_bytes = display.width // 8
+            self.sent = {self.seq: [0] * display.height}
+            self.acked = self.seq
+            self.hello()
+        if display.dirty.find(1) != -1:
+            if self.seq - self.acked >= MAX_IN_FLIGHT:
+                return
+            self.send_delta()
+        if self.halt_reason is not None:
+            self.writer.write(message(HALT, self.halt_reason.encode()))
+            self.halt_reason = None
+
+    def send_delta(self):
+        display = self.chip8.display
+        rows = list(display.rows)
+        base = self.sent[self.acked]
+        delta = b"".join([bytes([y]) + row.to_bytes(self.row_bytes, "big")
+                          for y, (row, old) in enumerate(zip(rows, base)) if row != old])
+        self.seq += 1
+        self.sent[self.seq] = rows
+        display.dirty[:] = bytes(display.height)
+
+        chunk = self.compressor.compress(delta) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.writer.write(message(FRAME, FRAME_BODY.pack(self.seq, self.acked) + chunk))
+
+    def ack(self, seq):
+        if self.acked < seq <= self.seq:
+            for old in range(self.acked, seq):
+                del self.sent[old]
+            self.acked = seq
+
+    def key(self, event):
+        if event & KEY_DOWN:
+            self.chip8.keypad.press(event & 0xF)
+        else:
+            self.chip8.keypad.release(event & 0xF)
+
+
+# Hosts a headless machine for every connected client in one process, running them all from a single 60 Hz loop
+# Each frame the sessions that have had the least CPU time so far run first, until the frame's CPU budget is spent;
+# the rest wait for a later frame. A session costing twice as much per frame as the others gets half as many frames
+# once the server is overloaded, rather than slowing everyone down. Idle loops are fast-forwarded (see
+# CHIP8.fast_forward) and a program waiting for a key costs nothing, so only busy sessions use much of the budget
+class Server:
+
+    def __init__(self, rom_dir, instructions_per_frame=CHIP8.CYCLES_PER_TICK, frame_rate=60, cpu_share=0.75,
+                 max_sessions=1000, clock=time.perf_counter):
+        self.rom_dir = rom_dir
+        self.instructions_per_frame = instructions_per_frame
+        self.period = 1 / frame_rate
+        self.budget = cpu_share * self.period   # seconds of emulation per frame, leaving the rest for the network
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self.sessions = {}
+        self.next_id = 1
+
+        self.frames = 0
+        self.deferred = 0       # session frames pushed to a later frame by the budget
+        self.overruns = 0       # frames that took longer than the frame period
+
+    def rom_path(self, name):
+        path = os.path.join(self.rom_dir, name)
+        if os.path.basename(name) != name or not os.path.isfile(path):
+            raise ValueError(f"no ROM called {name!r}")
+        return path
+
+    # One connection: a JOIN, then ACKs and KEYs until the client hangs up
+    async def handle(self, reader, writer):
+        session = None
+        try:
+            kind, payload = await read_message(reader)
+            if kind != JOIN:
+                raise ValueError("expected JOIN")
+            if len(self.sessions) >= self.max_sessions:
+                raise ValueError("server full")
+            session = Session(self.next_id, self.rom_path(payload.decode()), writer, self.instructions_per_frame)
+            self.next_id += 1
+            # Start level with the least-served session, so a new one neither jumps the queue nor waits behind it
+            session.cpu_time = min([s.cpu_time for s in self.sessions.values()], default=0.0)
+            self.sessions[session.id] = session
+            session.hello()
+
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == ACK:
+                    session.ack(SEQ.unpack(payload)[0])
+                elif kind == KEY:
+                    session.key(payload[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ValueError, UnicodeDecodeError, struct.error, IndexError) as e:
+            writer.write(message(ERROR, str(e).encode()))
+        finally:
+            if session is not None:
+                del self.sessions[session.id]
+            writer.close()
+
+    # Run one frame of every session the budget allows, then send whatever changed
+    def step(self):
+        deadline = self.clock() + self.budget
+        active = sorted([s for s in self.sessions.values() if not s.halted], key=lambda s: s.cpu_time)
+        for served, session in enumerate(active):
+            if self.clock() >= deadline:
+                self.deferred += len(active) - served
+                break
+            session.run_frame(self.clock)
+
+        for session in self.sessions.values():
+            session.send_frame()
+        self.frames += 1
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        next_frame = loop.time()
+        while True:
+            self.step()
+            next_frame += self.period
+            delay = next_frame - loop.time()
+            if delay < 0:
+                self.overruns += 1
+                next_frame = loop.time()
+            # Always yield, so connections get handled even when the server is behind
+            await asyncio.sleep(max(delay, 0))
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "frames": self.frames,
+            "deferred": self.deferred,
+            "overruns": self.overruns,
+        }
+
+    async def serve(self, host="127.0.0.1", port=8765, path=None):
+        # A big listen backlog, so a dashboard opening hundreds of sessions at once doesn't get connections refused
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path, backlog=1024)
+        else:
+            server = await asyncio.start_server(self.handle, host, port, backlog=1024)
+        async with server:
+            await self.run()
+
+
+# The other end of a connection, for dashboards and scripts: keeps the client's copies of the frames and acks them
+class Client:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.decompressor = zlib.decompressobj()
+        self.frames = {0: None}     # seq -> rows of the frames a later delta might be based on
+        self.seq = 0
+        self.halted = False
+        self.halt_reason = ""
+
+    @staticmethod
+    async def connect(rom, host="127.0.0.1", port=8765, path=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        client = Client(reader, writer)
+        writer.write(message(JOIN, rom.encode()))
+
+        kind, payload = await read_message(reader)
+        if kind == ERROR:
+            raise ValueError(payload.decode())
+        client.hello(payload)
+        return client
+
+    # Start over from a blank screen of the size in a HELLO, as of the last frame
+    def hello(self, payload):
+        self.width, self.height, self.id = HELLO_BODY.unpack(payload)
+        self.row_bytes = self.width // 8
+        self.frames = {self.seq: [0] * self.height}
+
+    # Wait for the next frame and return its rows, one integer per row with the leftmost pixel in the highest bit
+    # Returns None once the program has stopped, with halt_reason saying why if it crashed
+    async def frame(self):
+        while True:
+            kind, payload = await read_message(self.reader)
+            if kind == HALT:
+                self.halted = True
+                self.halt_reason = payload.decode()
+                return None
+            if kind == ERROR:
+                raise ValueError(payload.decode())
+            if kind == HELLO:
+                self.hello(payload)
+                continue
+            if kind != FRAME:
+                continue
+
+            seq, base = FRAME_BODY.unpack_from(payload)
+            delta = self.decompressor.decompress(payload[FRAME_BODY.size:])
+            rows = list(self.frames[base])
+            step = 1 + self.row_bytes
+            for offset in range(0, len(delta), step):
+                rows[delta[offset]] = int.from_bytes(delta[offset + 1:offset + step], "big")
+
+            self.frames = {s: f for s, f in self.frames.items() if s >= base}
+            self.frames[seq] = rows
+            self.seq = seq
+            self.writer.write(message(ACK, SEQ.pack(seq)))
+            return rows
+
+    def key(self, key, down):
+        self.writer.write(message(KEY, bytes([key | (KEY_DOWN if down else 0)])))
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream headless CHIP-8 sessions to local clients")
+    parser.add_argument("roms", help="directory of ROMs clients can ask for")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="listen on this UNIX socket instead of TCP")
+    parser.add_argument("--ipf", type=int, default=CHIP8.CYCLES_PER_TICK, help="instructions per 60 Hz frame")
+    parser.add_argument("--cpu-share", type=float, default=0.75, help="fraction of each frame spent emulating")
+    parser.add_argument("--max-sessions", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    server = Server(args.roms, args.ipf, cpu_share=args.cpu_share, max_sessions=args.max_sessions)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        print(server.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import threading
+
+from bench.roms import assemble
+from core import *
+from debugger import Debugger
+
+
+# ADD V0, 01 then JP to itself, which run() fast-forwards over instead of fetching
+IDLE = assemble(0x7001, 0x1202)
+
+
+def machine():
+    chip8 = CHIP8(debug_mode=False, headless=True)
+    chip8.mem.load(PGM_MEM_START, IDLE)
+    return chip8
+
+
+def test_pause_stops_an_idle_loop():
+    chip8 = machine()
+    debugger = Debugger()
+    debugger.attach(chip8)
+
+    runner = threading.Thread(target=chip8.run, daemon=True)
+    runner.start()
+    runner.join(0.2)
+    assert runner.is_alive()    # sitting in JP 202
+
+    debugger.pause()
+    runner.join(5)
+    assert not runner.is_alive()
+    assert debugger.stop == "paused"
+    assert chip8.cpu.pc == 0x202
+
+    # Carrying on skips the idle loop again
+    debugger.resume()
+    assert chip8.skip_idle
+    assert chip8.run(10000) == 10000
+
+
+def test_breakpoints_outlast_detach():
+    chip8 = machine()
+    debugger = Debugger()
+    debugger.attach(chip8)
+    assert debugger.rearm not in chip8.mem.invalidators
+
+    debugger.break_at(0x202)
+    assert debugger.rearm in chip8.mem.invalidators
+    debugger.detach()
+    assert debugger.rearm not in chip8.mem.invalidators
+    assert chip8.mem.decoded[0x202] is None
+
+    debugger.attach(chip8)
+    assert chip8.run(100) == 1
+    assert debugger.stop == "breakpoint 202"
@@ -0,0 +1,51 @@
+from bench.roms import assemble
+from core import *
+from savestate import snapshot, restore
+
+
+# Draws a random byte into V0 and V1 over and over
+RANDOM = assemble(0xC0FF, 0xC1FF, 0x1200)
+
+
+def machine():
+    chip8 = CHIP8(debug_mode=False, headless=True)
+    chip8.mem.load(PGM_MEM_START, RANDOM)
+    return chip8
+
+
+# V0 and V1 after each of the next count passes through the loop
+def draws(chip8, count):
+    values = []
+    for _ in range(count):
+        chip8.run(3)
+        values.append(bytes(chip8.cpu.v[:2]))
+    return values
+
+
+def test_restored_machine_draws_the_same_random_numbers():
+    original = machine()
+    original.run(99)
+    data = snapshot(original)
+    expected = draws(original, 50)
+
+    copy = machine()
+    restore(copy, data)
+    assert draws(copy, 50) == expected
+
+    # Restoring into the machine that took the snapshot rewinds its generator too
+    restore(original, data)
+    assert draws(original, 50) == expected
+
+
+def test_snapshot_keeps_the_keypad():
+    original = machine()
+    original.keypad.press(0x3)
+    original.keypad.press(0xA)
+    original.keypad.release(0x3)
+    data = snapshot(original)
+
+    copy = machine()
+    restore(copy, data)
+    assert copy.keypad.pressed == 1 << 0xA
+    assert copy.keypad.presses == 2
+    assert copy.keypad.new_press(0) == 0x3